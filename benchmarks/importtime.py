@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""
+${LICENSE_HEADER}
+"""
+
+import sys
+import subprocess
+
+# modules that must never be loaded just by importing the headless modules
+HEAVY_MODULES = ['PyQt5', 'cv2', 'Crypto', 'serial', 'numpy']
+
+TARGETS = [
+    'monnalisa.xyz',
+    'monnalisa.jobs',
+    'monnalisa.server',
+    'monnalisa.convert',
+]
+
+
+def importtime(module):
+    """
+    Return the cumulative import time of module in microseconds and the
+    list of the heavy modules it loaded
+    """
+    code = (
+        f"import sys, {module}\n"
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        capture_output=True, text=True, check=True
+    )
+    usecs = 0
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            usecs = int(fields[1])
+    loaded = [m for m in proc.stdout.strip().split(',') if m]
+    return usecs, loaded
+
+
+def main():
+    failed = False
+    for module in TARGETS:
+        usecs, loaded = importtime(module)
+        print(f"{module:24s} {usecs/1000:8.1f} ms", end='')
+        if loaded:
+            failed = True
+            print(f"  FAIL: loads {', '.join(loaded)}")
+        else:
+            print()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
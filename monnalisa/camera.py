@@ -0,0 +1,198 @@
+"""
+${LICENSE_HEADER}
+"""
+
+import time
+import zlib
+import base64
+import struct
+import logging
+import importlib.util
+import multiprocessing
+
+
+def available():
+    """
+    Whether OpenCV is installed, without importing it since it is slow
+    """
+    return importlib.util.find_spec('cv2') is not None
+
+
+class FrameRing():
+    """
+    Ring of encoded frames in shared memory, written by one process and
+    read by another.
+
+    The header holds the number of slots and their size, the sequence
+    number of the last frame written, its slot and the slot in use by the
+    reader, that the writer skips. Each slot starts with the sequence
+    number of its frame, the size of the data and the shape of the frame.
+    """
+
+    HEADER = struct.Struct('<IIQii')
+    SLOT_HEADER = struct.Struct('<QIB3I')
+
+    def __init__(self, name=None, slots=4, slot_size=1 << 22):
+        from multiprocessing import shared_memory
+        if name is None:
+            size = self.HEADER.size
+            size += slots * (self.SLOT_HEADER.size + slot_size)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.HEADER.pack_into(self.shm.buf, 0, slots, slot_size, 0, -1,
+                                  -1)
+        else:
+            self.shm = shared_memory.SharedMemory(name)
+        self.name = self.shm.name
+        self.slots, self.slot_size = self.HEADER.unpack_from(
+            self.shm.buf
+        )[:2]
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+    def _offset(self, slot):
+        return (self.HEADER.size +
+                slot * (self.SLOT_HEADER.size + self.slot_size))
+
+    def write(self, data, shape):
+        """
+        Store a new frame, returns its sequence number, None if it does not
+        fit in a slot
+        """
+        if len(data) > self.slot_size:
+            return None
+        slots, slot_size, seq, last, pinned = self.HEADER.unpack_from(
+            self.shm.buf
+        )
+        slot = (last + 1) % slots
+        if slot == pinned:
+            slot = (slot + 1) % slots
+        seq += 1
+        off = self._offset(slot)
+        start = off + self.SLOT_HEADER.size
+        self.shm.buf[start:start+len(data)] = data
+        ndim = min(len(shape), 3)
+        shape = (tuple(shape) + (0, 0, 0))[:3]
+        self.SLOT_HEADER.pack_into(self.shm.buf, off, seq, len(data), ndim,
+                                   *shape)
+        # the frame is published only once it is complete; pinned belongs to
+        # the reader, only seq and last are written
+        struct.pack_into('<Qi', self.shm.buf, 8, seq, slot)
+        return seq
+
+    @property
+    def seq(self):
+        return self.HEADER.unpack_from(self.shm.buf)[2]
+
+    def latest(self):
+        """
+        Pin the last frame and return its sequence number, shape and a
+        memoryview of its data, that stays valid until release(). Returns
+        None if there is no frame yet.
+        """
+        while True:
+            slots, slot_size, seq, last, pinned = self.HEADER.unpack_from(
+                self.shm.buf
+            )
+            if seq == 0:
+                return None
+            struct.pack_into('<i', self.shm.buf, self.HEADER.size - 4, last)
+            off = self._offset(last)
+            slot_seq, size, ndim, *shape = self.SLOT_HEADER.unpack_from(
+                self.shm.buf, off
+            )
+            if slot_seq == seq:
+                start = off + self.SLOT_HEADER.size
+                return seq, tuple(shape[:ndim]), self.shm.buf[start:start+size]
+            # overwritten before being pinned, try with the new one
+
+    def valid(self, seq):
+        """
+        Whether the pinned frame seq is still intact
+        """
+        pinned = self.HEADER.unpack_from(self.shm.buf)[4]
+        if pinned < 0:
+            return False
+        return self.SLOT_HEADER.unpack_from(
+            self.shm.buf, self._offset(pinned)
+        )[0] == seq
+
+    def release(self):
+        struct.pack_into('<i', self.shm.buf, self.HEADER.size - 4, -1)
+
+
+def capture(ring_name, notify, device=0, interval=10, scale=2):
+    """
+    Body of the camera process: capture a frame every interval seconds,
+    downsize it, encode it as a base64 encoded compressed PNG and store it
+    in the ring, then send its sequence number through notify
+    """
+    import cv2
+    ring = FrameRing(ring_name)
+    cam = cv2.VideoCapture(device)
+    try:
+        while True:
+            stme = time.monotonic()
+            ret, frame = cam.read()
+            if ret:
+                frame = frame[::scale, ::scale]
+                data = cv2.imencode('.png', frame)[1]
+                data = base64.b64encode(zlib.compress(data, 9))
+                seq = ring.write(data, frame.shape)
+                if seq is None:
+                    logging.warning("Camera frame of %d bytes too big for "
+                                    "the ring", len(data))
+                else:
+                    notify.send(seq)
+            time.sleep(max(0, interval - (time.monotonic() - stme)))
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        cam.release()
+        ring.close()
+
+
+class Camera():
+    """
+    Captures and encodes the frames of a camera in a separate process, so
+    that the camera never competes for the GIL with the printer I/O. The
+    frames are read from a FrameRing.
+    """
+
+    def __init__(self, device=0, interval=10, slots=4, slot_size=1 << 22,
+                 target=capture):
+        self.ring = FrameRing(slots=slots, slot_size=slot_size)
+        # a fresh interpreter, without the threads of the server
+        ctx = multiprocessing.get_context('spawn')
+        self._notify, notify = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(
+            target=target, args=(self.ring.name, notify, device, interval),
+            daemon=True
+        )
+        self.process.start()
+        notify.close()
+
+    def wait(self, timeout=None):
+        """
+        Wait for a new frame, returns False on timeout or if the camera
+        process has exited
+        """
+        try:
+            if not self._notify.poll(timeout):
+                return False
+            # only the last frame matters
+            while self._notify.poll():
+                self._notify.recv()
+        except (EOFError, OSError):
+            return False
+        return True
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        self._notify.close()
+        self.ring.close()
+        self.ring.unlink()
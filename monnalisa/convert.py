@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+"""
+${LICENSE_HEADER}
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import monnalisa
+from monnalisa import xyz
+
+
+GCODE_EXTENSIONS = ('.gcode', '.gco', '.g')
+
+# Rough peak memory used by a conversion, in multiples of the input size
+# (decoded text, rewritten text and encoded text, the output is written
+# straight into a memory mapped file)
+MEMORY_FACTOR = 3
+
+
+def findinputs(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for fname in sorted(files):
+                    if fname.lower().endswith(GCODE_EXTENSIONS):
+                        yield os.path.join(root, fname)
+        else:
+            yield path
+
+
+def outputpath(src, outdir):
+    base = os.path.splitext(os.path.basename(src))[0] + '.3w'
+    if outdir is None:
+        return os.path.join(os.path.dirname(src), base)
+    return os.path.join(outdir, base)
+
+
+def wwwformat(path):
+    """
+    The (version, zipped, machine id) of the 3w file path
+    """
+    with open(path, 'rb') as f:
+        data = f.read(0x2000)
+    header = xyz.readwwwheader(data)
+    pos = 20 + int.from_bytes(data[16:20], byteorder='big')
+    return (data[13], data[pos:pos+8] == b'TagEa128', header.get('machine'))
+
+
+def isuptodate(src, dst, machine_id):
+    """
+    Whether dst is newer than src and was converted for machine_id
+    """
+    try:
+        if os.stat(dst).st_mtime < os.stat(src).st_mtime:
+            return False
+        fmt = wwwformat(dst)
+    except (OSError, ValueError):
+        return False
+    return fmt == (*xyz.MACHINES[machine_id][:2], machine_id)
+
+
+def convertfile(src, dst, machine_id, profile=None, level=-1,
+                minify=False):
+    version, zipped = xyz.MACHINES[machine_id][:2]
+    with open(src, 'rb') as f:
+        gcode = f.read().decode()
+    stats = xyz.ConversionStats()
+    tmp = dst + '.part'
+    try:
+        xyz.profilecall(
+            profile, xyz.gcode2www, gcode, version, zipped, machine_id,
+            stats=stats, level=level, minify=minify, output=tmp
+        )
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, dst)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert G-code files to the 3w format'
+    )
+    parser.add_argument("inputs", metavar='PATH', nargs='*',
+                        help="G-code files or directories containing "
+                        "G-code files to convert.")
+    parser.add_argument("--machine", '-m', metavar='ID', type=str,
+                        choices=sorted(xyz.MACHINES), default='daVinciF10',
+                        help="The machine id of the target printer. The "
+                        "default value is %(default)s.")
+    parser.add_argument("--output-dir", '-o', metavar='DIR', type=str,
+                        default=None, help="Write the converted files in "
+                        "%(metavar)s instead of next to the input files.")
+    parser.add_argument("--level", '-l', metavar='LEVEL', type=int,
+                        choices=range(-1, 10), default=-1, help="Deflate "
+                        "level (0-9) used for zipped files, -1 means the "
+                        "zlib default.")
+    parser.add_argument("--minify", action='store_true',
+                        help="Strip comments, whitespaces and redundant "
+                        "words from the G-code before converting it.")
+    parser.add_argument("--jobs", '-j', metavar='N', type=int,
+                        default=os.cpu_count(), help="Number of worker "
+                        "processes. Defaults to the number of CPUs.")
+    parser.add_argument("--memory", metavar='MB', type=int, default=1024,
+                        help="Approximate memory budget for the files being "
+                        "converted at the same time. The default value is "
+                        "%(default)d MB.")
+    parser.add_argument("--force", '-f', action='store_true',
+                        help="Convert also the files whose output is already "
+                        "up to date.")
+    parser.add_argument("--profile", choices=['cprofile', 'tracemalloc'],
+                        default=None, help="Log a cProfile or tracemalloc "
+                        "report for each conversion.")
+    parser.add_argument("--version", action='store_true')
+
+    args = parser.parse_args()
+
+    if args.version:
+        print(f"Monnalisa v{monnalisa.__version__}")
+        sys.exit(0)
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    clog = logging.StreamHandler()
+    logger.addHandler(clog)
+    clog.setLevel(logging.INFO)
+    clog.setFormatter(logging.Formatter('%(levelname)s  %(message)s'))
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    budget = args.memory * 1024 * 1024
+    jobs = []
+    skipped = 0
+    failed = 0
+    # e.g. a/part.gcode and b/part.gcode with --output-dir, or part.g and
+    # part.gcode in the same directory
+    outputs = {}
+    for src in findinputs(args.inputs):
+        dst = outputpath(src, args.output_dir)
+        key = os.path.normcase(os.path.abspath(dst))
+        if key in outputs:
+            logger.error("Cannot convert %s: %s is already the output of %s",
+                         src, dst, outputs[key])
+            failed += 1
+            continue
+        outputs[key] = src
+        if not args.force and isuptodate(src, dst, args.machine):
+            skipped += 1
+            continue
+        try:
+            size = os.path.getsize(src)
+        except OSError as exc:
+            logger.error("Cannot convert %s: %s", src, exc)
+            failed += 1
+            continue
+        jobs.append((src, dst, size))
+
+    converted = 0
+    bytes_in = 0
+    bytes_out = 0
+    bytes_saved = 0
+    start_time = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        pending = {}
+        in_flight = 0
+        jobs.reverse()
+        while jobs or pending:
+            # always allow at least one job, even if bigger than the budget
+            while jobs and (
+                not pending or
+                in_flight + jobs[-1][2] * MEMORY_FACTOR <= budget
+            ):
+                src, dst, size = jobs.pop()
+                future = pool.submit(
+                    convertfile, src, dst, args.machine, args.profile,
+                    args.level, args.minify
+                )
+                pending[future] = (src, dst, size)
+                in_flight += size * MEMORY_FACTOR
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                src, dst, size = pending.pop(future)
+                in_flight -= size * MEMORY_FACTOR
+                try:
+                    stats = future.result()
+                except Exception as exc:
+                    # a broken file must not stop the others
+                    logger.error("Cannot convert %s: %s: %s", src,
+                                 type(exc).__name__, exc)
+                    failed += 1
+                    continue
+                converted += 1
+                # the input size of the stats counts characters
+                bytes_in += size
+                bytes_out += stats.sizes['output']
+                logger.info("%s -> %s (%.1f ms)",
+                            src, dst, stats.total() * 1000)
+                bytes_saved += stats.sizes.get('saved', 0)
+
+    elapsed = time.perf_counter() - start_time
+    rate = bytes_in / elapsed / 1024 / 1024 if elapsed > 0 else 0
+    print(f"{converted} converted, {skipped} up to date, {failed} failed; "
+          f"{bytes_in / 1024 / 1024:.1f} MB in, "
+          f"{bytes_out / 1024 / 1024:.1f} MB out "
+          f"in {elapsed:.2f} s ({rate:.1f} MB/s)")
+    if args.minify:
+        print(f"Minification saved {bytes_saved / 1024 / 1024:.1f} MB")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+"""
+${LICENSE_HEADER}
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+
+import monnalisa
+from monnalisa import xyz
+
+
+class FanOut(threading.Thread):
+    """
+    Prints the same file on several printers at once.
+
+    The printers are grouped by 3w format (version, zipped, machine id) and
+    the file is converted once per group. The printers of a group start
+    uploading as soon as their file is ready, each from its own thread, and
+    they all read the same memory mapped 3w file. A 3w file is sent as it
+    is to every printer.
+
+    progress() reports the status of each printer and the overall progress,
+    weighted by the size of the files to upload. callback is called with it
+    every time it changes, from the threads of the printers.
+    """
+
+    def __init__(self, printers, path, workdir=None, callback=None):
+        super().__init__(daemon=True)
+        self.printers = list(printers)
+        self.path = path
+        self.workdir = workdir
+        self.callback = callback
+        self.status = [
+            {'status': 'waiting', 'progress': 0.0, 'size': 0}
+            for printer in self.printers
+        ]
+        self._saved = []
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def printerformat(printer):
+        return (printer.version, printer.zipped, printer.id)
+
+    def progress(self):
+        with self._cond:
+            status = [dict(stat) for stat in self.status]
+        total = sum(stat['size'] for stat in status)
+        done = sum(stat['size'] * stat['progress'] for stat in status)
+        return {
+            'progress': done / total if total else 0.0,
+            'printers': status,
+        }
+
+    def succeeded(self):
+        return all(stat['status'] == 'done' for stat in self.status)
+
+    def run(self):
+        tmpdir = None
+        if self.workdir is None:
+            tmpdir = self.workdir = tempfile.mkdtemp(prefix='monnalisa-')
+        for i, printer in enumerate(self.printers):
+            self._saved.append(printer.__dict__.get('message_callback'))
+            printer.message_callback = self._callback(i, printer)
+        try:
+            self._fanout()
+        finally:
+            for printer, saved in zip(self.printers, self._saved):
+                if saved is None:
+                    del printer.message_callback
+                else:
+                    printer.message_callback = saved
+            if tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _fanout(self):
+        # the format and the status are reported by the printers right
+        # after connecting
+        targets = []
+        for i, printer in enumerate(self.printers):
+            deadline = time.time() + printer.ack_timeout
+            while printer.port and printer.port.is_open:
+                if printer.formatknown() and (printer.isidle() or
+                                              time.time() >= deadline):
+                    break
+                time.sleep(0.05)
+            if not (printer.port and printer.port.is_open):
+                logging.error("Printer %s is not connected", printer.name)
+                self._setstatus(i, 'failed')
+            elif not printer.isidle():
+                logging.error("Printer %s is busy", printer.name)
+                self._setstatus(i, 'failed')
+            else:
+                targets.append(i)
+
+        try:
+            with open(self.path, 'rb') as f:
+                fdata = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as exc:
+            logging.error("Cannot read %s: %s", self.path, exc)
+            for i in targets:
+                self._setstatus(i, 'failed')
+            return
+        with fdata:
+            self._upload(fdata, targets)
+
+        # the uploads that fail before starting do not send any message
+        with self._cond:
+            while any(stat['status'] == 'uploading' for stat in self.status):
+                for i, stat in enumerate(self.status):
+                    if (stat['status'] == 'uploading' and
+                            not self.printers[i].isuploading()):
+                        self._finish(i)
+                self._cond.wait(0.5)
+        self._notify()
+
+    def _upload(self, fdata, targets):
+        digest = None
+        if any(self.printers[i].savetosd for i in targets):
+            digest = xyz.filedigest(self.path)
+
+        if fdata[:12] == b'3DPFNKG13WTW':
+            groups = {None: targets}
+        else:
+            groups = {}
+            for i in targets:
+                fmt = self.printerformat(self.printers[i])
+                groups.setdefault(fmt, []).append(i)
+            logging.info("Printing %s on %d printers, %d formats",
+                         self.path, len(targets), len(groups))
+
+        for fmt, group in groups.items():
+            try:
+                fname = self._convert(fdata, fmt, group)
+                size = os.path.getsize(fname)
+            except (OSError, ValueError) as exc:
+                logging.error("Cannot convert %s: %s", self.path, exc)
+                for i in group:
+                    self._setstatus(i, 'failed')
+                continue
+            for i in group:
+                self._setstatus(i, 'uploading', size=size)
+                self.printers[i].sendFile(fname, digest)
+
+    def _convert(self, fdata, fmt, group):
+        if fmt is None:
+            return self.path
+        version, zipped, machine_id = fmt
+        printers = [self.printers[i] for i in group]
+        for i in group:
+            self._setstatus(i, 'converting')
+        fname = os.path.join(self.workdir, '{}-v{}{}-{}.3w'.format(
+            os.path.splitext(os.path.basename(self.path))[0], version,
+            'z' if zipped else '', machine_id
+        ))
+        # the slowest link decides the compression
+        slowest = min(printers, key=lambda printer: printer.link_speed or 0)
+        logging.info("Converting %s for %s...", self.path, machine_id)
+        xyz.gcode2www(
+            fdata[:].decode(), version, zipped, machine_id,
+            level=slowest.compressionlevel(fdata),
+            minify=all(printer.minify for printer in printers),
+            output=fname + '.tmp'
+        )
+        os.replace(fname + '.tmp', fname)
+        return fname
+
+    def _callback(self, i, printer):
+        saved = printer.message_callback
+
+        def callback(msg):
+            if msg.startswith(b'upload:'):
+                self._onupload(i, msg)
+            saved(msg)
+        return callback
+
+    def _onupload(self, i, msg):
+        try:
+            upload = json.loads(msg[7:])
+        except ValueError:
+            return
+        with self._cond:
+            stat = self.status[i]
+            if stat['status'] != 'uploading':
+                return
+            if upload.get('stat') == 'uploading':
+                stat['progress'] = upload.get('progress', 0) / 100
+            elif upload.get('stat') == 'complete':
+                self._finish(i)
+            self._cond.notify_all()
+        self._notify()
+
+    def _finish(self, i):
+        # called with _cond held, an upload is complete only if its last
+        # block was acknowledged
+        stat = self.status[i]
+        if stat['size'] == 0 or stat['progress'] >= 1:
+            stat['status'] = 'done'
+            stat['progress'] = 1.0
+        else:
+            stat['status'] = 'failed'
+        logging.info("Printer %s: upload %s", self.printers[i].name,
+                     stat['status'])
+
+    def _setstatus(self, i, status, **values):
+        with self._cond:
+            self.status[i]['status'] = status
+            self.status[i].update(values)
+            self._cond.notify_all()
+        self._notify()
+
+    def _notify(self):
+        if self.callback:
+            self.callback(self.progress())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print the same file on several printers at once'
+    )
+    parser.add_argument("file", metavar='FILE', type=str,
+                        help="G-code or 3w file to print.")
+    parser.add_argument("--printer-port", '-p', metavar='PORT', type=str,
+                        action='append', required=True,
+                        help="Serial port of a printer, or host:port of a "
+                        "monnalisa-server. Use it once for each printer.")
+    parser.add_argument("--baud", '-b', metavar='BAUDRATE', type=int,
+                        default=9600, help="Baud rate of the serial "
+                        "connections. The default value is %(default)s.")
+    parser.add_argument("--workdir", metavar='DIR', type=str, default=None,
+                        help="Directory where the converted files are "
+                        "written. A temporary directory is used by default.")
+    parser.add_argument("--capabilities", metavar='FILE', type=str,
+                        default=os.path.join(
+                            os.path.expanduser('~'), '.monnalisa',
+                            'capabilities.json'
+                        ), help="Cache of the printer capabilities. The "
+                        "default value is %(default)s.")
+    parser.add_argument("--sd-card", action='store_true',
+                        help="Save the file on the SD cards of the printers "
+                        "too, and record it in the SD card index.")
+    parser.add_argument("--sd-index", metavar='FILE', type=str,
+                        default=os.path.join(
+                            os.path.expanduser('~'), '.monnalisa',
+                            'sdcard.json'
+                        ), help="Index of the files saved on the SD cards. "
+                        "The default value is %(default)s.")
+    parser.add_argument("--server-extensions", action='store_true',
+                        help="Compress the links to the monnalisa-servers "
+                        "and let them upload the file on their own. Older "
+                        "servers send these requests to the printer as they "
+                        "are, do not use it with them.")
+    parser.add_argument("--version", action='store_true')
+
+    args = parser.parse_args()
+
+    if args.version:
+        print(f"Monnalisa v{monnalisa.__version__}")
+        sys.exit(0)
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    clog = logging.StreamHandler()
+    logger.addHandler(clog)
+    clog.setFormatter(logging.Formatter('%(levelname)s  %(message)s'))
+
+    capabilities = xyz.CapabilityCache(args.capabilities)
+    sdcard = xyz.SDCardIndex(args.sd_index) if args.sd_card else None
+    printers = []
+    ports = []
+    for port in args.printer_port:
+        printer = xyz.XYZPrinter()
+        printer.capabilities = capabilities
+        printer.savetosd = args.sd_card
+        printer.sdcard = sdcard
+        printer.server_extensions = args.server_extensions
+        # the progress is printed by the fan-out
+        printer.message_callback = lambda msg: None
+        if printer.connect(port, args.baud):
+            printers.append(printer)
+            ports.append(port)
+        else:
+            printer.stop()
+    if not printers:
+        logger.error("No printer connected")
+        sys.exit(1)
+
+    last = [0, None]
+    lock = threading.Lock()
+
+    def report(progress, force=False):
+        # called by the threads of all the printers
+        states = [stat['status'] for stat in progress['printers']]
+        with lock:
+            now = time.monotonic()
+            if not force and states == last[1] and now - last[0] < 1:
+                return
+            last[:] = [now, states]
+            print(f"{100 * progress['progress']:5.1f}%  " + "  ".join(
+                f"{port}: {stat['status']} {100 * stat['progress']:.0f}%"
+                for port, stat in zip(ports, progress['printers'])
+            ), flush=True)
+
+    fanout = FanOut(printers, args.file, args.workdir, report)
+    fanout.start()
+    try:
+        fanout.join()
+    except KeyboardInterrupt:
+        pass
+    for printer in printers:
+        printer.stop()
+    report(fanout.progress(), True)
+    sys.exit(0 if fanout.succeeded() else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""
+${LICENSE_HEADER}
+"""
+
+import os
+import json
+import uuid
+import logging
+import threading
+
+from monnalisa import xyz
+
+
+class PrintJob():
+
+    def __init__(self, path, priority=0, job_id=None):
+        self.id = job_id if job_id else uuid.uuid4().hex
+        self.path = path
+        self.priority = priority
+        self.status = 'queued'
+        self.prepared = None
+        self.prepared_for = None
+        # sha256 of the file, its name on the SD card of the printer
+        self.digest = None
+
+    def todict(self):
+        return {
+            'id': self.id,
+            'path': self.path,
+            'priority': self.priority,
+            'status': self.status,
+            'prepared': self.prepared,
+            'prepared_for': self.prepared_for,
+            'digest': self.digest,
+        }
+
+    @classmethod
+    def fromdict(cls, val):
+        job = cls(val['path'], val['priority'], val['id'])
+        job.status = val['status']
+        job.prepared = val['prepared']
+        job.digest = val.get('digest')
+        if val['prepared_for'] is not None:
+            job.prepared_for = tuple(val['prepared_for'])
+        return job
+
+
+class JobQueue(threading.Thread):
+    """
+    Disk-backed queue of print jobs for a single printer.
+
+    The next jobs in the queue are converted to the 3w format of the
+    printer while the current one is printing, so that the upload of the
+    next job can start as soon as the printer becomes idle.
+    """
+
+    STATE_FILE = 'queue.json'
+
+    def __init__(self, printer, path, prefetch=2):
+        super().__init__()
+        self.printer = printer
+        self.path = path
+        self.prefetch = prefetch
+        self.jobs = []
+        self.current = None
+        self._job_started = False
+        self._do_stop = False
+        self._cond = threading.Condition()
+        os.makedirs(path, exist_ok=True)
+        self.load()
+        self.printer.onstatuschange = self.notify
+        self.start()
+
+    def notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def stop(self):
+        self._do_stop = True
+        with self._cond:
+            self._cond.notify_all()
+        self.join()
+
+    def load(self):
+        try:
+            with open(os.path.join(self.path, self.STATE_FILE), 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            logging.error("Cannot load the print queue: %s", exc)
+            return
+
+        for val in state:
+            job = PrintJob.fromdict(val)
+            if job.status == 'printing':
+                # the printer keeps printing the job while the server is
+                # down, there is no way to tell how it ended
+                logging.warning("Job %s was printing when the queue was "
+                                "closed, removing it", job.path)
+                self._removeprepared(job)
+                continue
+            self.jobs.append(job)
+        logging.info("Loaded %d jobs from the print queue", len(self.jobs))
+
+    def save(self):
+        fname = os.path.join(self.path, self.STATE_FILE)
+        state = [job.todict() for job in self.jobs]
+        if self.current is not None:
+            state.insert(0, self.current.todict())
+        try:
+            with open(fname + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(fname + '.tmp', fname)
+        except OSError as exc:
+            logging.error("Cannot save the print queue: %s", exc)
+
+    def list(self):
+        with self._cond:
+            jobs = [job.todict() for job in self.jobs]
+            if self.current is not None:
+                jobs.insert(0, self.current.todict())
+        return jobs
+
+    def add(self, path, priority=0):
+        job = PrintJob(os.path.abspath(path), priority)
+        with self._cond:
+            self._insert(job)
+            self.save()
+            self._cond.notify_all()
+        logging.info("Job %s queued: %s", job.id, path)
+        return job.id
+
+    def cancel(self, job_id):
+        with self._cond:
+            job = self._find(job_id)
+            if job is None:
+                return False
+            self.jobs.remove(job)
+            job.status = 'cancelled'
+            self._removeprepared(job)
+            self.save()
+            self._cond.notify_all()
+        logging.info("Job %s cancelled", job_id)
+        return True
+
+    def move(self, job_id, index):
+        with self._cond:
+            job = self._find(job_id)
+            if job is None:
+                return False
+            self.jobs.remove(job)
+            index = max(0, min(index, len(self.jobs)))
+            self.jobs.insert(index, job)
+            self.save()
+            self._cond.notify_all()
+        return True
+
+    def setpriority(self, job_id, priority):
+        with self._cond:
+            job = self._find(job_id)
+            if job is None:
+                return False
+            self.jobs.remove(job)
+            job.priority = priority
+            self._insert(job)
+            self.save()
+            self._cond.notify_all()
+        return True
+
+    def _find(self, job_id):
+        for job in self.jobs:
+            if job.id == job_id:
+                return job
+        return None
+
+    def _insert(self, job):
+        for i, other in enumerate(self.jobs):
+            if other.priority < job.priority:
+                self.jobs.insert(i, job)
+                return
+        self.jobs.append(job)
+
+    def _removeprepared(self, job):
+        if job.prepared and job.prepared != job.path:
+            try:
+                os.remove(job.prepared)
+            except OSError:
+                pass
+        job.prepared = None
+        job.prepared_for = None
+
+    def _printerformat(self):
+        return (self.printer.version, self.printer.zipped, self.printer.id)
+
+    def _prepare(self, job, fmt):
+        """
+        Convert the job to the given printer format, returns the path of
+        the file to upload.
+        """
+        with open(job.path, 'rb') as f:
+            fdata = f.read()
+        if fdata.startswith(b'3DPFNKG13WTW'):
+            return job.path
+        logging.info("Preparing job %s...", job.path)
+        level = self.printer.compressionlevel(fdata)
+        fname = os.path.join(self.path, f'{job.id}.3w')
+        xyz.gcode2www(
+            fdata.decode(), *fmt, level=level, minify=self.printer.minify,
+            output=fname + '.tmp'
+        )
+        os.replace(fname + '.tmp', fname)
+        return fname
+
+    def _prepareahead(self):
+        fmt = self._printerformat()
+        with self._cond:
+            todo = [
+                job for job in self.jobs[:self.prefetch]
+                if job.prepared_for != fmt
+            ]
+        for job in todo:
+            if self._do_stop:
+                return
+            try:
+                if self.printer.savetosd and job.digest is None:
+                    job.digest = xyz.filedigest(job.path)
+                prepared = self._prepare(job, fmt)
+            except (OSError, ValueError) as exc:
+                logging.error("Cannot prepare job %s: %s", job.path, exc)
+                with self._cond:
+                    if job in self.jobs:
+                        self.jobs.remove(job)
+                        job.status = 'failed'
+                        self.save()
+                continue
+            with self._cond:
+                if job.prepared != prepared:
+                    self._removeprepared(job)
+                job.prepared = prepared
+                if job not in self.jobs:
+                    # cancelled in the meantime
+                    self._removeprepared(job)
+                    continue
+                job.prepared_for = fmt
+                job.status = 'ready'
+                self.save()
+
+    def _dispatch(self):
+        with self._cond:
+            if self.current is not None:
+                status = self.printer.getprintstatus()
+                if status != 'ready':
+                    # an uploaded file falls back to ready if it does not
+                    # start printing
+                    if status != 'uploaded':
+                        self._job_started = True
+                    return
+                if not self.printer.isidle():
+                    return
+                job = self.current
+                job.status = 'done' if self._job_started else 'failed'
+                logging.info("Job %s %s", job.path, job.status)
+                self._removeprepared(job)
+                self.current = None
+                self.save()
+
+            if not self.jobs or not self.printer.isidle():
+                return
+            job = self.jobs[0]
+            if job.prepared_for != self._printerformat():
+                return
+            self.jobs.pop(0)
+            job.status = 'printing'
+            self.current = job
+            self._job_started = False
+            self.save()
+        logging.info("Starting job %s", job.path)
+        self.printer.sendFile(job.prepared, job.digest)
+
+    def run(self):
+        while not self._do_stop:
+            if self.printer.port and self.printer.port.is_open:
+                self._prepareahead()
+                self._dispatch()
+            with self._cond:
+                if not self._do_stop:
+                    self._cond.wait(1)
+        self.save()
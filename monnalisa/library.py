@@ -0,0 +1,220 @@
+"""
+${LICENSE_HEADER}
+"""
+
+import os
+import re
+import time
+import sqlite3
+import logging
+import threading
+
+from monnalisa import xyz
+
+
+LIBRARY_EXTENSIONS = ('.gcode', '.gco', '.g', '.3w')
+
+# only the beginning of the files is read, slicers write their statistics
+# at the top and the 3w header ends at the start of the body
+HEADER_SIZE = 0x4000
+
+METADATA_KEYS = ('machine', 'print_time', 'total_layers', 'total_filament')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    format TEXT,
+    machine TEXT,
+    print_time REAL,
+    total_layers INTEGER,
+    total_filament REAL
+);
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE TABLE IF NOT EXISTS roots (
+    path TEXT PRIMARY KEY
+);
+"""
+
+
+def _number(val, cast=float):
+    # values like '2.5m' or '1234.0'
+    match = re.match(r'\s*([-+]?\d+(\.\d*)?)', str(val))
+    if match is None:
+        return None
+    return cast(float(match[1]))
+
+
+def gcodemetadata(text):
+    """
+    Read the header keys used by gcode2www from the beginning of a G-code
+    """
+    values = {}
+    for key, name in xyz.XYZ_HEADER_KEYS.items():
+        if name is None:
+            continue
+        match = re.search(rf'^;{key}:(.*)$', text, re.MULTILINE)
+        if match:
+            values[name] = match[1].strip()
+    for match in re.finditer(r'^; ?(\w+) ?= ?(.*)$', text, re.MULTILINE):
+        if match[1] in METADATA_KEYS:
+            values[match[1]] = match[2].strip()
+    return values
+
+
+def readmetadata(path, size=HEADER_SIZE):
+    """
+    Returns the file format ('3w' or 'gcode') and the metadata of a file,
+    reading only its first size bytes
+    """
+    with open(path, 'rb') as f:
+        data = f.read(size)
+    if data.startswith(b'3DPFNKG13WTW'):
+        fmt = '3w'
+        values = xyz.readwwwheader(data)
+    else:
+        fmt = 'gcode'
+        values = gcodemetadata(data.decode(errors='replace'))
+    return fmt, {
+        'machine': values.get('machine'),
+        'print_time': _number(values.get('print_time')),
+        'total_layers': _number(values.get('total_layers'), int),
+        'total_filament': _number(values.get('total_filament')),
+    }
+
+
+class Library():
+    """
+    SQLite index of the G-code and 3w files found in a set of directories.
+
+    Files are identified by path, size and modification time, so a rescan
+    reads only the files added or changed since the previous one.
+    """
+
+    COLUMNS = ('path', 'name', 'mtime', 'size', 'format') + METADATA_KEYS
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        # held by scan() from start to end, close() waits for it
+        self._scanning = threading.Lock()
+        self._closing = threading.Event()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self.db:
+            self.db.executescript(SCHEMA)
+
+    def close(self):
+        """
+        Stop the scan in progress, if any, and close the index
+        """
+        self._closing.set()
+        with self._scanning, self._lock:
+            self.db.close()
+
+    def roots(self):
+        with self._lock:
+            rows = self.db.execute("SELECT path FROM roots").fetchall()
+        return [row[0] for row in rows]
+
+    def addroot(self, path):
+        with self._lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO roots VALUES (?)",
+                            (os.path.abspath(path),))
+
+    def removeroot(self, path):
+        path = os.path.abspath(path)
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM roots WHERE path = ?", (path,))
+            self.db.execute("DELETE FROM files WHERE path >= ? AND path < ?",
+                            self._subtree(path))
+
+    def scan(self, roots=None):
+        """
+        Update the index with the files in roots (all the roots of the
+        library by default), returns the number of files indexed, unchanged
+        and removed
+        """
+        with self._scanning:
+            if self._closing.is_set():
+                return 0, 0, 0
+            return self._scan(roots)
+
+    def _scan(self, roots):
+        if roots is None:
+            roots = self.roots()
+        stme = time.perf_counter()
+        indexed = unchanged = removed = 0
+        for root in roots:
+            root = os.path.abspath(root)
+            with self._lock:
+                known = {
+                    row[0]: (row[1], row[2]) for row in self.db.execute(
+                        "SELECT path, mtime, size FROM files "
+                        "WHERE path >= ? AND path < ?", self._subtree(root)
+                    )
+                }
+            rows = []
+            for dirpath, dirs, files in os.walk(root):
+                if self._closing.is_set():
+                    logging.info("Library scan interrupted")
+                    return indexed, unchanged, removed
+                for fname in files:
+                    if not fname.lower().endswith(LIBRARY_EXTENSIONS):
+                        continue
+                    path = os.path.join(dirpath, fname)
+                    try:
+                        stat = os.stat(path)
+                        if known.pop(path, None) == (stat.st_mtime,
+                                                     stat.st_size):
+                            unchanged += 1
+                            continue
+                        fmt, values = readmetadata(path)
+                    except (OSError, ValueError) as exc:
+                        logging.warning("Cannot index %s: %s", path, exc)
+                        continue
+                    rows.append((
+                        path, fname, stat.st_mtime, stat.st_size, fmt
+                    ) + tuple(values[key] for key in METADATA_KEYS))
+            with self._lock, self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO files VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+                )
+                self.db.executemany("DELETE FROM files WHERE path = ?",
+                                    [(path,) for path in known])
+            indexed += len(rows)
+            removed += len(known)
+        logging.info("Library scanned in %.2f s: %d indexed, %d unchanged, "
+                     "%d removed", time.perf_counter() - stme, indexed,
+                     unchanged, removed)
+        return indexed, unchanged, removed
+
+    def search(self, text='', machine=None, limit=200):
+        """
+        Files whose name contains text, most recent first, as a list of
+        dicts
+        """
+        query = "SELECT * FROM files WHERE name LIKE ? ESCAPE '\\'"
+        args = ['%' + self._escape(text) + '%']
+        if machine:
+            query += " AND machine = ?"
+            args.append(machine)
+        query += " ORDER BY mtime DESC LIMIT ?"
+        args.append(limit)
+        with self._lock:
+            rows = self.db.execute(query, args).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    @staticmethod
+    def _escape(text):
+        return re.sub(r'([\\%_])', r'\\\1', text)
+
+    @staticmethod
+    def _subtree(root):
+        # bounds of the paths under root, compared byte by byte unlike LIKE
+        # that ignores the case: the separator is followed by the next char
+        prefix = os.path.join(root, '')
+        return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
@@ -0,0 +1,490 @@
+#!/usr/bin/env python
+
+"""
+${LICENSE_HEADER}
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import selectors
+import tempfile
+import threading
+import subprocess
+
+import monnalisa
+from monnalisa import xyz
+
+
+# commands whose replies start with the same prefix, so that their latency
+# can be measured
+DEFAULT_COMMANDS = (
+    b'queue:{"cmd": "list"}',
+    b'telemetry:{"channels": ["temp1"], "since": 0}',
+)
+
+
+def percentile(values, perc):
+    """
+    Nearest rank percentile of a sorted list, None if it is empty
+    """
+    if not values:
+        return None
+    rank = int(round(perc / 100 * (len(values) - 1)))
+    return values[rank]
+
+
+def cputime(pid):
+    """
+    CPU seconds (user + system) used so far by the process pid, None if it
+    cannot be read (only Linux is supported)
+    """
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # the process name can contain spaces, the fields start after it
+    fields = stat[stat.rfind(b')')+2:].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class StandInPrinter(threading.Thread):
+    """
+    Local stand-in for a printer, reachable by monnalisa-server as a
+    host:port printer port.
+
+    It answers the status queries with a fixed status and acknowledges
+    everything else, optionally it also sends status_rate temperature
+    messages per second on its own, to load the server with status traffic.
+    """
+
+    STATUS = (
+        b'j:9511,0\n'
+        b'd:0,0,0\n'
+        b't:1,24,0\n'
+        b'f:1,150000\n'
+        b'p:daVinciF10\n'
+    )
+
+    def __init__(self, status_rate=0):
+        super().__init__(daemon=True)
+        self.status_rate = status_rate
+        self.srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.srv.bind(('127.0.0.1', 0))
+        self.srv.listen(1)
+        self.url = '127.0.0.1:%d' % self.srv.getsockname()[1]
+        self._do_stop = False
+        self.start()
+
+    def stop(self):
+        self._do_stop = True
+        self.srv.close()
+
+    def run(self):
+        while not self._do_stop:
+            try:
+                conn, addr = self.srv.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(conn,),
+                             daemon=True).start()
+
+    def serve(self, conn):
+        codec = xyz.MessageCodec()
+        rawbuff = b''
+        conn.settimeout(1 / self.status_rate if self.status_rate else 1)
+        next_status = time.monotonic()
+        try:
+            while not self._do_stop:
+                if self.status_rate and time.monotonic() >= next_status:
+                    next_status += 1 / self.status_rate
+                    codec.send(conn, b't:1,%.1f,210\n' % (
+                        200 + time.monotonic() % 10
+                    ))
+                try:
+                    data = conn.recv(65536)
+                except socket.timeout:
+                    continue
+                if not data:
+                    return
+                messages, rawbuff = codec.decode(rawbuff + data)
+                for message in messages:
+                    if message.startswith(b'hello:'):
+                        codec.send(conn, b'hello:{"compress":"deflate"}')
+                        codec.compress = (
+                            json.loads(message[6:]).get('compress') ==
+                            'deflate'
+                        )
+                    elif message.startswith(b'XYZv3/query='):
+                        codec.send(conn, self.STATUS)
+                    else:
+                        codec.send(conn, b'ok\n')
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+
+class Client():
+    """
+    A synthetic client speaking the same protocol as MainWindow: it sends
+    commands at a fixed rate, consumes everything the server sends and
+    acknowledges the images.
+    """
+
+    def __init__(self, name, addr, commands, rate, compress=True):
+        self.name = name
+        self.addr = addr
+        self.commands = commands
+        self.interval = 1 / rate if rate else None
+        self.compress = compress
+        self.sock = None
+        self.codec = xyz.MessageCodec()
+        self._rawbuff = b''
+        self._buffer = b''
+        self._index = 0
+        self.next_send = None
+        # send times of the commands waiting for a reply, by reply prefix
+        self._pending = {}
+        self.latencies = []
+        self.sent = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.images = 0
+        self.served = False
+        self.error = None
+
+    def connect(self, timeout):
+        try:
+            self.sock = socket.create_connection(self.addr, timeout)
+        except OSError as exc:
+            self.error = str(exc)
+            return False
+        self.sock.settimeout(timeout)
+        if self.compress:
+            self.send(b'hello:{"compress":"deflate"}')
+        self.next_send = time.monotonic()
+        return True
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, data):
+        try:
+            self.sock.sendall(self.codec.encode(data))
+        except OSError as exc:
+            self.error = str(exc)
+            self.close()
+
+    def sendnext(self, now):
+        """
+        Send the next command if it is due
+        """
+        if self.interval is None or now < self.next_send:
+            return
+        self.next_send += self.interval
+        command = self.commands[self._index % len(self.commands)]
+        self._index += 1
+        prefix = command[:command.find(b':')+1]
+        if prefix:
+            self._pending.setdefault(prefix, []).append(now)
+        self.sent += 1
+        self.send(command)
+
+    def onreadable(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.timeout:
+            return
+        except OSError as exc:
+            self.error = str(exc)
+            self.close()
+            return
+        if not data:
+            self.error = "connection closed by the server"
+            self.close()
+            return
+        now = time.monotonic()
+        self.received_bytes += len(data)
+        messages, self._rawbuff = self.codec.decode(self._rawbuff + data)
+        for message in messages:
+            self.served = True
+            if message.startswith(b'hello:'):
+                hello = json.loads(message[6:])
+                self.codec.compress = hello.get('compress') == 'deflate'
+                continue
+            # the server sends status lines glued together
+            self._buffer += message
+            *lines, self._buffer = self._buffer.split(b'\n')
+            for line in lines:
+                self.onmessage(line, now)
+
+    def onmessage(self, msg, now):
+        self.received += 1
+        if msg.startswith(b'image:'):
+            # MainWindow acknowledges every part of an image
+            self.images += 1
+            self.send(b'ok:image\n')
+            return
+        prefix = msg[:msg.find(b':')+1]
+        pending = self._pending.get(prefix)
+        if pending:
+            self.latencies.append(now - pending.pop(0))
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        return {
+            'name': self.name,
+            'served': self.served,
+            'error': self.error,
+            'sent': self.sent,
+            'received': self.received,
+            'bytes': self.received_bytes,
+            'images': self.images,
+            'unanswered': sum(len(v) for v in self._pending.values()),
+            'latency': {
+                f'p{perc}': percentile(latencies, perc)
+                for perc in (50, 90, 99, 100)
+            },
+        }
+
+
+def loadtest(addr, clients=10, rate=1.0, duration=30.0,
+             commands=DEFAULT_COMMANDS, compress=True, pid=None,
+             timeout=5.0):
+    """
+    Run clients synthetic clients against the server at addr for duration
+    seconds, returns a dict of statistics. If pid is given the CPU time used
+    by that process is measured too.
+    """
+    selector = selectors.DefaultSelector()
+    pool = [
+        Client(f'client{i}', addr, commands, rate, compress)
+        for i in range(clients)
+    ]
+    for client in pool:
+        if client.connect(timeout):
+            selector.register(client.sock, selectors.EVENT_READ, client)
+
+    cpu_start = cputime(pid) if pid else None
+    stme = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if now - stme >= duration:
+            break
+        for client in pool:
+            if client.sock:
+                client.sendnext(now)
+        due = [c.next_send for c in pool if c.sock and c.interval]
+        wait = min(due + [stme + duration]) - time.monotonic()
+        for key, events in selector.select(max(0, wait)):
+            client = key.data
+            client.onreadable()
+            if client.sock is None:
+                selector.unregister(key.fileobj)
+    elapsed = time.monotonic() - stme
+    cpu_end = cputime(pid) if pid else None
+
+    for client in pool:
+        client.close()
+    selector.close()
+
+    reports = [client.report() for client in pool]
+    latencies = sorted(val for client in pool for val in client.latencies)
+    return {
+        'elapsed': elapsed,
+        'clients': reports,
+        'served': sum(1 for rep in reports if rep['served']),
+        'messages': sum(rep['received'] for rep in reports),
+        'bytes': sum(rep['bytes'] for rep in reports),
+        'sent': sum(rep['sent'] for rep in reports),
+        'latency': {
+            f'p{perc}': percentile(latencies, perc)
+            for perc in (50, 90, 99, 100)
+        },
+        'cpu': (
+            None if cpu_start is None or cpu_end is None
+            else (cpu_end - cpu_start) / elapsed
+        ),
+    }
+
+
+def startserver(printer_port, workdir, log):
+    """
+    Start a monnalisa-server on a free local port, returns the process and
+    its address. Everything it writes stays in workdir, its output goes to
+    log.
+    """
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    proc = subprocess.Popen([
+        sys.executable, '-m', 'monnalisa.server', '--addr', '127.0.0.1',
+        '--server-port', str(port), '--printer-port', printer_port,
+        '--queue-dir', os.path.join(workdir, 'queue'),
+        '--store-dir', os.path.join(workdir, 'files'),
+        '--library-index', os.path.join(workdir, 'library.sqlite'),
+        '--capabilities', os.path.join(workdir, 'capabilities.json'),
+        '--log', os.path.join(workdir, 'server.log'),
+    ], stdout=log, stderr=subprocess.STDOUT)
+    return proc, ('127.0.0.1', port)
+
+
+def waitserver(proc, addr, timeout):
+    """
+    Wait until the server accepts connections, False if it exited
+    """
+    stme = time.monotonic()
+    while time.monotonic() - stme < timeout:
+        if proc.poll() is not None:
+            return False
+        try:
+            # the server serves one client at a time, close it right away
+            socket.create_connection(addr, 1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def _ms(val):
+    return '-' if val is None else f'{val * 1000:.1f}'
+
+
+def printreport(stats):
+    print(f"{'client':<10} {'sent':>6} {'recv':>7} {'kB':>8} {'images':>6} "
+          f"{'p50':>7} {'p90':>7} {'p99':>7} {'max':>7}")
+    for rep in stats['clients']:
+        lat = rep['latency']
+        line = (f"{rep['name']:<10} {rep['sent']:>6} {rep['received']:>7} "
+                f"{rep['bytes'] / 1000:>8.1f} {rep['images']:>6} "
+                f"{_ms(lat['p50']):>7} {_ms(lat['p90']):>7} "
+                f"{_ms(lat['p99']):>7} {_ms(lat['p100']):>7}")
+        if not rep['served']:
+            line += "  not served"
+        if rep['error']:
+            line += f"  {rep['error']}"
+        print(line)
+    elapsed = stats['elapsed']
+    lat = stats['latency']
+    print(f"\n{stats['served']}/{len(stats['clients'])} clients served in "
+          f"{elapsed:.1f} s")
+    print(f"{stats['sent'] / elapsed:.1f} commands/s sent, "
+          f"{stats['messages'] / elapsed:.1f} messages/s and "
+          f"{stats['bytes'] / elapsed / 1000:.1f} kB/s received")
+    print(f"latency (ms): p50 {_ms(lat['p50'])}, p90 {_ms(lat['p90'])}, "
+          f"p99 {_ms(lat['p99'])}, max {_ms(lat['p100'])}")
+    if stats['cpu'] is not None:
+        print(f"server CPU: {stats['cpu'] * 100:.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test a monnalisa-server with synthetic clients'
+    )
+    parser.add_argument("--server", metavar='HOST:PORT', type=str,
+                        default=None, help="Address of a running server. If "
+                        "not specified a server is started on a local port, "
+                        "connected to --printer-port.")
+    parser.add_argument("--server-pid", metavar='PID', type=int,
+                        default=None, help="Process id of the server given "
+                        "with --server, to measure its CPU usage.")
+    parser.add_argument("--printer-port", '-p', metavar='PORT', type=str,
+                        default=None, help="The port of the printer used by "
+                        "the server that is started. If not specified a "
+                        "local stand-in printer is used.")
+    parser.add_argument("--status-rate", metavar='N', type=float, default=0,
+                        help="Status messages per second sent by the stand-in "
+                        "printer on its own. The default value is "
+                        "%(default)s.")
+    parser.add_argument("--clients", '-n', metavar='N', type=int, default=10,
+                        help="Number of clients. The default value is "
+                        "%(default)s.")
+    parser.add_argument("--rate", '-r', metavar='N', type=float, default=1,
+                        help="Commands per second sent by each client. The "
+                        "default value is %(default)s.")
+    parser.add_argument("--duration", '-d', metavar='SECONDS', type=float,
+                        default=30, help="Duration of the test. The default "
+                        "value is %(default)s.")
+    parser.add_argument("--command", '-c', metavar='MSG', type=str,
+                        action='append', default=None, help="Command sent by "
+                        "the clients in turn, can be used more than once. The "
+                        "latency is measured for the commands answered with "
+                        "the same prefix, like queue: and telemetry:. The "
+                        "default commands list the print queue and query the "
+                        "telemetry.")
+    parser.add_argument("--no-compression", action='store_true',
+                        help="Do not ask the server to compress the messages.")
+    parser.add_argument("--json", action='store_true',
+                        help="Print the statistics as JSON.")
+    parser.add_argument("--version", action='store_true')
+
+    args = parser.parse_args()
+
+    if args.version:
+        print(f"Monnalisa v{monnalisa.__version__}")
+        sys.exit(0)
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    clog = logging.StreamHandler()
+    logger.addHandler(clog)
+    clog.setFormatter(logging.Formatter('%(levelname)s  %(message)s'))
+
+    if args.command:
+        commands = [cmd.encode() for cmd in args.command]
+    else:
+        commands = list(DEFAULT_COMMANDS)
+
+    stand_in = None
+    proc = None
+    workdir = tempfile.TemporaryDirectory(prefix='monnalisa-loadtest-')
+    try:
+        if args.server:
+            host, _, port = args.server.rpartition(':')
+            addr = (host or 'localhost', int(port))
+            pid = args.server_pid
+        else:
+            printer_port = args.printer_port
+            if printer_port is None:
+                stand_in = StandInPrinter(args.status_rate)
+                printer_port = stand_in.url
+            log_path = os.path.join(workdir.name, 'output.log')
+            with open(log_path, 'wb') as log:
+                proc, addr = startserver(printer_port, workdir.name, log)
+            logger.info("Started a server on %s:%d", *addr)
+            if not waitserver(proc, addr, 15):
+                with open(log_path, 'rb') as log:
+                    sys.stderr.write(log.read().decode(errors='replace'))
+                logger.error("The server did not start")
+                sys.exit(1)
+            pid = proc.pid
+
+        logger.info("Running %d clients for %.0f s", args.clients,
+                    args.duration)
+        stats = loadtest(addr, args.clients, args.rate, args.duration,
+                         commands, not args.no_compression, pid)
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+        if stand_in:
+            stand_in.stop()
+        workdir.cleanup()
+
+    if args.json:
+        print(json.dumps(stats, indent=2))
+    else:
+        printreport(stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,11 +8,21 @@ import logging
 import io
 import base64
 import zlib
+import time
+import threading
 
 from PyQt5 import QtWidgets, uic
-from PyQt5.QtCore import pyqtSignal
-from PyQt5.QtGui import QPixmap
-from . import xyz
+from PyQt5.QtCore import (pyqtSignal, pyqtSlot, Qt, QTimer, QPointF,
+                          QObject, QThread)
+from PyQt5.QtGui import (QPixmap, QPainter, QPen, QColor, QPolygonF,
+                         QPainterPath)
+from . import xyz, library
+
+try:
+    from . import toolpath
+except ImportError:
+    # numpy is optional, there is no preview without it
+    toolpath = None
 
 
 ACTION_MSG_DICT = {
@@ -25,11 +35,402 @@ ACTION_MSG_DICT = {
 }
 
 
+class PrinterWorker(QObject):
+    """
+    Runs the printer calls that may block, like opening the connection or
+    writing to the port, in its own thread. Results are sent back to the
+    GUI through signals.
+    """
+    connected = pyqtSignal(bool, str)
+    _request = pyqtSignal(object, tuple)
+
+    def __init__(self, printer):
+        super().__init__()
+        self.printer = printer
+        self._thread = QThread()
+        self.moveToThread(self._thread)
+        self._request.connect(self._execute)
+        self._thread.start()
+
+    def stop(self):
+        self._thread.quit()
+        self._thread.wait()
+
+    def call(self, func, *args):
+        """
+        Execute func(*args) in the worker thread
+        """
+        self._request.emit(func, args)
+
+    def connectprinter(self, port, baud):
+        self.call(self._connect, port, baud)
+
+    def _connect(self, port, baud):
+        self.connected.emit(self.printer.connect(port, baud, timeout=3), port)
+
+    @pyqtSlot(object, tuple)
+    def _execute(self, func, args):
+        try:
+            func(*args)
+        except Exception:
+            # an exception escaping from a slot aborts the application
+            logging.exception("Printer command failed")
+
+
+class TelemetryChart(QtWidgets.QWidget):
+    """
+    Chart of the extruder temperatures and of the print progress, use the
+    mouse wheel to change the time span
+    """
+
+    # minimum time between two redraws, in milliseconds
+    REFRESH_INTERVAL = 1000
+    SERIES = (
+        ('temp1', '#FF4F00', Qt.SolidLine),
+        ('target1', '#FF4F00', Qt.DashLine),
+        ('temp2', '#4682B4', Qt.SolidLine),
+        ('target2', '#4682B4', Qt.DashLine),
+        ('progress', '#006A4E', Qt.SolidLine),
+    )
+    MIN_SPAN = 600
+    MAX_SPAN = 48 * 3600
+
+    def __init__(self, telemetry, parent=None):
+        super().__init__(parent)
+        self.telemetry = telemetry
+        self.span = 3600
+        self._revision = None
+        self.setMinimumHeight(120)
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self.refresh)
+        self._timer.start(self.REFRESH_INTERVAL)
+
+    def refresh(self):
+        # new samples arrive every few seconds, repaint only once per
+        # interval and only if something changed
+        if self.isVisible() and self._revision != self.telemetry.revision:
+            self._revision = self.telemetry.revision
+            self.update()
+
+    def wheelEvent(self, event):
+        if event.angleDelta().y() > 0:
+            self.span = max(self.MIN_SPAN, self.span // 2)
+        else:
+            self.span = min(self.MAX_SPAN, self.span * 2)
+        self.update()
+
+    def paintEvent(self, event):
+        now = time.time()
+        since = now - self.span
+        series = [
+            (self.telemetry.history(name, since), color, style, name)
+            for name, color, style in self.SERIES
+        ]
+        temps = [
+            row[2] for rows, _, _, name in series
+            if name != 'progress' for row in rows
+        ]
+        # temperature scale rounded up to 50 degrees
+        t_max = max([50] + [50 * (int(val) // 50 + 1) for val in temps])
+
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.fillRect(self.rect(), self.palette().base())
+        area = self.rect().adjusted(40, 5, -40, -20)
+        painter.setPen(self.palette().mid().color())
+        painter.drawRect(area)
+        painter.setPen(self.palette().text().color())
+        painter.drawText(2, area.top() + 10, f"{t_max}°C")
+        painter.drawText(2, area.bottom(), "0°C")
+        painter.drawText(area.right() + 4, area.top() + 10, "100%")
+        painter.drawText(area.right() + 4, area.bottom(), "0%")
+        painter.drawText(area.left(), self.height() - 4,
+                         f"last {self.span // 60} minutes")
+
+        for rows, color, style, name in series:
+            if not rows:
+                continue
+            v_max = 100 if name == 'progress' else t_max
+            points = QPolygonF([
+                QPointF(
+                    area.left() + area.width() * (row[0] - since) / self.span,
+                    area.bottom() - area.height() * row[3] / v_max
+                ) for row in rows
+            ])
+            pen = QPen(QColor(color))
+            pen.setStyle(style)
+            painter.setPen(pen)
+            painter.drawPolyline(points)
+        painter.end()
+
+
+class LibraryDialog(QtWidgets.QDialog):
+    """
+    Choose a file to print from the print library
+    """
+    COLUMNS = (
+        ('name', 'Name'),
+        ('machine', 'Machine'),
+        ('print_time', 'Time'),
+        ('total_layers', 'Layers'),
+        ('total_filament', 'Filament (m)'),
+    )
+    scanned = pyqtSignal()
+
+    def __init__(self, lib, parent=None):
+        super().__init__(parent)
+        self.setAttribute(Qt.WA_DeleteOnClose)
+        self.library = lib
+        self.path = None
+        self.files = []
+        self.setWindowTitle("Print library")
+        self.resize(640, 400)
+
+        self.lineEditSearch = QtWidgets.QLineEdit()
+        self.lineEditSearch.setPlaceholderText("Search")
+        self.tableFiles = QtWidgets.QTableWidget(0, len(self.COLUMNS))
+        self.tableFiles.setHorizontalHeaderLabels(
+            [label for key, label in self.COLUMNS]
+        )
+        self.tableFiles.setSelectionBehavior(
+            QtWidgets.QAbstractItemView.SelectRows
+        )
+        self.tableFiles.setEditTriggers(
+            QtWidgets.QAbstractItemView.NoEditTriggers
+        )
+        self.tableFiles.horizontalHeader().setStretchLastSection(True)
+        pushButtonAdd = QtWidgets.QPushButton("Add folder...")
+        pushButtonBrowse = QtWidgets.QPushButton("Browse...")
+        pushButtonPrint = QtWidgets.QPushButton("Print")
+
+        buttons = QtWidgets.QHBoxLayout()
+        buttons.addWidget(pushButtonAdd)
+        buttons.addWidget(pushButtonBrowse)
+        buttons.addStretch()
+        buttons.addWidget(pushButtonPrint)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.lineEditSearch)
+        layout.addWidget(self.tableFiles)
+        layout.addLayout(buttons)
+
+        self.lineEditSearch.textChanged.connect(self.refresh)
+        self.tableFiles.cellDoubleClicked.connect(self.choose)
+        pushButtonAdd.clicked.connect(self.addfolder)
+        pushButtonBrowse.clicked.connect(self.browse)
+        pushButtonPrint.clicked.connect(
+            lambda: self.choose(self.tableFiles.currentRow())
+        )
+        self.scanned.connect(self.refresh)
+        self.refresh()
+        # show the index right away, then pick up the files changed since
+        # the last scan
+        self.rescan()
+
+    def rescan(self):
+        threading.Thread(target=self._scan, daemon=True).start()
+
+    def _scan(self):
+        self.library.scan()
+        try:
+            self.scanned.emit()
+        except RuntimeError:
+            # the dialog has been closed in the meantime
+            pass
+
+    def refresh(self):
+        self.files = self.library.search(self.lineEditSearch.text())
+        self.tableFiles.setRowCount(len(self.files))
+        for row, info in enumerate(self.files):
+            for col, (key, label) in enumerate(self.COLUMNS):
+                val = info[key]
+                if val is None:
+                    val = ''
+                elif key == 'print_time':
+                    val = f"{int(val) // 3600}h {int(val) // 60 % 60:02d}m"
+                item = QtWidgets.QTableWidgetItem(str(val))
+                item.setToolTip(info['path'])
+                self.tableFiles.setItem(row, col, item)
+
+    def choose(self, row):
+        if 0 <= row < len(self.files):
+            self.path = self.files[row]['path']
+            self.accept()
+
+    def addfolder(self):
+        path = QtWidgets.QFileDialog.getExistingDirectory(self)
+        if path:
+            self.library.addroot(path)
+            self.rescan()
+
+    def browse(self):
+        url, ext = QtWidgets.QFileDialog.getOpenFileName(self)
+        if url:
+            self.path = url
+            self.accept()
+
+
+class ToolpathView(QtWidgets.QWidget):
+    """
+    Top view of a Toolpath: the selected layer and, fainter, the few
+    layers below it. Each layer is decimated to about one point per pixel
+    and its path is cached.
+    """
+    layerschanged = pyqtSignal(int)
+
+    # minimum time between two redraws while loading, in milliseconds
+    REFRESH_INTERVAL = 200
+    # layers drawn below the selected one
+    DEPTH = 3
+    LAYER_COLOR = '#FF4F00'
+    BELOW_COLOR = '#C0C0C0'
+
+    def __init__(self, tpath, parent=None):
+        super().__init__(parent)
+        self.toolpath = tpath
+        self.layers = []
+        self.index = 0
+        self._revision = None
+        self._paths = {}
+        self.setMinimumSize(320, 320)
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self.refresh)
+        self._timer.start(self.REFRESH_INTERVAL)
+
+    def refresh(self):
+        if self._revision == self.toolpath.revision:
+            return
+        self._revision = self.toolpath.revision
+        self.layers = self.toolpath.layers()
+        self.layerschanged.emit(len(self.layers))
+        if self.toolpath.done:
+            self._timer.stop()
+        self.update()
+
+    def setindex(self, index):
+        self.index = index
+        self.update()
+
+    def painterpath(self, z, cell):
+        points, starts, level = self.toolpath.path(z, cell)
+        cached = self._paths.get((z, level))
+        if cached and cached[0] is points:
+            return cached[1]
+        path = QPainterPath()
+        firsts = starts.nonzero()[0].tolist() + [len(points)]
+        coords = points.tolist()
+        for begin, end in zip(firsts[:-1], firsts[1:]):
+            path.addPolygon(QPolygonF([
+                QPointF(x, y) for x, y in coords[begin:end]
+            ]))
+        self._paths[(z, level)] = (points, path)
+        return path
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), self.palette().base())
+        bounds = self.toolpath.bounds
+        if bounds is None or not self.layers:
+            painter.setPen(self.palette().text().color())
+            painter.drawText(self.rect(), Qt.AlignCenter, "Loading...")
+            painter.end()
+            return
+
+        x_min, y_min, x_max, y_max = bounds
+        area = self.rect().adjusted(10, 10, -10, -10)
+        scale = min(area.width() / max(x_max - x_min, 1),
+                    area.height() / max(y_max - y_min, 1))
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.translate(area.center())
+        # millimeters, with the Y axis going up
+        painter.scale(scale, -scale)
+        painter.translate(-(x_min + x_max) / 2, -(y_min + y_max) / 2)
+
+        index = min(self.index, len(self.layers) - 1)
+        for i in range(max(0, index - self.DEPTH), index + 1):
+            pen = QPen(QColor(
+                self.LAYER_COLOR if i == index else self.BELOW_COLOR
+            ))
+            pen.setCosmetic(True)
+            painter.setPen(pen)
+            painter.drawPath(self.painterpath(self.layers[i], 1 / scale))
+        painter.end()
+
+
+class PreviewDialog(QtWidgets.QDialog):
+    """
+    Toolpath preview of a G-code file, accepted to print it
+    """
+
+    def __init__(self, path, parent=None):
+        super().__init__(parent)
+        # freed when closed, not when the main window is
+        self.setAttribute(Qt.WA_DeleteOnClose)
+        self.setWindowTitle(f"Preview of {os.path.basename(path)}")
+        self.resize(640, 640)
+        self.toolpath = toolpath.Toolpath()
+        self.view = ToolpathView(self.toolpath)
+        self.sliderLayer = QtWidgets.QSlider(Qt.Vertical)
+        self.sliderLayer.setRange(0, 0)
+        self.labelLayer = QtWidgets.QLabel()
+        pushButtonCancel = QtWidgets.QPushButton("Cancel")
+        pushButtonPrint = QtWidgets.QPushButton("Print")
+
+        view = QtWidgets.QHBoxLayout()
+        view.addWidget(self.view, 1)
+        view.addWidget(self.sliderLayer)
+        buttons = QtWidgets.QHBoxLayout()
+        buttons.addWidget(self.labelLayer)
+        buttons.addStretch()
+        buttons.addWidget(pushButtonCancel)
+        buttons.addWidget(pushButtonPrint)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addLayout(view)
+        layout.addLayout(buttons)
+
+        self.view.layerschanged.connect(self.setlayers)
+        self.sliderLayer.valueChanged.connect(self.showlayer)
+        pushButtonCancel.clicked.connect(self.reject)
+        pushButtonPrint.clicked.connect(self.accept)
+        threading.Thread(target=self._load, args=(path,), daemon=True).start()
+
+    def _load(self, path):
+        try:
+            self.toolpath.load(path)
+        except (OSError, ValueError) as exc:
+            logging.error("Cannot preview %s: %s", path, exc)
+        except Exception:
+            logging.exception("Cannot preview %s", path)
+
+    def done(self, result):
+        self.toolpath.stop()
+        super().done(result)
+
+    def setlayers(self, count):
+        # keep showing the top layer while the file is loading
+        top = self.sliderLayer.value() == self.sliderLayer.maximum()
+        self.sliderLayer.setMaximum(max(0, count - 1))
+        if top:
+            self.sliderLayer.setValue(self.sliderLayer.maximum())
+        self.showlayer(self.sliderLayer.value())
+
+    def showlayer(self, index):
+        self.view.setindex(index)
+        layers = self.view.layers
+        if not layers:
+            return
+        index = min(index, len(layers) - 1)
+        text = f"Layer {index + 1}/{len(layers)} at {layers[index]:.2f} mm"
+        if not self.toolpath.done:
+            text += f", loading {self.toolpath.progress:.0%}"
+        self.labelLayer.setText(text)
+
+
 class MainWindow(QtWidgets.QMainWindow):
     """
     The main window of the application
     """
     processPrinterMessage = pyqtSignal(bytes)
+    logMessage = pyqtSignal(str)
 
     def __init__(self):
         super().__init__()
@@ -37,8 +438,16 @@ class MainWindow(QtWidgets.QMainWindow):
                                'ui', 'mainwnd.ui')
         uic.loadUi(ui_path, self)
         self.open_dialog = QtWidgets.QFileDialog()
+        self.library = library.Library(os.path.join(
+            os.path.expanduser('~'), '.monnalisa', 'library.sqlite'
+        ))
         self.printer = xyz.XYZPrinter()
+        self.printer.capabilities = xyz.CapabilityCache(os.path.join(
+            os.path.expanduser('~'), '.monnalisa', 'capabilities.json'
+        ))
         self.printer.message_callback = self.printercallback
+        self.worker = PrinterWorker(self.printer)
+        self.worker.connected.connect(self.printerconnected)
 
         self.actions = {}
         self._image = {
@@ -47,10 +456,21 @@ class MainWindow(QtWidgets.QMainWindow):
         }
         self.processPrinterMessage.connect(self.processmessage)
 
-        guilogger = xyz.GuiLogger()
-        guilogger.edit = self.textEditLog
+        self.chart = TelemetryChart(self.printer.telemetry)
+        self.verticalLayout_4.insertWidget(1, self.chart)
+
+        # the log handlers run in a background thread, the records reach
+        # the log widget through a signal
+        self.logMessage.connect(self.textEditLog.append)
+        guilogger = xyz.GuiLogger(self.logMessage.emit)
         guilogger.setLevel(logging.DEBUG)
-        logging.getLogger().addHandler(guilogger)
+        flog = xyz.CompressedRotatingFileHandler(os.path.join(
+            os.path.expanduser('~'), '.monnalisa', 'monnalisa.log'
+        ))
+        flog.setFormatter(logging.Formatter(
+            '%(asctime)s  %(levelname)s  %(message)s'
+        ))
+        xyz.startlogging([guilogger, flog], logging.getLogger().level)
 
         self.pushButtonPause.hide()
         self.labelRemoteImage.hide()
@@ -58,10 +478,18 @@ class MainWindow(QtWidgets.QMainWindow):
         self.pushButtonPause.clicked.connect(self.pauseprint)
         self.pushButtonPortOpen.clicked.connect(self.getportfile)
         self.pushButtonConnect.clicked.connect(self.connectprinter)
-        self.pushButtonHome.clicked.connect(self.printer.home)
-        self.pushButtonLoad.clicked.connect(self.printer.loadfilemanet)
-        self.pushButtonUnload.clicked.connect(self.printer.unloadfilemanet)
-        self.pushButtonCalib.clicked.connect(self.printer.calibrationinit)
+        self.pushButtonHome.clicked.connect(
+            lambda: self.worker.call(self.printer.home)
+        )
+        self.pushButtonLoad.clicked.connect(
+            lambda: self.worker.call(self.printer.loadfilemanet)
+        )
+        self.pushButtonUnload.clicked.connect(
+            lambda: self.worker.call(self.printer.unloadfilemanet)
+        )
+        self.pushButtonCalib.clicked.connect(
+            lambda: self.worker.call(self.printer.calibrationinit)
+        )
         self.pushButtonAction.clicked.connect(self.printfile)
         self.pushButtonJog.clicked.connect(self.dojog)
         self.checkBoxDebug.toggled.connect(self.setloglevel)
@@ -70,7 +498,10 @@ class MainWindow(QtWidgets.QMainWindow):
         self.statusBar.showMessage("No printer connected")
 
     def closeEvent(self, event):
+        self.worker.stop()
         self.printer.stop()
+        # stops and waits for the scan started by the library dialog
+        self.library.close()
 
     def setloglevel(self, debug):
         if debug:
@@ -137,28 +568,10 @@ class MainWindow(QtWidgets.QMainWindow):
             self.labelE2Material.setText(e2mat)
 
         elif key == 'n':
-            self.printer.name = val
+            # name, machine id and options are stored by the printer itself
             self.labelPrinterName.setText(val)
 
-        elif key == 'o':
-            opts = val.split(',')
-            for option in opts:
-                if option[0] == 'p':  # p -> block_size
-                    b_size = int(option[1:])
-                    self.printer.block_size = b_size*1024 if b_size > 0 else 0
-                    logging.debug("Setting printer block size %d",
-                                  self.printer.block_size)
-                elif option[0] == 't':
-                    pass
-                elif option[0] == 'c':
-                    pass
-                elif option[0] == 'a':
-                    if option[1] == '+':
-                        self.printer.autoleveling = True
-                    else:
-                        self.printer.autoleveling = False
         elif key == 'p':
-            self.printer.setid(val)
             self.labelPrinterId.setText(f"({val})")
             self.checkBoxZipped.setChecked(self.printer.zipped)
             self.radioButton3wV2.setChecked(self.printer.version == 2)
@@ -244,7 +657,7 @@ class MainWindow(QtWidgets.QMainWindow):
         if stat:
             status_msg = f'{ACTION_MSG_DICT[action]}: '
             if action == 'image':
-                self.printer.sendAck(b'image')
+                self.worker.call(self.printer.sendAck, b'image')
                 try:
                     if stat['id'] != self._image['id']:
                         self._image['data'].close()
@@ -263,7 +676,7 @@ class MainWindow(QtWidgets.QMainWindow):
                         "Lower the calibration detenctor and then press ok",
                         QtWidgets.QMessageBox.Ok
                     )
-                    self.printer.calibrationrun()
+                    self.worker.call(self.printer.calibrationrun)
                     self.busy(True)
                 elif stat['stat'] == 'ok':
                     msg = QtWidgets.QMessageBox.information(
@@ -271,7 +684,7 @@ class MainWindow(QtWidgets.QMainWindow):
                         "Raise the calibration detenctor and then press ok",
                         QtWidgets.QMessageBox.Ok
                     )
-                    self.printer.calibrationdone()
+                    self.worker.call(self.printer.calibrationdone)
                 self.busy(False)
 
             elif stat['stat'] == 'start':
@@ -309,27 +722,48 @@ class MainWindow(QtWidgets.QMainWindow):
     def dojog(self):
         axis = self.comboBoxAxis.currentText().lower()
         jog = self.doubleSpinBoxJog.value()
-        self.printer.jog(axis, jog)
+        self.worker.call(self.printer.jog, axis, jog)
 
     def pauseprint(self):
         if self.printer.getprintstatus() == 'paused':
-            if self.printer.print('resume'):
-                self.printer._print_status = 'printing'
+            self.worker.call(self._setpause, 'resume', 'printing')
         elif self.printer.getprintstatus() == 'printing':
-            if self.printer.print('pause'):
-                self.printer._print_status = 'paused'
+            self.worker.call(self._setpause, 'pause', 'paused')
+
+    def _setpause(self, val, status):
+        # runs in the worker thread
+        if self.printer.print(val):
+            self.printer._print_status = status
 
     def printfile(self):
-        url, ext = self.open_dialog.getOpenFileName()
+        dialog = LibraryDialog(self.library, self)
+        if not dialog.exec_() or dialog.path is None:
+            return None
+        url = dialog.path
         if not os.path.exists(url):
             return None
+        if not self.previewfile(url):
+            return None
         self.printer.sendFile(url)
         self.pushButtonPause.show()
 
+    def previewfile(self, path):
+        """
+        Show the toolpath of a G-code file, returns False if the user does
+        not want to print it
+        """
+        if toolpath is None:
+            return True
+        with open(path, 'rb') as f:
+            if f.read(12) == b'3DPFNKG13WTW':
+                # the toolpath of a 3w file is encrypted
+                return True
+        return bool(PreviewDialog(path, self).exec_())
+
     def cancelcurrentaction(self):
-        self.printer.print('cancel')
+        self.worker.call(self.printer.print, 'cancel')
         for action in list(self.actions.keys()):
-            self.printer.sendaction(action, 'cancel')
+            self.worker.call(self.printer.sendaction, action, 'cancel')
 
     def busy(self, val, pbar=False):
         try:
@@ -355,28 +789,31 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def connectprinter(self, checked):
         if self.printer.port and self.printer.port.is_open:
-            self.printer.disconnect()
-            self.pushButtonConnect.setText('Connect')
-            self.pushButtonPortOpen.setEnabled(True)
-            self.lineEditPortUrl.setEnabled(True)
-            self.comboBoxBaud.setEnabled(True)
-            self.groupBoxOp.setEnabled(False)
-            self.groupBoxHm.setEnabled(False)
-            self.groupBoxPr.setEnabled(False)
-            self.groupBoxEx.setEnabled(False)
+            self.worker.call(self.printer.disconnect)
+            self.setconnected(False)
             self.statusBar.showMessage("No printer connected")
         else:
             port_url = self.lineEditPortUrl.text()
             baud = float(self.comboBoxBaud.currentText())
-            if self.printer.connect(port_url, baud, timeout=3):
-                self.pushButtonConnect.setText('Disconnect')
-                self.pushButtonPortOpen.setEnabled(False)
-                self.lineEditPortUrl.setEnabled(False)
-                self.comboBoxBaud.setEnabled(False)
-                self.groupBoxOp.setEnabled(True)
-                self.groupBoxHm.setEnabled(True)
-                self.groupBoxPr.setEnabled(True)
-                self.groupBoxEx.setEnabled(True)
-                self.statusBar.showMessage(
-                    f"Printer connected on: {port_url}"
-                )
+            # the connection may take seconds, keep the window responsive
+            self.pushButtonConnect.setEnabled(False)
+            self.statusBar.showMessage(f"Connecting to {port_url}...")
+            self.worker.connectprinter(port_url, baud)
+
+    def printerconnected(self, success, port_url):
+        self.pushButtonConnect.setEnabled(True)
+        if success:
+            self.setconnected(True)
+            self.statusBar.showMessage(f"Printer connected on: {port_url}")
+        else:
+            self.statusBar.showMessage(f"Cannot connect to {port_url}")
+
+    def setconnected(self, val):
+        self.pushButtonConnect.setText('Disconnect' if val else 'Connect')
+        self.pushButtonPortOpen.setEnabled(not val)
+        self.lineEditPortUrl.setEnabled(not val)
+        self.comboBoxBaud.setEnabled(not val)
+        self.groupBoxOp.setEnabled(val)
+        self.groupBoxHm.setEnabled(val)
+        self.groupBoxPr.setEnabled(val)
+        self.groupBoxEx.setEnabled(val)
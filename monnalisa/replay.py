@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""
+${LICENSE_HEADER}
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import socket
+import logging
+import argparse
+import threading
+
+import monnalisa
+from monnalisa import xyz
+
+
+class Player():
+    """
+    Plays back the received side of a wire recording.
+
+    Each chunk is delivered at its recorded time divided by speed (as soon
+    as possible if speed is 0). A chunk is also held back until the code
+    under test has sent as many bytes as had been sent before it, so that
+    replies never precede their requests, but no longer than gate_timeout
+    seconds in case the code sends something different. Status queries are
+    not counted, since they are sent at the pace of the replay.
+    """
+
+    POLL = b'XYZv3/query='
+
+    def __init__(self, records, speed=1.0, gate_timeout=1.0):
+        self.speed = speed
+        self.gate_timeout = gate_timeout
+        self.chunks = []
+        self.events = []
+        self.expected = bytearray()
+        self.open_info = None
+        for stamp, kind, data in records:
+            if kind == xyz.WireRecorder.RECV:
+                self.chunks.append((stamp, data, len(self.expected)))
+            elif kind == xyz.WireRecorder.SENT:
+                if not data.startswith(self.POLL):
+                    self.expected += data
+            elif kind == xyz.WireRecorder.EVENT:
+                self.events.append((stamp, json.loads(data)))
+            elif kind == xyz.WireRecorder.OPEN and self.open_info is None:
+                self.open_info = json.loads(data)
+        self.duration = max(
+            [stamp for stamp, data, sent in self.chunks[-1:]] +
+            [stamp for stamp, event in self.events[-1:]] + [0]
+        )
+        self.sent = bytearray()
+        self.received = 0
+        self.index = 0
+        self.start = time.monotonic()
+        # when the last chunk was delivered
+        self._delivered = 0
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.index >= len(self.chunks)
+
+    def due(self, stamp):
+        if not self.speed:
+            # right after the previous chunk
+            return max(self.start, self._delivered)
+        return self.start + stamp / self.speed
+
+    def recv(self, timeout):
+        """
+        Next received chunk, or b'' if none is due within timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self.finished:
+                stamp, data, sent_before = self.chunks[self.index]
+                ready = self.due(stamp)
+                if len(self.sent) < sent_before:
+                    ready += self.gate_timeout
+                now = time.monotonic()
+                if now >= ready:
+                    self.index += 1
+                    self.received += len(data)
+                    self._delivered = now
+                    return data
+                if now >= deadline:
+                    break
+                # woken up earlier by send()
+                self._cond.wait(min(ready, deadline) - now)
+        if self.finished:
+            time.sleep(max(0, deadline - time.monotonic()))
+        return b''
+
+    def send(self, data):
+        if data.startswith(self.POLL):
+            return len(data)
+        with self._cond:
+            self.sent += data
+            self._cond.notify_all()
+        return len(data)
+
+
+class ReplaySerial():
+    """
+    Stand-in for serial.Serial fed by a Player
+    """
+
+    def __init__(self, player, timeout=1):
+        self.player = player
+        self.timeout = timeout
+        self.is_open = True
+        self._pending = b''
+
+    @property
+    def in_waiting(self):
+        return len(self._pending)
+
+    def read(self, size=1):
+        if not self._pending:
+            self._pending = self.player.recv(self.timeout)
+        data = self._pending[:size]
+        self._pending = self._pending[size:]
+        return data
+
+    def write(self, data):
+        return self.player.send(data)
+
+    def close(self):
+        self.is_open = False
+
+
+class ReplaySocket():
+    """
+    Stand-in for a connected socket fed by a Player, for SocketPort. The
+    messages are recorded before they are framed, so they are unframed
+    again before being compared.
+    """
+
+    def __init__(self, player):
+        self.player = player
+        self.timeout = None
+        self.codec = xyz.MessageCodec()
+        self._rawbuff = b''
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def recv(self, size):
+        data = self.player.recv(self.timeout or 1)
+        if not data:
+            raise socket.timeout()
+        return data
+
+    def sendall(self, data):
+        messages, self._rawbuff = self.codec.decode(self._rawbuff + data)
+        for message in messages:
+            self.player.send(message)
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+def replay(path, speed=1.0, upload=None):
+    """
+    Run an XYZPrinter against a recording, returns a dict of statistics
+    """
+    player = Player(xyz.readrecording(path), speed)
+    if player.open_info is None:
+        raise ValueError(f"{path} does not record the opening of a link")
+
+    printer = xyz.XYZPrinter()
+    messages = []
+    printer.message_callback = messages.append
+    # the printer thread keeps the recorded pace
+    if speed:
+        printer.poll_interval /= speed
+        printer.ack_timeout /= speed
+    else:
+        printer.poll_interval = 0.01
+        printer.ack_timeout = 0.1
+
+    stme = time.perf_counter()
+    player.start = time.monotonic()
+    if player.open_info['type'] == 'socket':
+        port = xyz.SocketPort(
+            player.open_info['url'], compress=player.open_info['compress'],
+            sock=ReplaySocket(player)
+        )
+    else:
+        port = ReplaySerial(player)
+    printer.attach(port)
+
+    events = list(player.events)
+    while not player.finished or printer._upload:
+        if events and player.due(events[0][0]) <= time.monotonic():
+            stamp, event = events.pop(0)
+            fname = upload or event.get('upload')
+            if fname and printer._upload is None:
+                if os.path.exists(fname):
+                    printer.sendFile(fname)
+                else:
+                    logging.warning("Cannot replay the upload of %s, use "
+                                    "--upload", fname)
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - stme
+    printer.stop()
+
+    return {
+        'recorded': player.duration,
+        'elapsed': elapsed,
+        'received': player.received,
+        'sent': len(player.sent),
+        'expected': len(player.expected),
+        'identical': zlib.crc32(player.sent) == zlib.crc32(player.expected),
+        'messages': len(messages),
+        'uploads': sum(
+            1 for msg in messages if msg.startswith(b'upload:') and
+            b'"complete"' in msg
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Play back a wire recording through the printer code'
+    )
+    parser.add_argument("recording", metavar='FILE', type=str,
+                        help="A recording made with monnalisa-server "
+                        "--record.")
+    parser.add_argument("--speed", '-s', metavar='N', type=float, default=1,
+                        help="Playback speed, 0 means as fast as possible. "
+                        "The default value is %(default)s.")
+    parser.add_argument("--upload", '-u', metavar='FILE', type=str,
+                        default=None, help="File to upload when the "
+                        "recording did, instead of the recorded path.")
+    parser.add_argument("--version", action='store_true')
+
+    args = parser.parse_args()
+
+    if args.version:
+        print(f"Monnalisa v{monnalisa.__version__}")
+        sys.exit(0)
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.WARNING)
+    clog = logging.StreamHandler()
+    logger.addHandler(clog)
+    clog.setFormatter(logging.Formatter('%(levelname)s  %(message)s'))
+
+    try:
+        stats = replay(args.recording, args.speed, args.upload)
+    except (OSError, ValueError) as exc:
+        logger.error("Cannot replay %s: %s", args.recording, exc)
+        sys.exit(1)
+
+    print(f"{stats['recorded']:.2f} s recorded, replayed in "
+          f"{stats['elapsed']:.2f} s "
+          f"({stats['recorded'] / max(stats['elapsed'], 1e-9):.1f}x)")
+    print(f"{stats['received']} bytes received, {stats['messages']} "
+          f"messages, {stats['uploads']} uploads completed")
+    print(f"{stats['sent']} bytes sent, {stats['expected']} recorded "
+          f"(status queries excluded), "
+          f"{'identical' if stats['identical'] else 'different'}")
+
+
+if __name__ == '__main__':
+    main()
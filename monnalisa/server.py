@@ -7,42 +7,138 @@ ${LICENSE_HEADER}
 import sys
 import argparse
 import socket
-import time
 import logging
 import threading
-import zlib
 import uuid
 import base64
+import json
+import os
+import hashlib
+import time
+import zlib
 
 from functools import partial
 
-try:
-    import cv2
-    HAS_CV2 = True
-except ImportError:
-    HAS_CV2 = False
-
 import monnalisa
-from monnalisa import xyzgui, xyz
+from monnalisa import xyz, jobs, library, camera
 
 
-def client_callback(client, msg):
+def client_callback(codec, client, msg):
+    # the client splits what it receives in lines
+    if not msg.endswith(b'\n'):
+        msg += b'\n'
     try:
-        client.sendall(xyz.socketmsg(msg))
+        codec.send(client, msg)
     except (BrokenPipeError, ConnectionError):
         pass
 
 
+def hellocommand(data, compression=True, min_size=None):
+    """
+    Answer the hello sent by a client as a JSON object like
+    {"compress": "deflate"}, returns the message to send back and whether
+    the messages to the client are compressed from now on
+    """
+    try:
+        hello = json.loads(data)
+        compress = compression and hello.get('compress') == 'deflate'
+    except (ValueError, AttributeError) as exc:
+        logging.error("Invalid hello: %s", exc)
+        compress = False
+    reply = {
+        'compress': 'deflate' if compress else None,
+        'min_size': min_size,
+    }
+    return b'hello:' + json.dumps(reply).encode(), compress
+
+
+def queuecommand(job_queue, data):
+    """
+    Execute a print queue command sent by a client as a JSON object like
+    {"cmd": "add", "path": "/path/to/file.gcode", "priority": 0}, returns
+    the message to send back to the client.
+    """
+    try:
+        cmd = json.loads(data)
+        name = cmd['cmd']
+        if name == 'add':
+            job_id = job_queue.add(cmd['path'], int(cmd.get('priority', 0)))
+            result = {'id': job_id}
+        elif name == 'cancel':
+            result = {'ok': job_queue.cancel(cmd['id'])}
+        elif name == 'move':
+            result = {'ok': job_queue.move(cmd['id'], int(cmd['index']))}
+        elif name == 'priority':
+            result = {
+                'ok': job_queue.setpriority(cmd['id'], int(cmd['priority']))
+            }
+        elif name == 'list':
+            result = {}
+        else:
+            raise ValueError(f"unknown command {name}")
+    except (ValueError, KeyError, TypeError) as exc:
+        logging.error("Invalid queue command: %s", exc)
+        result = {'error': str(exc)}
+    result['jobs'] = job_queue.list()
+    return b'queue:' + json.dumps(result).encode() + b'\n'
+
+
+def telemetrycommand(telemetry, data):
+    """
+    Reply to a telemetry query sent by a client as a JSON object like
+    {"since": 1600000000.0, "channels": ["temp1", "progress"]}, both keys
+    are optional.
+    """
+    try:
+        query = json.loads(data)
+        since = query.get('since')
+        channels = query.get('channels')
+        result = {'channels': telemetry.todict(channels, since)}
+    except (ValueError, AttributeError, TypeError) as exc:
+        logging.error("Invalid telemetry query: %s", exc)
+        result = {'error': str(exc), 'channels': {}}
+    return b'telemetry:' + json.dumps(result).encode() + b'\n'
+
+
+def librarycommand(lib, data):
+    """
+    Execute a print library command sent by a client as a JSON object like
+    {"cmd": "search", "text": "benchy", "machine": null, "limit": 200} or
+    {"cmd": "scan"}, returns the message to send back to the client.
+    """
+    try:
+        cmd = json.loads(data)
+        name = cmd['cmd']
+        if name == 'search':
+            result = {'files': lib.search(
+                cmd.get('text', ''), cmd.get('machine'),
+                int(cmd.get('limit', 200))
+            )}
+        elif name == 'scan':
+            threading.Thread(target=lib.scan, daemon=True).start()
+            result = {'stat': 'scanning'}
+        else:
+            raise ValueError(f"unknown command {name}")
+    except (ValueError, KeyError, TypeError) as exc:
+        logging.error("Invalid library command: %s", exc)
+        result = {'error': str(exc)}
+    return b'library:' + json.dumps(result).encode() + b'\n'
+
+
 class CamThread(threading.Thread):
+    """
+    Sends the frames of a camera.Camera to the client, base64 encoded, in
+    packets that the client acknowledges one by one. The frames are sent
+    straight from the shared memory of the camera process.
+    """
 
-    def __init__(self, cam, interval=1):
+    def __init__(self, cam, packet_size=1024):
         super().__init__()
         self._do_stop = False
         self.cam = cam
-        self.interval = interval
-        self._lock = threading.Lock()
+        self.packet_size = packet_size
+        self._acked = threading.Event()
         self.start()
-        self.packet_size = 1024
 
     def onImageCallback(self, image):
         pass
@@ -51,40 +147,200 @@ class CamThread(threading.Thread):
         self._do_stop = True
         self.ack()
         self.join()
+        self.cam.stop()
 
     def ack(self):
-        if self._lock.locked():
-            self._lock.release()
+        self._acked.set()
 
     def run(self):
+        ring = self.cam.ring
         while not self._do_stop:
-            print('sending image...')
-            ret, frame = self.cam.read()
-            frame = frame[::2, ::2]
-            img_id = str(uuid.uuid4()).encode()
-            shape = frame.shape
-            if HAS_CV2:
-                data = cv2.imencode('.png', frame)[1]
-            else:
-                data = frame.tobytes()
-            data = zlib.compress(data, 9)
-            data = base64.b64encode(data)
-            for off in range(0, len(data), self.packet_size):
-                stripe = data[off:off+self.packet_size]
-                msg = b'image:{'
-                msg += b'"id":"' + img_id + b'",'
-                msg += b'"shape":' + ('['+str(shape)[1:-1]+']').encode()+b','
-                msg += b'"offset":' + str(off).encode() + b','
-                msg += b'"data":"' + stripe + b'"}\n'
-                self._lock.acquire()
-                send_time = time.time()
+            if not self.cam.wait(1):
+                if not self.cam.process.is_alive():
+                    logging.error("The camera process exited with code %s",
+                                  self.cam.process.exitcode)
+                    return
+                continue
+            frame = ring.latest()
+            if frame is None:
+                continue
+            seq, shape, data = frame
+            try:
+                self._sendframe(seq, shape, data)
+            finally:
+                data.release()
+                ring.release()
+
+    def _sendframe(self, seq, shape, data):
+        logging.debug("Sending image...")
+        img_id = str(uuid.uuid4()).encode()
+        head = b'image:{"id":"' + img_id + b'",'
+        head += b'"shape":' + json.dumps(list(shape)).encode() + b','
+        for off in range(0, len(data), self.packet_size):
+            msg = head + b'"offset":' + str(off).encode() + b','
+            msg += b'"data":"' + data[off:off+self.packet_size] + b'"}\n'
+            self._acked.clear()
+            self.onImageCallback(msg)
+            while not self._acked.wait(10):
                 self.onImageCallback(msg)
-                while self._lock.locked():
-                    if time.time() - send_time > 10:
-                        self.onImageCallback(msg)
-                        send_time = time.time()
-            self.onImageCallback(b'image:{"id":"' + img_id + b'"}\n')
-            time.sleep(self.interval)
+            if self._do_stop:
+                return
+        # the client shows the frame when this last message arrives, a
+        # torn one is dropped: the next frame replaces it
+        if not self.cam.ring.valid(seq):
+            logging.warning("Camera frame overwritten while it was being "
+                            "sent, dropped")
+            return
+        self.onImageCallback(b'image:{"id":"' + img_id + b'"}\n')
+
+
+class FileStore():
+    """
+    Files sent by the clients, stored by their sha256 hash, so that a file
+    already received is never sent again
+    """
+
+    # files bigger than this are refused
+    MAX_SIZE = 1 << 31
+    # seconds after which an upload that received nothing is dropped
+    PARTIAL_TIMEOUT = 300
+
+    def __init__(self, path):
+        self.path = path
+        # digest: [file, size, bytes received from the start, last write]
+        self._partial = {}
+        os.makedirs(path, exist_ok=True)
+        # left by a previous run
+        for fname in os.listdir(path):
+            if fname.endswith('.part'):
+                os.remove(os.path.join(path, fname))
+
+    def filepath(self, digest):
+        # the hash comes from the network, don't let it escape from the store
+        if len(digest) != 64 or not all(c in '0123456789abcdef'
+                                        for c in digest):
+            raise ValueError(f"invalid hash {digest}")
+        return os.path.join(self.path, digest)
+
+    def has(self, digest):
+        return os.path.exists(self.filepath(digest))
+
+    def write(self, digest, size, offset, data):
+        """
+        Store a chunk of a file, returns True once the file is complete.
+        The chunks must come in order, a chunk sent again is ignored.
+        """
+        fname = self.filepath(digest)
+        self.expire()
+        if not isinstance(size, int) or not 0 < size <= self.MAX_SIZE:
+            raise ValueError(f"invalid size {size}")
+        if not isinstance(offset, int) or offset < 0 or (
+                offset + len(data) > size):
+            raise ValueError(f"invalid chunk at {offset} of {size} bytes")
+        if digest not in self._partial:
+            self._partial[digest] = [open(fname + '.part', 'wb'), size, 0,
+                                     time.monotonic()]
+        upload = self._partial[digest]
+        fobj, expected, received = upload[:3]
+        if size != expected:
+            self.discard(digest)
+            raise ValueError(f"size of {digest} changed")
+        if offset > received:
+            self.discard(digest)
+            raise ValueError(f"missing data of {digest} at {received}")
+        upload[3] = time.monotonic()
+        if offset + len(data) <= received:
+            # already received
+            return False
+        fobj.seek(offset)
+        fobj.write(data)
+        upload[2] = received = offset + len(data)
+        if received < size:
+            return False
+
+        fobj.close()
+        del self._partial[digest]
+        hasher = hashlib.sha256()
+        with open(fname + '.part', 'rb') as f:
+            for block in iter(partial(f.read, 1 << 20), b''):
+                hasher.update(block)
+        if hasher.hexdigest() != digest:
+            os.remove(fname + '.part')
+            raise ValueError(f"corrupted file {digest}")
+        os.replace(fname + '.part', fname)
+        logging.info("Stored file %s (%d bytes)", digest, size)
+        return True
+
+    def discard(self, digest=None):
+        """
+        Drop the incomplete file digest, or all of them
+        """
+        for key in [digest] if digest else list(self._partial):
+            upload = self._partial.pop(key, None)
+            if upload is None:
+                continue
+            upload[0].close()
+            try:
+                os.remove(upload[0].name)
+            except OSError:
+                pass
+
+    def expire(self):
+        now = time.monotonic()
+        for digest, upload in list(self._partial.items()):
+            if now - upload[3] > self.PARTIAL_TIMEOUT:
+                logging.warning("Upload of %s timed out", digest)
+                self.discard(digest)
+
+
+def offloadcommand(store, job_queue, data):
+    """
+    Execute an upload offload command sent by a client, returns the message
+    to send back to the client, if any.
+    """
+    cmd = None
+    try:
+        cmd = json.loads(data)
+        name = cmd['cmd']
+        digest = cmd['hash']
+        if name == 'query':
+            result = {'stat': 'have' if store.has(digest) else 'need'}
+        elif name == 'data':
+            chunk = base64.b64decode(cmd['data'])
+            if not store.write(digest, cmd['size'], cmd['offset'], chunk):
+                return None
+            result = {'stat': 'stored'}
+        elif name == 'print':
+            if not store.has(digest):
+                raise ValueError(f"unknown file {digest}")
+            result = {
+                'stat': 'queued',
+                'id': job_queue.add(store.filepath(digest))
+            }
+        else:
+            raise ValueError(f"unknown command {name}")
+    except (ValueError, KeyError, TypeError, OSError) as exc:
+        logging.error("Invalid offload command: %s", exc)
+        result = {'stat': 'error', 'error': str(exc)}
+    result['hash'] = cmd.get('hash') if isinstance(cmd, dict) else None
+    return b'offload:' + json.dumps(result).encode() + b'\n'
+
+
+def compressionlevel(value):
+    """
+    argparse type of --compression: 'auto' or a deflate level
+    """
+    if value == 'auto':
+        return value
+    try:
+        level = int(value)
+    except ValueError:
+        level = -1
+    if not 0 <= level <= 9:
+        raise argparse.ArgumentTypeError(
+            f"invalid level {value!r}, use 0-9 or 'auto'"
+        )
+    return level
 
 
 def main():
@@ -106,6 +362,80 @@ def main():
                         "serial connection tiwth the printer. If this option "
                         "is not specified then the default vaule ob 9600 is "
                         "used")
+    parser.add_argument("--queue-dir", metavar='DIR', type=str,
+                        default=os.path.join(
+                            os.path.expanduser('~'), '.monnalisa', 'queue'
+                        ), help="Directory where the print queue and the "
+                        "prepared jobs are stored. The default value is "
+                        "%(default)s.")
+    parser.add_argument("--store-dir", metavar='DIR', type=str,
+                        default=os.path.join(
+                            os.path.expanduser('~'), '.monnalisa', 'files'
+                        ), help="Directory where the files sent by the "
+                        "clients are stored. The default value is "
+                        "%(default)s.")
+    parser.add_argument("--library", metavar='DIR', type=str,
+                        action='append', default=[], help="Add %(metavar)s "
+                        "to the print library that clients can search. Can "
+                        "be used more than once.")
+    parser.add_argument("--library-index", metavar='FILE', type=str,
+                        default=os.path.join(
+                            os.path.expanduser('~'), '.monnalisa',
+                            'library.sqlite'
+                        ), help="SQLite index of the print library. The "
+                        "default value is %(default)s.")
+    parser.add_argument("--capabilities", metavar='FILE', type=str,
+                        default=os.path.join(
+                            os.path.expanduser('~'), '.monnalisa',
+                            'capabilities.json'
+                        ), help="Cache of the printer capabilities, used "
+                        "until the printer reports them after connecting. "
+                        "The default value is %(default)s.")
+    parser.add_argument("--sd-card", action='store_true',
+                        help="Save the files sent to the printer on its SD "
+                        "card too, and record them in the SD card index.")
+    parser.add_argument("--sd-index", metavar='FILE', type=str,
+                        default=os.path.join(
+                            os.path.expanduser('~'), '.monnalisa',
+                            'sdcard.json'
+                        ), help="Index of the files saved on the SD cards. "
+                        "The default value is %(default)s.")
+    parser.add_argument("--prefetch", metavar='N', type=int, default=2,
+                        help="Number of queued jobs to convert ahead of time."
+                        " The default value is %(default)d.")
+    parser.add_argument("--compression", metavar='LEVEL',
+                        type=compressionlevel,
+                        default='auto', help="Deflate level (0-9) used for "
+                        "printers that accept zipped files. If set to 'auto'"
+                        " (the default) the level is chosen according to the"
+                        " upload speed measured on the printer link.")
+    parser.add_argument("--minify", action='store_true',
+                        help="Strip comments, whitespaces and redundant "
+                        "words from the G-code before sending it to the "
+                        "printer.")
+    parser.add_argument("--no-compression", action='store_true',
+                        help="Do not compress the messages sent to the "
+                        "clients, even if they support it.")
+    parser.add_argument("--compress-min-size", metavar='BYTES', type=int,
+                        default=xyz.MessageCodec.MIN_SIZE,
+                        help="Send the messages shorter than %(metavar)s "
+                        "uncompressed, the clients are told to do the same. "
+                        "The default value is %(default)s.")
+    parser.add_argument("--profile", choices=['cprofile', 'tracemalloc'],
+                        default=None, help="Log a cProfile or tracemalloc "
+                        "report for each G-code to 3w conversion.")
+    parser.add_argument("--record", metavar='FILE', type=str, default=None,
+                        help="Record the data exchanged with the printer in "
+                        "%(metavar)s, to be played back by monnalisa-replay.")
+    parser.add_argument("--log", metavar='FILE', type=str,
+                        default=os.path.join(
+                            os.path.expanduser('~'), '.monnalisa',
+                            'server.log'
+                        ), help="Log file, rotated and compressed when it "
+                        "reaches 4 MB. The default value is %(default)s.")
+    parser.add_argument("--debug", action='store_true',
+                        help="Log the debug messages too, including every "
+                        "message exchanged with the printer.")
     parser.add_argument("--version", action='store_true')
 
     args = parser.parse_args()
@@ -114,18 +444,20 @@ def main():
         print(f"Monnalisa v{monnalisa.__version__}")
         sys.exit(0)
 
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-    clog = logging.StreamHandler()
-    logger.addHandler(clog)
-    clog.setLevel(logging.INFO)
+    level = logging.DEBUG if args.debug else logging.INFO
     formatter = logging.Formatter(
         '%(asctime)s  %(levelname)s  %(message)s'
     )
+    clog = logging.StreamHandler()
     clog.setFormatter(formatter)
+    flog = xyz.CompressedRotatingFileHandler(args.log)
+    flog.setFormatter(formatter)
+    # the handlers run in a background thread, fed by a queue
+    xyz.startlogging([clog, flog], level)
+    logger = logging.getLogger()
 
-    if args.server:
-        addr = args.server
+    if args.addr:
+        addr = args.addr
     else:
         addr = ''
 
@@ -137,72 +469,113 @@ def main():
     logger.info("Socket timeout: %s", srv.gettimeout())
     client = None
 
-    if HAS_CV2:
+    cam_thread = None
+    if camera.available():
         device = 0
         logger.info("Opening video stream with device %d", device)
-        remote_cam = cv2.VideoCapture(0)
-        cam_thread = CamThread(remote_cam, 10)
+        cam_thread = CamThread(camera.Camera(device, 10))
 
     logger.info("Creating printer object...")
     printer = xyz.XYZPrinter()
+    printer.profile = args.profile
+    printer.capabilities = xyz.CapabilityCache(args.capabilities)
+    if args.sd_card:
+        printer.savetosd = True
+        printer.sdcard = xyz.SDCardIndex(args.sd_index)
+    if args.record:
+        printer.record(args.record)
+    printer.minify = args.minify
+    printer.compression = args.compression
+    job_queue = None
     try:
         if not printer.connect(args.printer_port, args.baud, timeout=3):
             sys.exit(1)
+        job_queue = jobs.JobQueue(printer, args.queue_dir, args.prefetch)
+        store = FileStore(args.store_dir)
+        lib = library.Library(args.library_index)
+        for path in args.library:
+            lib.addroot(path)
+        # only the new and changed files are read
+        threading.Thread(target=lib.scan, daemon=True).start()
         while True:
             logger.info("Waiting for clients")
             client, client_addr = srv.accept()
             logger.info("New client accepted from %s", client_addr)
             _rawbuff = b''
+            codec = xyz.MessageCodec(min_size=args.compress_min_size)
 
-            if HAS_CV2:
-                client_send_message = partial(client_callback, client)
+            client_send_message = partial(client_callback, codec, client)
             printer.message_callback = client_send_message
-            cam_thread.onImageCallback = client_send_message
+            if cam_thread:
+                cam_thread.onImageCallback = client_send_message
+            # let the client know the printer state right away
+            for line in list(printer.status.values()):
+                client_send_message(line)
 
             client_error = False
             while client:
                 try:
-                    data = client.recv(1024)
+                    data = client.recv(65536)
                     if not data:
                         client_error = True
                 except ConnectionError as exc:
-                    # TODO: retry
+                    # the client reconnects on its own
                     logging.error(exc)
                     client_error = True
 
+                messages = []
+                if not client_error:
+                    _rawbuff += data
+                    try:
+                        messages, _rawbuff = codec.decode(_rawbuff)
+                    except (zlib.error, ValueError) as exc:
+                        # the stream of the client cannot be trusted any
+                        # longer, it reconnects on its own
+                        logging.error("Corrupted message from the client, "
+                                      "disconnecting it: %s", exc)
+                        client_error = True
+
                 if client_error:
                     printer.message_callback = lambda x: None
+                    client.close()
                     client = None
+                    # the client sends its files again when it comes back
+                    store.discard()
+                    logger.info("Client disconnected, compression ratio "
+                                "%.2f", codec.ratio())
                     break
 
-                if data:
-                    _rawbuff += data
-
-                msg_start = _rawbuff.find(xyz.SocketPort.PACKET_START)
-                while msg_start >= 0:
-                    msg_start += len(xyz.SocketPort.PACKET_START)
-                    msg_end = _rawbuff.find(
-                        xyz.SocketPort.PACKET_END,
-                        msg_start
-                    )
-
-                    if msg_end < 0:
-                        break
-
-                    action = _rawbuff[msg_start:msg_end]
-                    msg_end += len(xyz.SocketPort.PACKET_END)
-                    _rawbuff = _rawbuff[msg_end+1:]
-
-                    message = xyz._parsemsg(action)
-                    msg_start = _rawbuff.find(
-                        xyz.SocketPort.PACKET_START,
-                        msg_end
-                    )
-                    if message.startswith(b'ok:'):
-                        if message.endswith(b':image\n'):
+                for message in messages:
+                    if message.startswith(b'hello:'):
+                        # always answered, the clients send the extended
+                        # commands (offload:...) only after this reply
+                        reply, compress = hellocommand(
+                            message[6:], not args.no_compression,
+                            args.compress_min_size
+                        )
+                        client_send_message(reply)
+                        codec.compress = compress
+                    elif message.startswith(b'ok:'):
+                        if message.endswith(b':image\n') and cam_thread:
                             cam_thread.ack()
+                    elif message.startswith(b'queue:'):
+                        client_send_message(
+                            queuecommand(job_queue, message[6:])
+                        )
+                    elif message.startswith(b'telemetry:'):
+                        client_send_message(
+                            telemetrycommand(printer.telemetry, message[10:])
+                        )
+                    elif message.startswith(b'library:'):
+                        client_send_message(
+                            librarycommand(lib, message[8:])
+                        )
+                    elif message.startswith(b'offload:'):
+                        reply = offloadcommand(store, job_queue, message[8:])
+                        if reply:
+                            client_send_message(reply)
                     else:
-                        printer.port.write(message)
+                        printer.sendcommand(message)
 
     except (KeyboardInterrupt, SystemExit):
         if client:
@@ -213,7 +586,13 @@ def main():
                 pass
             else:
                 client.close()
-        if HAS_CV2:
+        if cam_thread:
             cam_thread.stop()
+        if job_queue:
+            job_queue.stop()
         printer.stop()
         srv.close()
+
+
+if __name__ == '__main__':
+    main()
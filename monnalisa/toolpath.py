@@ -0,0 +1,518 @@
+"""
+${LICENSE_HEADER}
+"""
+
+import re
+import mmap
+import math
+import threading
+
+import numpy as np
+
+
+BATCH_SIZE = 1 << 20
+
+# characters of a number parsed at once, the longer numbers are parsed
+# one by one
+NUMBER_WIDTH = 12
+
+# feedrate (mm/min) assumed until the G-code sets one
+DEFAULT_FEEDRATE = 3000.0
+
+MOVE = 1        # G0, G1
+SETPOS = 2      # G92
+HOME = 3        # G28
+ABSOLUTE = 4    # G90
+RELATIVE = 5    # G91
+E_ABSOLUTE = 6  # M82
+E_RELATIVE = 7  # M83
+
+# cell sizes (mm) of the level of detail decimations of the preview
+LOD_CELLS = (0.05, 0.2, 0.8, 3.2)
+
+# files bigger than this are previewed first by parsing SAMPLES windows of
+# SAMPLE_SIZE bytes spread over the whole file
+SAMPLE_SIZE = 0x10000
+SAMPLES = 64
+SAMPLE_THRESHOLD = 16 << 20
+
+# what can follow a command number: anything but a digit or a dot, the
+# words can be written without spaces (G1X10Y5)
+_WORD_END = np.ones(256, dtype=bool)
+_WORD_END[[ord(char) for char in '0123456789.']] = False
+
+_NUMBER = re.compile(rb'[-+]?[0-9]*\.?[0-9]*')
+
+_POW10 = 10.0 ** np.arange(NUMBER_WIDTH + 1)
+
+_AXIS_CODES = np.zeros(256, dtype=np.uint8)
+_AXIS_CODES[[ord(axis) for axis in 'XYZEF']] = np.arange(1, 6)
+
+
+def _ord(char):
+    return np.uint8(ord(char))
+
+
+def _ffillindex(mask):
+    """
+    For each element, the index of the last True element of mask up to it.
+    """
+    idx = np.where(mask, np.arange(len(mask)), 0)
+    np.maximum.accumulate(idx, out=idx)
+    return idx
+
+
+def parsenumbers(buff, pos, width=NUMBER_WIDTH):
+    """
+    Parse the decimal numbers starting at the indices pos of the uint8
+    array buff, all at once. buff must be followed by at least width + 1
+    null bytes.
+    """
+    mantissa = np.zeros(len(pos))
+    decimals = np.zeros(len(pos), dtype=np.int64)
+    dot = np.zeros(len(pos), dtype=bool)
+    neg = buff[pos] == _ord('-')
+    sign = neg | (buff[pos] == _ord('+'))
+    inside = np.ones(len(pos), dtype=bool)
+    # one column of characters at a time, for all the numbers together
+    for col in range(width):
+        char = buff[pos + col]
+        digit = char - _ord('0')
+        isdig = digit < 10
+        isdot = char == _ord('.')
+        if col == 0:
+            inside = isdig | isdot | sign
+        else:
+            inside &= isdig | isdot
+        isdig &= inside
+        mantissa = np.where(isdig, mantissa * 10 + digit, mantissa)
+        decimals += isdig & dot
+        dot |= isdot & inside
+        if not inside.any():
+            break
+    values = mantissa / _POW10[decimals]
+    values[neg] *= -1
+    if inside.any():
+        # still going after width characters
+        char = buff[pos + width]
+        inside &= (char - _ord('0') < 10) | (char == _ord('.'))
+    if inside.any():
+        view = memoryview(buff)
+        for i in np.flatnonzero(inside):
+            try:
+                values[i] = float(_NUMBER.match(view, pos[i])[0])
+            except ValueError:
+                values[i] = np.nan
+    return values
+
+
+def _scanbatch(buff):
+    """
+    Find the lines of buff relevant for the motion, returns their types and
+    a dictionary with the values of the X, Y, Z, E and F words of each of
+    them (nan where a word is missing).
+    """
+    n_bytes = len(buff)
+    newlines = np.flatnonzero(buff == _ord('\n'))
+    starts = np.concatenate(([0], newlines + 1))
+    starts = starts[starts < n_bytes]
+    # the line of each byte, cheaper than a search for each word
+    lineof = np.repeat(np.arange(len(starts), dtype=np.int32),
+                       np.diff(np.append(starts, n_bytes)))
+
+    padded = np.zeros(n_bytes + NUMBER_WIDTH + 1, dtype=np.uint8)
+    padded[:n_bytes] = buff
+    c0, c1, c2, c3 = (padded[starts + i] for i in range(4))
+
+    is_g = c0 == _ord('G')
+    sep2 = _WORD_END[c2]
+    sep3 = _WORD_END[c3]
+    short_move = ((c1 == _ord('0')) | (c1 == _ord('1'))) & sep2
+    long_move = (c1 == _ord('0')) & ((c2 == _ord('0')) | (c2 == _ord('1')))
+    long_move &= sep3
+
+    types = np.zeros(len(starts), dtype=np.uint8)
+    types[is_g & (short_move | long_move)] = MOVE
+    types[is_g & (c1 == _ord('9')) & (c2 == _ord('2')) & sep3] = SETPOS
+    types[is_g & (c1 == _ord('2')) & (c2 == _ord('8')) & sep3] = HOME
+    types[is_g & (c1 == _ord('9')) & (c2 == _ord('0')) & sep3] = ABSOLUTE
+    types[is_g & (c1 == _ord('9')) & (c2 == _ord('1')) & sep3] = RELATIVE
+    is_m8 = (c0 == _ord('M')) & (c1 == _ord('8')) & sep3
+    types[is_m8 & (c2 == _ord('2'))] = E_ABSOLUTE
+    types[is_m8 & (c2 == _ord('3'))] = E_RELATIVE
+
+    rows = np.flatnonzero(types)
+    rowof = np.full(len(starts), -1)
+    rowof[rows] = np.arange(len(rows))
+
+    # everything after the first ';' of a line is a comment
+    semicolons = np.flatnonzero(buff == _ord(';'))
+    comment = np.full(len(starts), n_bytes)
+    sc_lines = lineof[semicolons]
+    first = np.ones(len(sc_lines), dtype=bool)
+    first[1:] = sc_lines[1:] != sc_lines[:-1]
+    comment[sc_lines[first]] = semicolons[first]
+
+    # all the X, Y, Z, E and F letters that start a word, after a blank
+    # or after the number of the previous word
+    letters = (buff[1:] - _ord('X') < 3) | (buff[1:] - _ord('E') < 2)
+    prev = buff[:-1]
+    letters &= ((prev == _ord(' ')) | (prev == _ord('\t')) |
+                (prev - _ord('0') < 10) | (prev == _ord('.')))
+    pos = np.flatnonzero(letters) + 1
+    lines = lineof[pos]
+    line_types = types[lines]
+    keep = (line_types == MOVE) | (line_types == SETPOS)
+    keep |= line_types == HOME
+    keep &= pos < comment[lines]
+    pos = pos[keep]
+    rows_of_words = rowof[lines[keep]]
+    codes = _AXIS_CODES[buff[pos]]
+    values = parsenumbers(padded, pos + 1)
+
+    # one column per axis, filled at once
+    table = np.full((6, len(rows)), np.nan)
+    table[codes, rows_of_words] = values
+    words = {axis: table[code] for code, axis in enumerate('XYZEF', 1)}
+    return types[rows], words
+
+
+def iterrows(data, batch_size=BATCH_SIZE, progress=None):
+    """
+    Parse the motion commands of the G-code data (bytes) in batches.
+
+    For each batch yields the types of the relevant lines and a dictionary
+    with the absolute X, Y, Z, E positions and the feedrate after each of
+    them; the position arrays have an extra leading element, the position
+    at the end of the previous batch. progress, if given, is called with
+    the number of bytes parsed before each batch is yielded.
+    """
+    carry = {'X': 0.0, 'Y': 0.0, 'Z': 0.0, 'E': 0.0, 'F': DEFAULT_FEEDRATE}
+    absolute = True
+    e_absolute = True
+    start = 0
+    while start < len(data):
+        end = start + batch_size
+        if end < len(data):
+            end = data.rfind(b'\n', start, end) + 1
+            if end <= start:
+                end = data.find(b'\n', start + batch_size) + 1 or len(data)
+        else:
+            end = len(data)
+        buff = np.frombuffer(data, dtype=np.uint8, count=end-start,
+                             offset=start)
+        start = end
+
+        types, words = _scanbatch(buff)
+        if progress is not None:
+            progress(start)
+        if not len(types):
+            continue
+
+        # positioning modes, with the mode of the previous batch on top
+        mode = np.full(len(types) + 1, -1, dtype=np.int8)
+        mode[0] = absolute
+        mode[1:][types == ABSOLUTE] = 1
+        mode[1:][types == RELATIVE] = 0
+        mode = mode[_ffillindex(mode >= 0)].astype(bool)
+        e_mode = np.full(len(types) + 1, -1, dtype=np.int8)
+        e_mode[0] = e_absolute
+        e_mode[1:][(types == ABSOLUTE) | (types == E_ABSOLUTE)] = 1
+        e_mode[1:][(types == RELATIVE) | (types == E_RELATIVE)] = 0
+        e_mode = e_mode[_ffillindex(e_mode >= 0)].astype(bool)
+        absolute = bool(mode[-1])
+        e_absolute = bool(e_mode[-1])
+
+        types0 = np.concatenate(([SETPOS], types))
+        is_move = types0 == MOVE
+        no_pos = np.ones(len(types0), dtype=bool)
+        no_xyz = np.ones(len(types0), dtype=bool)
+        for axis in 'XYZE':
+            no_pos[1:] &= np.isnan(words[axis])
+            if axis != 'E':
+                no_xyz[1:] &= np.isnan(words[axis])
+
+        positions = {}
+        for axis in 'XYZE':
+            values = np.concatenate(([carry[axis]], words[axis]))
+            has = ~np.isnan(values)
+            axis_abs = e_mode if axis == 'E' else mode
+            reset = has & ((types0 == SETPOS) | (is_move & axis_abs))
+            # G92 without arguments sets all the axes to 0
+            reset |= (types0 == SETPOS) & no_pos
+            if axis != 'E':
+                # G28 homes the given axes, or all of them
+                reset |= (types0 == HOME) & (has | no_xyz)
+            reset_val = np.where(has & (types0 != HOME), values, 0.0)
+            reset[0] = True
+            reset_val[0] = carry[axis]
+            delta = np.where(has & is_move & ~axis_abs, values, 0.0)
+            delta[0] = 0
+            cumulative = np.cumsum(delta)
+            last = _ffillindex(reset)
+            positions[axis] = (
+                reset_val[last] + cumulative - cumulative[last]
+            )
+            carry[axis] = float(positions[axis][-1])
+
+        feed = np.concatenate(([carry['F']], words['F']))
+        feed[~is_move] = np.nan
+        feed[0] = carry['F']
+        feed = feed[_ffillindex(~np.isnan(feed))]
+        positions['F'] = feed
+        carry['F'] = float(feed[-1])
+
+        yield types, positions
+
+
+def gcodestats(data):
+    """
+    Estimate the print time (s), the number of layers and the filament
+    used (m) from the moves of the G-code data (bytes).
+    """
+    print_time = 0.0
+    filament = 0.0
+    layers = set()
+    for types, pos in iterrows(data):
+        is_move = types == MOVE
+        d_x = np.diff(pos['X'])
+        d_y = np.diff(pos['Y'])
+        d_z = np.diff(pos['Z'])
+        d_e = np.diff(pos['E'])
+        dist = np.sqrt(d_x**2 + d_y**2 + d_z**2)
+        # retractions and priming moves
+        dist = np.where(dist > 0, dist, np.abs(d_e))
+        feed = pos['F'][1:]
+        timed = is_move & (feed > 0)
+        print_time += float((dist[timed] / feed[timed]).sum()) * 60
+        filament += float(d_e[is_move].sum())
+        extruding = is_move & (d_e > 0) & ((d_x != 0) | (d_y != 0))
+        layers.update(np.unique(np.round(pos['Z'][1:][extruding], 3)))
+    return {
+        'print_time': int(round(print_time)),
+        'total_layers': len(layers),
+        'total_filament': round(max(filament, 0) / 1000, 3),
+    }
+
+
+def extrusions(types, pos):
+    """
+    Start and end points of the extruding moves of a batch of iterrows, as
+    x0, y0, x1, y1 and z arrays
+    """
+    d_x = np.diff(pos['X'])
+    d_y = np.diff(pos['Y'])
+    d_e = np.diff(pos['E'])
+    extruding = (types == MOVE) & (d_e > 0) & ((d_x != 0) | (d_y != 0))
+    idx = np.flatnonzero(extruding)
+    return (pos['X'][idx], pos['Y'][idx], pos['X'][idx+1], pos['Y'][idx+1],
+            pos['Z'][idx+1])
+
+
+def polylines(x0, y0, x1, y1):
+    """
+    Join the consecutive segments into polylines, returns their points as
+    an (N, 2) float32 array and a bool array, True where a polyline starts
+    """
+    new = np.ones(len(x0), dtype=bool)
+    new[1:] = (x0[1:] != x1[:-1]) | (y0[1:] != y1[:-1])
+    # every segment adds its end point, a new polyline its start point too
+    end = np.arange(len(x0)) + np.cumsum(new)
+    start = end[new] - 1
+    points = np.empty((len(x0) + len(start), 2), dtype=np.float32)
+    starts = np.zeros(len(points), dtype=bool)
+    points[end, 0] = x1
+    points[end, 1] = y1
+    points[start, 0] = x0[new]
+    points[start, 1] = y0[new]
+    starts[start] = True
+    return points, starts
+
+
+def decimate(points, starts, cell):
+    """
+    Drop the points falling in the same cell of a grid of the given size
+    as the previous one, the ends of the polylines are kept
+    """
+    if not len(points):
+        return points, starts
+    grid = np.floor(points / cell).astype(np.int64)
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = (grid[1:] != grid[:-1]).any(axis=1)
+    keep |= starts
+    keep[:-1] |= starts[1:]
+    keep[-1] = True
+    return points[keep], starts[keep]
+
+
+class Toolpath():
+    """
+    Extruding moves of a G-code grouped by layer, for the preview.
+
+    load() parses the file in batches, usually in its own thread, while the
+    layers already parsed can be drawn. Big files are sampled first, so
+    that a coarse preview of all the layers is available in a fraction of a
+    second; each sampled layer is replaced by the real one as soon as the
+    parsing reaches it. The decimated layers are cached.
+    """
+
+    def __init__(self):
+        self.progress = 0.0
+        self.done = False
+        # incremented at every change, to know when to redraw
+        self.revision = 0
+        self.bounds = None
+        # highest layer parsed completely
+        self.frontier = -math.inf
+        self._layers = {}
+        self._sampled = {}
+        self._cache = {}
+        self._do_stop = False
+        self._lock = threading.Lock()
+
+    def stop(self):
+        self._do_stop = True
+
+    def layers(self):
+        """
+        Heights of the layers parsed or sampled so far, sorted
+        """
+        with self._lock:
+            return sorted(set(self._layers).union(
+                z for z in self._sampled if z > self.frontier
+            ))
+
+    def path(self, z, cell=0):
+        """
+        Points of the layer at height z decimated on the largest grid not
+        bigger than cell, with the start flags of the polylines (see
+        polylines). Returns the level of detail used too.
+        """
+        level = max([0] + [i for i, val in enumerate(LOD_CELLS)
+                           if val <= cell])
+        with self._lock:
+            try:
+                return self._cache[(z, level)] + (level,)
+            except KeyError:
+                pass
+            chunks = self._layers.get(z) or self._sampled.get(z, [])
+            chunks = list(chunks)
+        if not chunks:
+            points = np.empty((0, 2), dtype=np.float32)
+            starts = np.empty(0, dtype=bool)
+        else:
+            points = np.concatenate([chunk[0] for chunk in chunks])
+            starts = np.concatenate([chunk[1] for chunk in chunks])
+        points, starts = decimate(points, starts, LOD_CELLS[level])
+        with self._lock:
+            self._cache[(z, level)] = (points, starts)
+        return points, starts, level
+
+    def load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if len(data) > SAMPLE_THRESHOLD:
+                    self._sample(data)
+                if self._parse(data):
+                    with self._lock:
+                        self._sampled.clear()
+            finally:
+                try:
+                    data.close()
+                except BufferError:
+                    # still referenced by an array, released with it
+                    pass
+        finally:
+            # even if the file cannot be parsed, the view stops waiting
+            with self._lock:
+                self.done = True
+                self.revision += 1
+
+    def _parse(self, data):
+        def progress(parsed):
+            self.progress = parsed / len(data)
+
+        for types, pos in iterrows(data, progress=progress):
+            if self._do_stop:
+                return False
+            self._add(*extrusions(types, pos))
+        return True
+
+    def _sample(self, data):
+        # the extruder mode is set once at the beginning of the file
+        head = data[:SAMPLE_SIZE]
+        relative = head.rfind(b'M83') > head.rfind(b'M82')
+        for i in range(1, SAMPLES):
+            if self._do_stop:
+                return
+            off = data.find(b'\n', len(data) * i // SAMPLES) + 1
+            if off <= 0:
+                break
+            height = self._lastheight(data, off)
+            if height is None:
+                continue
+            prelude = b'M83\n' if relative else b''
+            prelude += b'G92 Z' + height + b'\n'
+            window = prelude + data[off:off+SAMPLE_SIZE]
+            for types, pos in iterrows(window):
+                # the first move starts from an unknown point
+                x0, y0, x1, y1, z = extrusions(types, pos)
+                self._add(x0[1:], y0[1:], x1[1:], y1[1:], z[1:], True)
+
+    @staticmethod
+    def _lastheight(data, off, limit=16*SAMPLE_SIZE):
+        """
+        Value of the last Z word before off, as bytes, looking back at
+        most limit bytes
+        """
+        end = off
+        while end > max(1, off - limit):
+            pos = data.rfind(b'Z', max(1, off - limit), end)
+            if pos < 0:
+                return None
+            match = re.match(rb'[ \t0-9.]Z([-+]?\d*\.?\d+)',
+                             data[pos-1:pos+64])
+            if match:
+                return match[1]
+            end = pos
+        return None
+
+    def _add(self, x0, y0, x1, y1, z, sampled=False):
+        if not len(z):
+            return
+        z = np.round(z, 2)
+        order = np.argsort(z, kind='stable')
+        z = z[order]
+        heights, first = np.unique(z, return_index=True)
+        bounds = (
+            float(min(x0.min(), x1.min())), float(min(y0.min(), y1.min())),
+            float(max(x0.max(), x1.max())), float(max(y0.max(), y1.max()))
+        )
+        layers = []
+        for height, begin, end in zip(heights, first,
+                                      list(first[1:]) + [len(z)]):
+            idx = order[begin:end]
+            layers.append((float(height), polylines(
+                x0[idx], y0[idx], x1[idx], y1[idx]
+            )))
+        with self._lock:
+            target = self._sampled if sampled else self._layers
+            for height, chunk in layers:
+                target.setdefault(height, []).append(chunk)
+                for level in range(len(LOD_CELLS)):
+                    self._cache.pop((height, level), None)
+            if not sampled:
+                # the layers below the last one are complete
+                self.frontier = max(self.frontier, float(heights[-1]))
+            if self.bounds is None:
+                self.bounds = bounds
+            else:
+                self.bounds = (
+                    min(self.bounds[0], bounds[0]),
+                    min(self.bounds[1], bounds[1]),
+                    max(self.bounds[2], bounds[2]),
+                    max(self.bounds[3], bounds[3]),
+                )
+            self.revision += 1
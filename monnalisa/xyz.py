@@ -3,17 +3,31 @@ ${LICENSE_HEADER}
 """
 
 import logging
+import logging.handlers
 import threading
 import socket
+import hashlib
+import base64
 import math
 import time
+import random
 import os
 import io
-import zipfile
+import mmap
+import json
+import itertools
+import queue
+import re
+import struct
 import zlib
-import serial
+import gzip
+import shutil
+import atexit
 
-from Crypto.Cipher import AES
+from array import array
+
+# pyserial, pycryptodome and the profilers are imported only when needed to
+# keep the startup of the headless server fast
 
 F_COLORS = {
     '0': "#CD7F32",
@@ -129,18 +143,136 @@ def filamentmaterial(val):
         return "PLA-Unk"
 
 
-class GuiLogger(logging.Handler):
+class ConversionStats():
+    """
+    Per-stage timings (in seconds) and byte counts of a gcode2www call
+    """
+
     def __init__(self):
+        self.timings = {}
+        self.sizes = {}
+        self._last = time.perf_counter()
+
+    def start(self):
+        self._last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0) + now - self._last
+        self._last = now
+
+    def total(self):
+        return sum(self.timings.values())
+
+    def __str__(self):
+        stages = ', '.join(
+            f'{k}={v*1000:.1f}ms' for k, v in self.timings.items()
+        )
+        sizes = ', '.join(f'{k}={v}B' for k, v in self.sizes.items())
+        return f'{stages} (total={self.total()*1000:.1f}ms); {sizes}'
+
+
+def profilecall(mode, func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) under cProfile or tracemalloc (according to
+    mode) and log the resulting report.
+    """
+    if mode == 'cprofile':
+        import cProfile
+        import pstats
+        prof = cProfile.Profile()
+        result = prof.runcall(func, *args, **kwargs)
+        report = io.StringIO()
+        pstats.Stats(prof, stream=report).sort_stats(
+            'cumulative'
+        ).print_stats(25)
+        logging.info("cProfile report for %s:\n%s",
+                     func.__name__, report.getvalue())
+    elif mode == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            result = func(*args, **kwargs)
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        report = '\n'.join(
+            str(stat) for stat in snapshot.statistics('lineno')[:25]
+        )
+        logging.info("tracemalloc report for %s (current=%dB, peak=%dB):\n%s",
+                     func.__name__, current, peak, report)
+    else:
+        result = func(*args, **kwargs)
+    return result
+
+
+class GuiLogger(logging.Handler):
+    def __init__(self, write=None):
         super().__init__()
         self.edit = None
+        # called with the formatted records instead of edit.append, for
+        # widgets that must only be updated by their own thread
+        self.write = write
 
     def emit(self, record):
-        if self.edit:
+        if self.write:
+            self.write(self.format(record))
+        elif self.edit:
             self.edit.append(self.format(record))
         else:
             print(self.format(record))
 
 
+class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler that gzips the files it rotates: path.1.gz,
+    path.2.gz and so on
+    """
+
+    def __init__(self, path, max_bytes=1 << 22, backups=5):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        super().__init__(path, maxBytes=max_bytes, backupCount=backups,
+                         delay=True)
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self._compress
+
+    @staticmethod
+    def _compress(source, dest):
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # the queue does not leave the process, the records are formatted by
+    # the listener instead of the thread that logs them
+    def prepare(self, record):
+        return record
+
+
+def startlogging(handlers, level=logging.INFO):
+    """
+    Send the records of the root logger through a queue to handlers, that
+    format and write them in a background thread so that logging never
+    blocks the printer I/O. The handlers already attached to the root
+    logger are moved to the background thread too. Returns the
+    QueueListener, the records left in the queue are written at exit.
+    """
+    root = logging.getLogger()
+    handlers = list(handlers) + root.handlers
+    records = queue.SimpleQueue()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(records))
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(records, *handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
 def socketmsg(data):
     msg = SocketPort.PACKET_START
     msg += data + b'\n'
@@ -159,12 +291,154 @@ def _parsemsg(msg):
     return data
 
 
+class MessageCodec():
+    """
+    Framing of the messages exchanged between monnalisa-server and its
+    clients, with optional streaming compression.
+
+    Once compression is enabled, the messages of at least min_size bytes
+    are sent through a single zlib stream, flushed after each message, so
+    that the short and repetitive status messages compress well too; the
+    others bypass it. The receiving side always understands both kinds of
+    packets.
+    """
+
+    ZPACKET_START = b'<zmsg>'
+    # the shorter messages (ok, d:0,0,0...) still shrink a few bytes but
+    # they are the most frequent ones, skipping them halves the time spent
+    # compressing the status traffic
+    MIN_SIZE = 16
+
+    def __init__(self, level=6, min_size=MIN_SIZE):
+        self.compress = False
+        self.min_size = min_size
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self._compressor = zlib.compressobj(level)
+        self._decompressor = zlib.decompressobj()
+        self._lock = threading.Lock()
+
+    def ratio(self):
+        """
+        Bytes sent on the wire over bytes of the messages
+        """
+        return self.sent_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+    def encode(self, data):
+        if self.compress and len(data) >= self.min_size:
+            payload = self._compressor.compress(data)
+            payload += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            packet = self.ZPACKET_START
+            packet += len(payload).to_bytes(4, 'big') + payload
+        else:
+            packet = socketmsg(data)
+        self.raw_bytes += len(data)
+        self.sent_bytes += len(packet)
+        return packet
+
+    def send(self, sock, data):
+        # the packets must be sent in the same order they are compressed
+        with self._lock:
+            sock.sendall(self.encode(data))
+
+    def decode(self, buff):
+        """
+        Extract the complete messages from buff, returns them and the
+        remaining bytes.
+        """
+        messages = []
+        while True:
+            start = buff.find(SocketPort.PACKET_START)
+            zstart = buff.find(self.ZPACKET_START)
+            if start < 0 and zstart < 0:
+                return messages, buff[-len(self.ZPACKET_START):]
+            if start < 0 or 0 <= zstart < start:
+                off = zstart + len(self.ZPACKET_START)
+                if len(buff) < off + 4:
+                    return messages, buff[zstart:]
+                size = int.from_bytes(buff[off:off+4], 'big')
+                if len(buff) < off + 4 + size:
+                    return messages, buff[zstart:]
+                messages.append(
+                    self._decompressor.decompress(buff[off+4:off+4+size])
+                )
+                buff = buff[off+4+size:]
+            else:
+                off = start + len(SocketPort.PACKET_START)
+                end = buff.find(SocketPort.PACKET_END, off)
+                if end < 0:
+                    return messages, buff[start:]
+                messages.append(_parsemsg(buff[off:end]))
+                buff = buff[end+len(SocketPort.PACKET_END):]
+
+
+class WireRecorder():
+    """
+    Records the bytes exchanged with a printer or a server, with their
+    monotonic time, to be played back by monnalisa-replay.
+
+    The file starts with MAGIC, followed by records made of a header
+    (seconds from the start as a double, kind, data length) and the data.
+    OPEN and EVENT records contain a JSON object. On a SocketPort the data
+    is received as it arrives on the socket, before the framing is removed,
+    and recorded as sent before it is framed.
+    """
+
+    MAGIC = b'MNLWIRE1'
+    RECV, SENT, OPEN, EVENT = range(4)
+    HEADER = struct.Struct('<dBI')
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(self.MAGIC)
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, kind, data):
+        with self._lock:
+            if self.file.closed:
+                return
+            self.file.write(self.HEADER.pack(
+                time.monotonic() - self.start, kind, len(data)
+            ))
+            self.file.write(data)
+
+    def event(self, kind, **args):
+        self.record(kind, json.dumps(args).encode())
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+
+def readrecording(path):
+    """
+    Iterate over the (time, kind, data) records of a WireRecorder file
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(WireRecorder.MAGIC)) != WireRecorder.MAGIC:
+            raise ValueError(f"{path} is not a wire recording")
+        header = WireRecorder.HEADER
+        while True:
+            head = f.read(header.size)
+            if len(head) < header.size:
+                return
+            stamp, kind, size = header.unpack(head)
+            data = f.read(size)
+            if len(data) < size:
+                # the recording was interrupted
+                return
+            yield stamp, kind, data
+
+
 class SocketPort():
 
     PACKET_START = b'<msg>'
     PACKET_END = b'</msg>'
 
-    def __init__(self, url, timeout=1):
+    def __init__(self, url, timeout=1, compress=False, recorder=None,
+                 sock=None):
         super().__init__()
         info = url.split(':')
         self.addr = info[0]
@@ -172,23 +446,55 @@ class SocketPort():
         self.is_open = False
         self._do_stop = False
         self.timeout = timeout
+        self.recorder = recorder
         self._lock = threading.Lock()
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # a connected socket can be given, e.g. to replay a recording
+        self.socket = sock
         self.buffer = b''
         self._rawbuff = b''
+        self.codec = MessageCodec()
+        # True once the server has answered the hello
+        self.extended = False
         try:
             self.port = int(info[1])
         except (IndexError, ValueError):
             pass
 
         logging.info("server on %s %d", self.addr, self.port)
-        self.socket.connect((self.addr, self.port))
-        self.socket.settimeout(timeout)
+        if self.socket is None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.settimeout(timeout)
+            try:
+                self.socket.connect((self.addr, self.port))
+            except OSError:
+                self.socket.close()
+                raise
+        else:
+            self.socket.settimeout(timeout)
         self.is_open = True
+        if recorder:
+            recorder.event(WireRecorder.OPEN, type='socket', url=url,
+                           compress=compress)
+        if compress:
+            # a monnalisa-server answers with its own hello, but the older
+            # ones forward the messages they do not know to the printer:
+            # the hello is sent only if asked for
+            self.write(b'hello:{"compress":"deflate"}')
 
     def __del__(self):
         self.close()
 
+    def read(self):
+        """
+        Return the data received so far, waiting up to timeout if there is
+        none
+        """
+        if not self.buffer:
+            self.run()
+        data = self.buffer
+        self.buffer = b''
+        return data
+
     def readline(self):
         stme = time.time()
         while b'\n' not in self.buffer:
@@ -202,39 +508,508 @@ class SocketPort():
         return line
 
     def run(self):
-        self._rawbuff = b''
         try:
-            self._rawbuff += self.socket.recv(4096)
-        except (socket.timeout, OSError):
-            pass
-
-        msg_start = self._rawbuff.find(self.PACKET_START)
-        while msg_start >= 0:
-            msg_start += len(self.PACKET_START)
-            msg_end = self._rawbuff.find(self.PACKET_END, msg_start+1)
-            if msg_end < 0:
-                return
-
-            self.buffer += _parsemsg(self._rawbuff[msg_start:msg_end])
-            self._rawbuff = self._rawbuff[msg_end+len(self.PACKET_END):]
-            msg_start = self._rawbuff.find(self.PACKET_START)
+            data = self.socket.recv(65536)
+        except socket.timeout:
+            return
+        except OSError:
+            self.is_open = False
+            raise
+        if not data:
+            self.is_open = False
+            raise ConnectionError("connection closed by the server")
+        if self.recorder:
+            self.recorder.record(WireRecorder.RECV, data)
+        self._rawbuff += data
+
+        messages, self._rawbuff = self.codec.decode(self._rawbuff)
+        for message in messages:
+            if message.startswith(b'hello:'):
+                hello = json.loads(message[6:])
+                self.extended = True
+                self.codec.compress = hello.get('compress') == 'deflate'
+                self.codec.min_size = hello.get('min_size',
+                                                MessageCodec.MIN_SIZE)
+                logging.info("Link compression: %s", self.codec.compress)
+            else:
+                self.buffer += message
 
     def write(self, data):
         if not self.socket or not self.is_open:
             return False
-        self._lock.acquire()
-        if self.socket and self.is_open:
-            try:
-                self.socket.sendall(socketmsg(data))
-            except BrokenPipeError:
-                self._do_stop = True
-        self._lock.release()
+        size = len(data)
+        with self._lock:
+            if self.socket and self.is_open:
+                try:
+                    if self.recorder:
+                        self.recorder.record(WireRecorder.SENT, data)
+                    self.socket.sendall(self.codec.encode(data))
+                except OSError as exc:
+                    logging.error("Cannot write to the server: %s", exc)
+                    self.is_open = False
+                    return False
+        return size
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+        self.socket.settimeout(timeout)
 
     def close(self):
         self.is_open = False
+        try:
+            # wakes up a thread blocked in recv
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.socket.close()
 
 
+class RingBuffer():
+    """
+    Circular buffer of records made of float32 fields, each field is stored
+    in its own array
+    """
+
+    def __init__(self, fields, capacity):
+        self.capacity = capacity
+        self.count = 0
+        self.arrays = [
+            array('f', bytes(4 * capacity)) for _ in range(fields)
+        ]
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, *values):
+        index = self.count % self.capacity
+        for arr, val in zip(self.arrays, values):
+            arr[index] = val
+        self.count += 1
+
+    def rows(self):
+        """
+        Records from the oldest to the newest
+        """
+        start = self.count - len(self)
+        for i in range(start, self.count):
+            index = i % self.capacity
+            yield tuple(arr[index] for arr in self.arrays)
+
+    def nbytes(self):
+        return sum(arr.itemsize * len(arr) for arr in self.arrays)
+
+
+class TelemetryChannel():
+
+    def __init__(self, capacity, tiers):
+        self.tiers = tiers
+        self.samples = RingBuffer(2, capacity)
+        self.buckets = [RingBuffer(4, size) for width, size in tiers]
+        # bucket being filled for each tier:
+        # [slot, time of the first sample, min, max, sum, count]
+        self.current = [None] * len(tiers)
+
+    def add(self, t, value):
+        self.samples.append(t, value)
+        for i, (width, size) in enumerate(self.tiers):
+            slot = t // width
+            bucket = self.current[i]
+            if bucket is not None and bucket[0] != slot:
+                self.buckets[i].append(bucket[1], bucket[2], bucket[3],
+                                       bucket[4] / bucket[5])
+                bucket = None
+            if bucket is None:
+                bucket = [slot, t, value, value, 0.0, 0]
+                self.current[i] = bucket
+            bucket[2] = min(bucket[2], value)
+            bucket[3] = max(bucket[3], value)
+            bucket[4] += value
+            bucket[5] += 1
+
+    def history(self, since):
+        """
+        Rows of (time, min, max, mean) after since, using the finest
+        resolution available for each period
+        """
+        samples = list(self.samples.rows())
+        oldest = samples[0][0] if samples else math.inf
+        rows = [(t, v, v, v) for t, v in samples if t >= since]
+        for ring in self.buckets:
+            older = [row for row in ring.rows() if since <= row[0] < oldest]
+            if older:
+                rows = older + rows
+                oldest = older[0][0]
+        return rows
+
+    def nbytes(self):
+        return self.samples.nbytes() + sum(
+            ring.nbytes() for ring in self.buckets
+        )
+
+
+class Telemetry():
+    """
+    History of the values reported by a printer: temperatures, progress and
+    remaining filament.
+
+    The last samples are kept as they are, older values only as min, max
+    and mean over buckets of 1 and 10 minutes, so that the status of a 48
+    hours print fits in a few hundred kB. Times are stored in float32 as
+    seconds from the creation of the store.
+    """
+
+    # (bucket width in seconds, number of buckets)
+    TIERS = ((60, 2880), (600, 1008))
+
+    def __init__(self, capacity=2048, tiers=TIERS):
+        self.start = time.time()
+        self.capacity = capacity
+        self.tiers = tiers
+        self.channels = {}
+        # incremented at every change, to know when to redraw a chart
+        self.revision = 0
+        self._lock = threading.Lock()
+
+    def add(self, name, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            try:
+                channel = self.channels[name]
+            except KeyError:
+                channel = TelemetryChannel(self.capacity, self.tiers)
+                self.channels[name] = channel
+            channel.add(timestamp - self.start, value)
+            self.revision += 1
+
+    def history(self, name, since=None):
+        """
+        List of [timestamp, min, max, mean] for the channel name
+        """
+        since = -math.inf if since is None else since - self.start
+        with self._lock:
+            try:
+                rows = self.channels[name].history(since)
+            except KeyError:
+                return []
+        return [
+            [round(self.start + row[0], 1)] + [round(v, 2) for v in row[1:]]
+            for row in rows
+        ]
+
+    def todict(self, names=None, since=None):
+        if names is None:
+            with self._lock:
+                names = list(self.channels)
+        return {name: self.history(name, since) for name in names}
+
+    def load(self, history):
+        """
+        Merge the history of another store, as returned by todict
+        """
+        merged = {}
+        for name, rows in history.items():
+            own = self.history(name)
+            rows = sorted(own + [list(row) for row in rows])
+            merged[name] = rows
+        with self._lock:
+            for name, rows in merged.items():
+                channel = TelemetryChannel(self.capacity, self.tiers)
+                last = None
+                for row in rows:
+                    if row[0] != last:
+                        channel.add(row[0] - self.start, row[3])
+                    last = row[0]
+                self.channels[name] = channel
+            self.revision += 1
+
+    def parsestatus(self, msg, timestamp=None):
+        """
+        Store the values of a status message of the printer
+        """
+        key = msg[:1]
+        try:
+            vals = msg[2:].decode().strip().split(',')
+            if key == b't':
+                # n,temp1,target1[,temp2,target2]
+                for i in range(int(vals[0])):
+                    self.add(f'temp{i+1}', float(vals[1 + 2*i]), timestamp)
+                    self.add(f'target{i+1}', float(vals[2 + 2*i]), timestamp)
+            elif key == b'd':
+                # progress,elapsed,remaining
+                self.add('progress', float(vals[0]), timestamp)
+            elif key == b'f':
+                # n,len1[,len2] remaining filament in mm
+                for i in range(int(vals[0])):
+                    self.add(f'filament{i+1}', float(vals[1 + i]) / 1000,
+                             timestamp)
+        except (ValueError, IndexError, UnicodeDecodeError):
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("Invalid status message %s", msg)
+
+    def nbytes(self):
+        with self._lock:
+            return sum(ch.nbytes() for ch in self.channels.values())
+
+
+class LineWaiter():
+    """
+    Receives the lines matching match from a PrinterLink while it is
+    registered, use it as a context manager
+    """
+
+    def __init__(self, link, match):
+        self.link = link
+        self.match = match
+        self.lines = queue.Queue()
+
+    def __enter__(self):
+        self.link.addwaiter(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.link.removewaiter(self)
+
+    def get(self, timeout=None):
+        """
+        Next matching line, None on timeout or if the link is closed
+        """
+        try:
+            return self.lines.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class PrinterLink(threading.Thread):
+    """
+    Full duplex transport on a serial.Serial or a SocketPort.
+
+    A reader thread receives everything the printer sends, in chunks as
+    large as available, splits it in lines and routes each line to the
+    first LineWaiter matching it or, if none does, to on_message. Writes
+    are serialized by a lock and never wait for the reader.
+    """
+
+    # seconds a read can wait on a socket, writes on the same socket fail
+    # after as long
+    IDLE_TIMEOUT = 30
+
+    def __init__(self, port, on_message, on_error, recorder=None):
+        super().__init__(daemon=True)
+        self.port = port
+        self.recorder = recorder
+        # the reader sleeps until data arrives, stop() interrupts it
+        if isinstance(port, SocketPort):
+            port.settimeout(self.IDLE_TIMEOUT)
+        elif hasattr(port, 'cancel_read'):
+            port.timeout = None
+        self.on_message = on_message
+        self.on_error = on_error
+        self._do_stop = False
+        self._waiters = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.start()
+
+    @property
+    def is_open(self):
+        return self.port.is_open and not self._do_stop
+
+    def stop(self):
+        self._do_stop = True
+        if hasattr(self.port, 'cancel_read'):
+            self.port.cancel_read()
+        self.port.close()
+        self._wakewaiters()
+
+    def expect(self, match):
+        return LineWaiter(self, match)
+
+    def addwaiter(self, waiter):
+        with self._lock:
+            self._waiters.append(waiter)
+
+    def removewaiter(self, waiter):
+        with self._lock:
+            self._waiters.remove(waiter)
+
+    def write(self, data):
+        with self._write_lock:
+            if self.recorder:
+                self.recorder.record(WireRecorder.SENT, data)
+            try:
+                return self.port.write(data)
+            except TypeError as exc:
+                # pyserial raises TypeError if the port is closed while
+                # writing
+                raise OSError(exc) from exc
+
+    def _read(self):
+        if isinstance(self.port, SocketPort):
+            return self.port.read()
+        # wait for the first byte, then take everything already received
+        data = self.port.read(max(1, self.port.in_waiting))
+        if data and self.recorder:
+            self.recorder.record(WireRecorder.RECV, data)
+        return data
+
+    def _route(self, line):
+        with self._lock:
+            for waiter in self._waiters:
+                if waiter.match(line):
+                    waiter.lines.put(line)
+                    return
+        self.on_message(line)
+
+    def _wakewaiters(self):
+        with self._lock:
+            for waiter in self._waiters:
+                waiter.lines.put(None)
+
+    def run(self):
+        buff = b''
+        while not self._do_stop:
+            try:
+                data = self._read()
+            except (OSError, TypeError, ValueError) as exc:
+                # pyserial raises TypeError if the port is closed while
+                # it is reading
+                if not self._do_stop:
+                    self._wakewaiters()
+                    self.on_error(exc)
+                return
+            if not data:
+                continue
+            buff += data
+            lines = buff.split(b'\n')
+            buff = lines.pop()
+            for line in lines:
+                self._route(line + b'\n')
+
+
+def _writejson(path, state):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def filedigest(path):
+    """
+    sha256 of the content of a file, as an hex string
+    """
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class CapabilityCache():
+    """
+    Capabilities of the printers seen so far, saved in a JSON file, so that
+    the 3w format of a printer is known as soon as its port opens instead
+    of after the first status replies.
+
+    Printers are identified by serial number or, if they don't report it,
+    by machine id. The cache also remembers the printer last seen on each
+    port.
+    """
+
+    KEYS = ('serial', 'id', 'name', 'version', 'zipped', 'block_size',
+            'autoleveling')
+
+    def __init__(self, path):
+        self.path = path
+        self.ports = {}
+        self.printers = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                state = json.load(f)
+            self.ports = dict(state['ports'])
+            self.printers = dict(state['printers'])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            logging.error("Cannot load the capability cache: %s", exc)
+
+    def lookup(self, port):
+        """
+        Capabilities of the printer last seen on port, None if unknown
+        """
+        with self._lock:
+            caps = self.printers.get(self.ports.get(port))
+            return dict(caps) if caps else None
+
+    def update(self, port, caps):
+        ident = caps.get('serial') or caps.get('id')
+        if not ident:
+            return
+        caps = {key: caps.get(key) for key in self.KEYS}
+        with self._lock:
+            if (self.ports.get(port) == ident and
+                    self.printers.get(ident) == caps):
+                return
+            self.ports[port] = ident
+            self.printers[ident] = caps
+            state = {'ports': self.ports, 'printers': self.printers}
+            try:
+                _writejson(self.path, state)
+            except OSError as exc:
+                logging.error("Cannot save the capability cache: %s", exc)
+
+
+class SDCardIndex():
+    """
+    The files saved on the SD card of each printer, by the sha256 of the
+    file that was sent to be printed, saved in a JSON file.
+
+    Printers are identified as in CapabilityCache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.printers = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                self.printers = dict(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as exc:
+            logging.error("Cannot load the SD card index: %s", exc)
+
+    def lookup(self, printer, digest):
+        """
+        Name of the file with the given hash on the card of printer, None
+        if it is not there
+        """
+        with self._lock:
+            entry = self.printers.get(printer, {}).get(digest)
+        return entry['name'] if entry else None
+
+    def add(self, printer, digest, name, size):
+        with self._lock:
+            self.printers.setdefault(printer, {})[digest] = {
+                'name': name,
+                'size': size,
+                'time': time.time(),
+            }
+            self._save()
+
+    def remove(self, printer, digest):
+        with self._lock:
+            if self.printers.get(printer, {}).pop(digest, None):
+                self._save()
+
+    def _save(self):
+        try:
+            _writejson(self.path, self.printers)
+        except OSError as exc:
+            logging.error("Cannot save the SD card index: %s", exc)
+
+
 class XYZPrinter(threading.Thread):
     """
     Abstraction layer that communicates with printer hardware
@@ -244,25 +1019,101 @@ class XYZPrinter(threading.Thread):
         'home', 'load', 'unload', 'calibratejr', 'upload', 'image'
     ]
 
+    # priorities of the queued commands, the lower is sent first
+    EMERGENCY, INTERACTIVE, UPLOAD, POLL = range(4)
+
+    # stops the print, or the upload in progress
+    PRINT_CANCEL = b'XYZv3/config=print[cancel]'
+
+    # capabilities assumed until the printer reports its own
+    DEFAULT_CAPABILITIES = {
+        'serial': "",
+        'id': "",
+        'name': "",
+        'version': 2,
+        'zipped': False,
+        'block_size': None,
+        'autoleveling': None,
+    }
+
     def __init__(self):
         super().__init__()
         self.port = None
+        self.link = None
+        # a WireRecorder, see record()
+        self.recorder = None
         self._do_stop = False
         self._stopped = False
         self._upload = None
+        self._upload_digest = None
+        # save the uploaded files on the SD card and record them in sdcard,
+        # an SDCardIndex. They are uploaded again anyway: no command to
+        # print a saved file is known to work on every firmware
+        self.savetosd = False
+        self.sdcard = None
         self.block_size = None
         self.autoleveling = None
         self._print_status = None
         self.name = ""
         self.id = ""
+        self.serial = ""
         self.zipped = False
         self.version = 2
+        # a CapabilityCache, the capabilities in use come from it
+        # ('cache') or from the status replies of the printer ('printer')
+        self.capabilities = None
+        self.caps_source = None
+        self._port_name = None
+        self._opened = 0
+        self.profile = None
+        # deflate level for zipped files: an int or 'auto' to choose it
+        # from the speed measured during the previous uploads
+        self.compression = 'auto'
+        self.link_speed = None
+        self.minify = False
+        # greet a monnalisa-server to compress the link and let it upload
+        # the files on its own; off by default since the older servers send
+        # the messages they do not know to the printer as they are
+        self.server_extensions = False
+        self.offload = True
+        # last status message received for each key, kept across reconnections
+        self.status = {}
+        self.telemetry = Telemetry()
+        # seconds between two status queries
+        self.poll_interval = 3
+        # seconds to wait for the printer to acknowledge an upload block
+        self.ack_timeout = 3
+        # seconds an uploaded file has to start printing, then the printer
+        # is considered ready again and the print failed
+        self.print_start_timeout = 60
+        self._uploaded_at = 0
+        self._wakeup = threading.Event()
+        self._last_poll = 0
+        self._telemetry_pending = False
+        self._commands = queue.PriorityQueue()
+        self._command_seq = itertools.count()
+        # seconds a queued command stays valid, the ones queued while the
+        # link is down are dropped instead of being sent when it is back
+        self.command_timeout = 10
+        self.reconnect_delay = 0.25
+        self.reconnect_max_delay = 5.0
+        self._connect_args = None
+        self._reconnect_attempts = 0
         self.start()
 
     def stop(self):
         self._do_stop = True
         self.disconnect()
         # self.join()
+        self._wakeup.set()
+        if self.recorder:
+            self.recorder.close()
+
+    def record(self, path):
+        """
+        Record the bytes exchanged on the links opened from now on
+        """
+        self.recorder = WireRecorder(path)
 
     def setid(self, uid):
         try:
@@ -275,147 +1126,593 @@ class XYZPrinter(threading.Thread):
             self.zipped = specs[1]
 
     def connect(self, port, baud=9600, **args) -> bool:
+        if not self._openport(port, baud, **args):
+            return False
+        # from now on the link is reopened automatically if it drops
+        self._connect_args = (port, baud, args)
+        self._reconnect_attempts = 0
+
+        # unknown until the printer reports its status
+        self._print_status = None
+        return True
+
+    def _openport(self, port, baud, **args):
+        import serial
         try:
             logging.info(f"Conneting to %s@%d...", port, baud)
             if os.path.exists(port):
-                self.port = serial.Serial(port, baud, **args)
+                new_port = serial.Serial(port, baud, **args)
+                if self.recorder:
+                    self.recorder.event(WireRecorder.OPEN, type='serial',
+                                        port=port, baud=baud)
             else:
-                self.port = SocketPort(port, **args)
-        except (
-            serial.SerialException, socket.gaierror,
-            ConnectionRefusedError
-        ) as exc:
+                new_port = SocketPort(port, recorder=self.recorder,
+                                      compress=self.server_extensions,
+                                      **args)
+        except (OSError, ValueError, serial.SerialException) as exc:
             logging.error("Connetion failed on %s: %s", port, exc)
-            self.port = None
             return False
         logging.info("Connected")
-
-        self._print_status = 'ready'
+        self._port_name = port
+        self.attach(new_port)
+        self._loadcapabilities()
         return True
 
+    def attach(self, port):
+        """
+        Communicate through an already open port, a serial.Serial or a
+        SocketPort. It is not reopened if the connection drops.
+        """
+        self.port = port
+        self._opened = time.time()
+        # query the status right away, it carries the capabilities
+        self._last_poll = 0
+        # SocketPort records the raw data itself, before the framing
+        self.link = PrinterLink(
+            port, self._onmessage, self._linklost,
+            None if isinstance(port, SocketPort) else self.recorder
+        )
+        # fetch what the server recorded while we were not connected, once
+        # it has answered the hello: the older servers would forward the
+        # query to the printer
+        self._telemetry_pending = isinstance(port, SocketPort)
+        self._wakeup.set()
+
+    def _linklost(self, exc):
+        if self._connect_args is None:
+            # closed on purpose
+            return
+        logging.error("Connection with the printer lost: %s", exc)
+        try:
+            self.port.close()
+        except OSError:
+            pass
+        # an upload in progress fails on its own, since no ack arrives
+        self._wakeup.set()
+
+    def _reconnect(self):
+        """
+        Wait with exponential backoff and jitter, then try to open again the
+        port. Block size, machine id and the last status are kept, so the
+        printer is usable as soon as the link is back.
+        """
+        port, baud, args = self._connect_args
+        delay = self.reconnect_delay * 2 ** self._reconnect_attempts
+        delay = min(delay, self.reconnect_max_delay)
+        delay = random.uniform(delay / 2, delay)
+        # a missing serial device is looked for every 50 ms, a host:port
+        # only waits for the delay
+        polled = not isinstance(self.port, SocketPort) and (
+            not os.path.exists(port))
+        deadline = time.time() + delay
+        while time.time() < deadline:
+            if self._do_stop or self._connect_args is None:
+                return
+            if polled and os.path.exists(port):
+                # the serial device is back, don't wait any longer
+                break
+            # stop() and disconnect() set the event
+            wait = deadline - time.time()
+            if self._wakeup.wait(min(wait, 0.05) if polled else wait):
+                self._wakeup.clear()
+
+        if self._openport(port, baud, **args):
+            logging.info("Reconnected after %d attempts",
+                         self._reconnect_attempts + 1)
+            self._reconnect_attempts = 0
+            self.onstatuschange()
+        else:
+            self._reconnect_attempts += 1
+
+    def capabilitiesdict(self):
+        return {key: getattr(self, key) for key in CapabilityCache.KEYS}
+
+    def _loadcapabilities(self):
+        """
+        Use the capabilities cached for the printer last seen on the port,
+        until the printer confirms or contradicts them
+        """
+        self.caps_source = None
+        if self.capabilities is None:
+            return
+        caps = self.capabilities.lookup(self._port_name)
+        if not caps:
+            return
+        for key, val in caps.items():
+            setattr(self, key, val)
+        self.caps_source = 'cache'
+        logging.info("Using the cached capabilities of %s: 3w v%d%s",
+                     self.serial or self.id, self.version,
+                     ' zipped' if self.zipped else '')
+        # the print queue can convert the next jobs already
+        self.onstatuschange()
+
+    def _identify(self, key, value):
+        # key is 'id' or 'serial', the first one received validates the
+        # cached capabilities
+        if self.caps_source == 'cache' and getattr(self, key) not in ('',
+                                                                      value):
+            logging.warning("The printer on %s is %s, not %s as cached",
+                            self._port_name, value, getattr(self, key))
+            for attr, val in XYZPrinter.DEFAULT_CAPABILITIES.items():
+                setattr(self, attr, val)
+        if key == 'id':
+            self.setid(value)
+        else:
+            self.serial = value
+        changed = self.caps_source != 'printer'
+        self.caps_source = 'printer'
+        self._storecapabilities()
+        if changed:
+            self.onstatuschange()
+            # an upload waiting for the format can start
+            self._wakeup.set()
+
+    def _setoptions(self, options):
+        for option in options.split(','):
+            if option[:1] == 'p':
+                # block size in kB
+                b_size = int(option[1:])
+                self.block_size = b_size * 1024 if b_size > 0 else 0
+                logging.debug("Setting printer block size %d",
+                              self.block_size)
+            elif option[:1] == 'a':
+                self.autoleveling = option[1:2] == '+'
+        self._storecapabilities()
+
+    def _storecapabilities(self):
+        if self.capabilities is not None and self.caps_source == 'printer':
+            self.capabilities.update(self._port_name,
+                                     self.capabilitiesdict())
+
+    def formatknown(self):
+        """
+        Whether version, zipped and id can be trusted to convert a file
+        """
+        # a file in the wrong format could be rejected, uploads wait a
+        # little for the first status reply, the print queue converts
+        # with the cached format in the meantime
+        return (self.caps_source == 'printer' or
+                time.time() - self._opened >= self.ack_timeout)
+
     def sendAck(self, resp=b''):
         ack = b'ok:' + resp + b'\n'
-        self.port.write(ack)
+        self.write(ack)
 
     def disconnect(self):
-        if self.port:
+        self._connect_args = None
+        if self.link:
+            self.link.stop()
+        elif self.port:
             self.port.close()
+        self._wakeup.set()
+
+    def write(self, data):
+        if self.link and self.link.is_open:
+            try:
+                return self.link.write(data)
+            except OSError as exc:
+                logging.error("Cannot write to the printer: %s", exc)
+        return False
 
     def getprintstatus(self):
         return self._print_status if self._print_status else 'ready'
 
+    def compressionlevel(self, data):
+        if self.compression == 'auto':
+            return autolevel(data, self.link_speed)
+        return self.compression
+
+    def isuploading(self):
+        return self._upload is not None
+
+    def isidle(self):
+        return (
+            self.port is not None and self.port.is_open and
+            self._upload is None and self._print_status == 'ready'
+        )
+
     def query(self, stat='a'):
-        self.sendaction('a', func='query')
+        self.sendaction('a', func='query', priority=self.POLL)
 
     def print(self, val):
         self.sendaction(f'print[{val}]', func='config')
 
-    def sendFile(self, fname):
+    def sendFile(self, fname, digest=None):
+        """
+        Print the file fname. digest identifies its content on the SD card,
+        it is the sha256 of fname if not given, e.g. a job converted from a
+        G-code is identified by the hash of the G-code.
+        """
         self._upload = fname
+        self._upload_digest = digest
+        self._wakeup.set()
+
+    def sendaction(self, action, arg=None, func='action', priority=None):
+        if self.port and self.port.is_open:
+            self.sendcommand(self._actionmsg(action, arg, func), priority)
+
+    def sendcommand(self, data, priority=None):
+        """
+        Queue data for the printer. The printer thread sends the commands in
+        order of priority. During an upload only the emergency commands are
+        sent, between two blocks, and they abort it: the others wait for its
+        end, since their replies could be taken for block acknowledgements.
+        """
+        if priority is None:
+            priority = self.commandpriority(data)
+        self._commands.put(
+            (priority, next(self._command_seq), data, time.monotonic())
+        )
+        self._wakeup.set()
+
+    def commandpriority(self, data):
+        # load=...:cancel and unload=...:cancel only stop the filament motor
+        if data.strip() == self.PRINT_CANCEL:
+            return self.EMERGENCY
+        return self.INTERACTIVE
 
-    def sendaction(self, action, arg=None, func='action'):
+    def _actionmsg(self, action, arg=None, func='action'):
         msg = f'XYZv3/{func}'
         if action:
             msg += f'={action}'
             if arg:
                 msg += f':{arg}'
-        if self.port and self.port.is_open:
-            logging.debug("sending message: %s", msg)
-            self.port.write(msg.encode())
+        return msg.encode()
+
+    def _flushcommands(self, lowest=POLL):
+        """
+        Send the queued commands with a priority up to lowest, returns the
+        last emergency command sent or None
+        """
+        emergency = None
+        while True:
+            try:
+                command = self._commands.get_nowait()
+            except queue.Empty:
+                break
+            priority, seq, data, queued = command
+            if priority > lowest:
+                self._commands.put(command)
+                break
+            if time.monotonic() - queued > self.command_timeout:
+                logging.warning("Dropping the stale command %s", data)
+                continue
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("sending message: %s", data)
+            self.write(data)
+            if priority == self.EMERGENCY:
+                emergency = data
+        return emergency
+
+    def queuecommand(self, cmd, **args):
+        # only supported when connected to a monnalisa-server
+        args['cmd'] = cmd
+        self.write(b'queue:' + json.dumps(args).encode())
+
+    def querytelemetry(self, since=None, channels=None):
+        # only supported when connected to a monnalisa-server, the history
+        # is merged in self.telemetry when the reply arrives
+        args = {'since': since, 'channels': channels}
+        self.write(b'telemetry:' + json.dumps(args).encode())
 
     def message_callback(self, msg):
         # not implemented, please override
-        logging.debug("printer send: %s", msg)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("printer send: %s", msg)
+
+    def onstatuschange(self):
+        # not implemented, please override
+        pass
+
+    def _updatestatus(self, msg):
+        if msg.startswith(b'telemetry:'):
+            try:
+                self.telemetry.load(json.loads(msg[10:])['channels'])
+            except (ValueError, KeyError, TypeError) as exc:
+                logging.error("Invalid telemetry from the server: %s", exc)
+            return
+        if msg[1:2] == b':':
+            self.status[msg[:1]] = msg
+            self.telemetry.parsestatus(msg)
+            try:
+                if msg.startswith(b'p:'):
+                    self._identify('id', msg[2:].decode().strip())
+                elif msg.startswith(b'i:'):
+                    self._identify('serial', msg[2:].decode().strip())
+                elif msg.startswith(b'n:'):
+                    self.name = msg[2:].decode().strip()
+                elif msg.startswith(b'o:'):
+                    self._setoptions(msg[2:].decode().strip())
+            except (ValueError, UnicodeDecodeError):
+                logging.error("Invalid status message %s", msg)
+        if not msg.startswith(b'd:'):
+            return
+        old_status = self._print_status
+        if msg[2:].strip() == b'0,0,0':
+            if self._print_status != 'uploaded':
+                self._print_status = 'ready'
+            elif time.time() - self._uploaded_at > self.print_start_timeout:
+                logging.error("The printer did not start printing the "
+                              "uploaded file")
+                self._print_status = 'ready'
+        elif self._print_status != 'paused':
+            self._print_status = 'printing'
+        if self._print_status != old_status:
+            self.onstatuschange()
+
+    def _onmessage(self, msg):
+        # called by the reader thread of the link
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(msg)
+        self._updatestatus(msg)
+        self.message_callback(msg)
+
+    def _waitreply(self, replies, prefix, timeout=10):
+        """
+        Wait for a message starting with prefix from a monnalisa-server and
+        return its JSON content, replies is a LineWaiter for them.
+        """
+        res = replies.get(timeout)
+        if res is None:
+            return None
+        try:
+            reply = json.loads(res[len(prefix):])
+        except ValueError as exc:
+            logging.error("Invalid reply from the server: %s", exc)
+            return {'stat': 'error'}
+        if not isinstance(reply, dict):
+            logging.error("Invalid reply from the server: %s", reply)
+            return {'stat': 'error'}
+        return reply
+
+    def _offload(self, fname, chunk_size=0x10000):
+        """
+        Send a file to a monnalisa-server, only if it doesn't have it
+        already, and let it print the file. Returns False if the server
+        doesn't support it.
+        """
+        with open(fname, 'rb') as f:
+            fdata = f.read()
+        digest = hashlib.sha256(fdata).hexdigest()
+        with self.link.expect(lambda msg: msg.startswith(b'offload:')) as r:
+            self._sendoffload(cmd='query', hash=digest, size=len(fdata))
+            reply = self._waitreply(r, b'offload:')
+            if reply is None:
+                return False
+            if reply.get('stat') == 'need':
+                logging.info("Sending %s to the server...", fname)
+                self.message_callback(b'upload:{"stat":"start"}')
+                for off in range(0, len(fdata), chunk_size):
+                    self._sendoffload(
+                        cmd='data', hash=digest, size=len(fdata), offset=off,
+                        data=base64.b64encode(
+                            fdata[off:off+chunk_size]
+                        ).decode()
+                    )
+                    prog = 100 * min(off + chunk_size, len(fdata))
+                    prog /= len(fdata)
+                    msg = f'upload:{{"stat":"uploading","progress":{prog}}}'
+                    self.message_callback(msg.encode())
+                reply = self._waitreply(r, b'offload:', 60)
+                if reply is None or reply.get('stat') != 'stored':
+                    logging.error("Cannot send %s to the server", fname)
+                    self.message_callback(b'upload:{"stat":"complete"}')
+                    return True
+            elif reply.get('stat') == 'have':
+                logging.info("The server already has %s", fname)
+            else:
+                logging.error("The server cannot receive %s", fname)
+                self.message_callback(b'upload:{"stat":"complete"}')
+                return True
+            self._sendoffload(cmd='print', hash=digest)
+            reply = self._waitreply(r, b'offload:')
+        if reply is None or reply.get('stat') != 'queued':
+            logging.error("The server cannot print %s", fname)
+            self.message_callback(b'upload:{"stat":"complete"}')
+        return True
 
-    def _ack(self):
-        return self.port.readline().strip() == b'ok'
+    def _sendoffload(self, **args):
+        self.write(b'offload:' + json.dumps(args).encode())
 
     def run(self):
         self.stoped = False
-        retry = 0
+        self._retry = 0
         while not self._do_stop:
             if self.port and self.port.is_open:
-                res = self.port.readline()
-                if res:
-                    logging.debug(res)
-                    self.message_callback(res)
-                elif self._upload:
-                    try:
-                        with open(self._upload, 'rb') as f:
-                            fdata = f.read()
-                            print(fdata[0:10])
-                            if not fdata.startswith(b'3DPFNKG13WTW'):
-                                logging.info("Converting to 3w format...")
-                                fdata = gcode2www(
-                                    fdata.decode(),
-                                    self.version,
-                                    self.zipped,
-                                    self.id
-                                )
-                    except OSError as exc:
-                        logging.error("Cannot print file %s: %s",
-                                      self._upload, exc)
-                        self._upload = None
-                        continue
-                    else:
-                        flen = len(fdata)
-                    tosd = ''  # ',SaveToSD'
-                    self.sendaction(f'sample.3w,{flen}{tosd}', func='upload')
-                    time.sleep(0.1)
-                    if not self._ack():
-                        logging.error('Printing FAILED: initialization error')
-                        if retry == 0:
-                            logging.info('Retring...')
-
-                        if retry < 3:
-                            retry += 1
-                            logging.info(f'New attempt: {retry}')
-                            time.sleep(1)
-                        else:
-                            retry = 0
-                            self._upload = None
-                        continue
-                    else:
-                        self.message_callback(b'upload:{"stat":"start"}')
-
-                    block_size = self.block_size if self.block_size else 8192
-                    total_blocks = math.ceil(flen/block_size)
-                    for i in range(total_blocks):
-                        data = fdata[i*block_size:(i+1)*block_size]
-                        block = i.to_bytes(4, 'big')
-                        block += len(data).to_bytes(4, 'big')
-                        block += data
-                        block += bytes(4)
-                        prog = 100 * (i + 1) / total_blocks
-                        if self.port.write(block) != len(block):
-                            logging.error("Printing FAILED: "
-                                          "communication error")
-
-                        if not self._ack():
-                            logging.error("Printing FAILED: "
-                                          "cannot write data to the printer!")
-                            self._upload = None
-                            self.message_callback(
-                                b'upload:{"stat":"complete"}'
-                            )
-                            break
-                        msg = 'upload:{"stat":"uploading",'
-                        msg += f'"progress":{prog}}}'
-                        self.message_callback(msg.encode())
-
-                    while not self._ack():
-                        self.sendaction('', func='uploadDidFinish')
-                        time.sleep(0.1)
-                    self.message_callback(b'upload:{"stat":"complete"}')
-                    self._print_status = 'printing'
-                    self._upload = None
-                else:
-                    self.query()
-                    time.sleep(0.250)
+                try:
+                    self._poll()
+                except OSError as exc:
+                    self._linklost(exc)
+            elif self._connect_args is not None:
+                self._reconnect()
             else:
-                time.sleep(1)
+                # until connect() or stop()
+                self._wakeup.wait()
+                self._wakeup.clear()
         self.stoped = True
 
+    def _poll(self):
+        # the replies are handled by the reader thread of the link
+        self._wakeup.clear()
+        self._flushcommands()
+        if self._telemetry_pending and self.port.extended:
+            self._telemetry_pending = False
+            self.querytelemetry()
+        if self._upload and self.formatknown():
+            self._uploadfile()
+            return
+        wait = self._last_poll + self.poll_interval - time.time()
+        if self._upload:
+            wait = min(wait, self._opened + self.ack_timeout - time.time())
+        if wait <= 0:
+            self._last_poll = time.time()
+            self.query()
+            self._flushcommands()
+        else:
+            self._wakeup.wait(wait)
+
+    def _uploadfile(self):
+        if self.recorder:
+            self.recorder.event(WireRecorder.EVENT, upload=self._upload)
+        if (self.offload and isinstance(self.port, SocketPort) and
+                self.port.extended):
+            try:
+                offloaded = self._offload(self._upload)
+            except OSError as exc:
+                logging.error("Cannot print file %s: %s",
+                              self._upload, exc)
+                offloaded = True
+            if offloaded:
+                self._upload = None
+                return
+            logging.info("The server does not accept files, "
+                         "sending them block by block")
+            self.offload = False
+        # the files are saved on the SD card under their hash
+        digest = None
+        try:
+            if self.savetosd and self.sdcard is not None and (self.serial or
+                                                              self.id):
+                digest = self._upload_digest or filedigest(self._upload)
+            with open(self._upload, 'rb') as f:
+                # a 3w file is sent from the page cache, shared with the
+                # other printers uploading it at the same time
+                fdata = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if fdata[:12] != b'3DPFNKG13WTW':
+                logging.info("Converting to 3w format...")
+                with fdata:
+                    fdata = profilecall(
+                        self.profile,
+                        gcode2www,
+                        fdata[:].decode(),
+                        self.version,
+                        self.zipped,
+                        self.id,
+                        level=self.compressionlevel(fdata),
+                        minify=self.minify
+                    )
+        except (OSError, ValueError) as exc:
+            logging.error("Cannot print file %s: %s",
+                          self._upload, exc)
+            self._upload = None
+            return
+        name = f'{digest[:12]}.3w' if digest else 'sample.3w'
+        # the mapping is closed before the SD card index is updated
+        flen = len(fdata)
+        try:
+            with self.link.expect(lambda msg: msg.strip() == b'ok') as acks:
+                completed = self._sendfile(fdata, acks, name,
+                                           digest is not None)
+        finally:
+            if isinstance(fdata, mmap.mmap):
+                fdata.close()
+        if completed and digest:
+            self.sdcard.add(self.serial or self.id, digest, name, flen)
+
+    def _sendfile(self, fdata, acks, name='sample.3w', tosd=False):
+        """
+        Upload the 3w data block by block, acks is a LineWaiter for the
+        acknowledgements of the printer. Returns True if the upload
+        completed.
+        """
+        timeout = self.ack_timeout
+        flen = len(fdata)
+        tosd = ',SaveToSD' if tosd else ''
+        self.write(self._actionmsg(f'{name},{flen}{tosd}', func='upload'))
+        if acks.get(timeout) is None:
+            logging.error('Printing FAILED: initialization error')
+            if self._retry == 0:
+                logging.info('Retring...')
+
+            if self._retry < 3:
+                self._retry += 1
+                logging.info(f'New attempt: {self._retry}')
+                self._wakeup.wait(1)
+            else:
+                self._retry = 0
+                self._upload = None
+            return False
+        else:
+            self.message_callback(b'upload:{"stat":"start"}')
+
+        block_size = self.block_size if self.block_size else 8192
+        total_blocks = math.ceil(flen/block_size)
+        upload_start = time.perf_counter()
+        for i in range(total_blocks):
+            # an emergency command waits at most one block, the others the
+            # end of the upload: a plain ok would pass for an ack
+            emergency = self._flushcommands(self.EMERGENCY)
+            if emergency:
+                logging.info("Upload aborted")
+                if emergency.strip() != self.PRINT_CANCEL:
+                    # the printer would wait for the next block
+                    self.write(self.PRINT_CANCEL)
+                self._upload = None
+                self.message_callback(b'upload:{"stat":"complete"}')
+                return False
+            data = fdata[i*block_size:(i+1)*block_size]
+            block = i.to_bytes(4, 'big')
+            block += len(data).to_bytes(4, 'big')
+            block += data
+            block += bytes(4)
+            prog = 100 * (i + 1) / total_blocks
+            if self.write(block) != len(block):
+                logging.error("Printing FAILED: "
+                              "communication error")
+
+            if acks.get(timeout) is None:
+                logging.error("Printing FAILED: "
+                              "cannot write data to the printer!")
+                self.write(self.PRINT_CANCEL)
+                self._upload = None
+                self.message_callback(
+                    b'upload:{"stat":"complete"}'
+                )
+                return False
+            msg = 'upload:{"stat":"uploading",'
+            msg += f'"progress":{prog}}}'
+            self.message_callback(msg.encode())
+
+        speed = flen / (time.perf_counter() - upload_start)
+        if self.link_speed:
+            speed = 0.5 * (self.link_speed + speed)
+        self.link_speed = speed
+
+        while acks.get(timeout) is None:
+            if not self.link.is_open:
+                logging.error("Printing FAILED: connection lost")
+                self._upload = None
+                self.message_callback(b'upload:{"stat":"complete"}')
+                return False
+            self.write(self._actionmsg('', func='uploadDidFinish'))
+        self.message_callback(b'upload:{"stat":"complete"}')
+        self._print_status = 'uploaded'
+        self._uploaded_at = time.time()
+        self._upload = None
+        self.onstatuschange()
+        return True
+
     def home(self):
         logging.info("Homing printer...")
         self.sendaction("home")
@@ -456,7 +1753,19 @@ class XYZPrinter(threading.Thread):
         )
 
 
-def gcode2www(gcode, version, zipped, machine_id):
+def gcode2www(gcode, version, zipped, machine_id, stats=None, level=-1,
+              minify=False, output=None):
+    """
+    Convert gcode to the 3w format and return it. If output is a path, the
+    3w file is written there through a memory map and its size is returned
+    instead.
+    """
+    from Crypto.Cipher import AES
+
+    if stats is None:
+        stats = ConversionStats()
+    stats.start()
+    stats.sizes['input'] = len(gcode)
 
     BODY_OFFSET = 0x2000
     PACKET_SIZE = 0x2000
@@ -470,6 +1779,8 @@ def gcode2www(gcode, version, zipped, machine_id):
         'version': 18020109,
         'total_filament': 1.0,
     }
+    # keys that are estimated from the moves if the slicer does not set them
+    missing = {'print_time', 'total_layers', 'total_filament'}
 
     for key in XYZ_HEADER_KEYS:
         key_start = gcode.find(f';{key}:')
@@ -482,6 +1793,7 @@ def gcode2www(gcode, version, zipped, machine_id):
         _, val = line.split(':')
         if XYZ_HEADER_KEYS[key] is not None:
             xyz_header_dict[XYZ_HEADER_KEYS[key]] = val
+            missing.discard(XYZ_HEADER_KEYS[key])
 
     header_end = 0
     while header_end >= 0:
@@ -502,18 +1814,38 @@ def gcode2www(gcode, version, zipped, machine_id):
         line = gcode_header[key_start:key_end].replace(' ', '')
         _, val = line.split('=')
         xyz_header_dict[key] = val
+        missing.discard(key)
         gcode_header = gcode_header[:key_start] + gcode_header[key_end+1:]
+    stats.mark('header')
+
+    gcode = gcode.replace('G0 ', 'G1 ')
+    gcode = gcode.replace('G00 ', 'G1 ')
+    gcode = gcode.replace('G01 ', 'G1 ')
+    stats.mark('rewrite')
+    if minify:
+        size = len(gcode)
+        gcode = minifygcode(gcode)
+        stats.sizes['saved'] = size - len(gcode)
+        logging.info("Minification saved %d bytes (%.1f%%)",
+                     size - len(gcode), 100 * (1 - len(gcode) / max(size, 1)))
+        stats.mark('minify')
+    gcode = gcode.encode()
+    stats.mark('rewrite')
+
+    if missing:
+        estimates = estimatestats(gcode)
+        for key in missing.intersection(estimates):
+            xyz_header_dict[key] = estimates[key]
+        stats.mark('analysis')
 
     header = '\n'.join(
         [f'; {k:s} = {v}' for k, v in xyz_header_dict.items()]
     )
     header += gcode_header
     header = header.encode()
-
-    gcode = gcode.replace('G0 ', 'G1 ')
-    gcode = gcode.replace('G00 ', 'G1 ')
-    gcode = gcode.replace('G01 ', 'G1 ')
-    gcode = header + gcode.encode()
+    gcode = header + gcode
+    stats.mark('header')
+    stats.sizes['gcode'] = len(gcode)
 
     padding = pad16(len(header))
     header += bytes([padding, ]*padding)
@@ -526,40 +1858,130 @@ def gcode2www(gcode, version, zipped, machine_id):
             b'\x00'*16
         )
         header = aes_cbc.encrypt(header)
+    stats.mark('encrypt')
+
+    pieces = _wwwbody(gcode, version, zipped, level, stats, PACKET_SIZE)
+    if output is None:
+        pieces = sorted(pieces, key=lambda piece: piece[0])
+        crc = 0
+        body_size = 0
+        for _, chunk in pieces:
+            crc = zlib.crc32(chunk, crc)
+            body_size += len(chunk)
+        prefix = _wwwprefix(version, zipped, header, crc)
+        data = b''.join(
+            [prefix, bytes(BODY_OFFSET - len(prefix))] +
+            [chunk for _, chunk in pieces]
+        )
+        size = len(data)
+    else:
+        # the file is sized for the worst case and truncated at the end,
+        # the unwritten part is sparse on most file systems
+        size = BODY_OFFSET + _wwwbodybound(len(gcode), version, zipped,
+                                           PACKET_SIZE)
+        with open(output, 'w+b') as f:
+            f.truncate(size)
+            with mmap.mmap(f.fileno(), size) as out:
+                body_size = 0
+                for offset, chunk in pieces:
+                    start = BODY_OFFSET + offset
+                    out[start:start + len(chunk)] = chunk
+                    body_size = max(body_size, offset + len(chunk))
+                with memoryview(out) as view:
+                    crc = zlib.crc32(
+                        view[BODY_OFFSET:BODY_OFFSET + body_size]
+                    )
+                prefix = _wwwprefix(version, zipped, header, crc)
+                out[:len(prefix)] = prefix
+            size = BODY_OFFSET + body_size
+            f.truncate(size)
+    stats.mark('pack')
+    stats.sizes['body'] = body_size
+    stats.sizes['output'] = size
+    logging.debug("gcode2www: %s", stats)
+    if output is None:
+        return data
+    return size
+
+
+def _wwwbody(gcode, version, zipped, level, stats, packet_size=0x2000):
+    """
+    Yield the offset and the content of the pieces of the 3w body. The
+    pieces do not overlap but are not in order: the first packet of a
+    zipped body is the last one to be ready.
+    """
+    from Crypto.Cipher import AES
 
-    if version == 2:
-        if zipped:
+    if version != 2:
+        padding = pad16(len(gcode))
+        yield 0, gcode
+        yield len(gcode), bytes([padding, ]*padding)
+        return
+
+    if not zipped:
+        aes_ecb = AES.new(b'@xyzprinting.com@xyzprinting.com',
+                          AES.MODE_ECB)
+        view = memoryview(gcode)
+        tail = floor16(len(gcode))
+        # ECB encrypts every block on its own, so the body is encrypted
+        # in slices to avoid a copy of the whole G-code
+        for off in range(0, tail, 0x100000):
+            yield off, aes_ecb.encrypt(view[off:min(off + 0x100000, tail)])
+        padding = pad16(len(gcode))
+        yield tail, aes_ecb.encrypt(
+            gcode[tail:] + bytes([padding, ]*padding)
+        )
+        stats.mark('encrypt')
+        return
 
-            with io.BytesIO() as bytesio:
-                with zipfile.ZipFile(bytesio, "w",
-                                     zipfile.ZIP_DEFLATED) as zip_obj:
-                    zip_obj.writestr("sample.3w", gcode)
-                bytesio.seek(0)
-                body_data = bytesio.read()
-
-            off = 0
-            body = b''
-            while off < len(body_data):
-                aes_cbc = AES.new(
-                    b'@xyzprinting.com',
-                    AES.MODE_CBC,
-                    b'\x00'*16
-                )
-                packet = body_data[off:off + PACKET_SIZE]
-                padding = pad16(len(packet))
-                packed = packet + bytes([padding, ]*padding)
-                body += aes_cbc.encrypt(packed)
-                off += PACKET_SIZE
+    def encrypt(packet):
+        aes_cbc = AES.new(
+            b'@xyzprinting.com',
+            AES.MODE_CBC,
+            b'\x00'*16
+        )
+        padding = pad16(len(packet))
+        return aes_cbc.encrypt(packet + bytes([padding, ]*padding))
+
+    # Every packet is encrypted on its own, so they can be encrypted while
+    # the zip archive is being deflated. Only the first one has to wait for
+    # the end, since the local file header at its start contains the
+    # compressed size.
+    first = None
+    offset = 0
+    deflated = 0
+    for packet in zipdeflate(gcode, 'sample.3w', level, packet_size):
+        stats.mark('deflate')
+        deflated += len(packet)
+        if first is None:
+            first = packet
+            offset = ceil16(len(packet) + 1)
         else:
-            aes_ecb = AES.new(b'@xyzprinting.com@xyzprinting.com',
-                              AES.MODE_ECB)
-            padding = pad16(len(gcode))
-            body = gcode + bytes([padding, ]*padding)
-            body = aes_ecb.encrypt(body)
-    else:
-        padding = pad16(len(gcode))
-        body = gcode + bytes([padding, ]*padding)
+            packet = encrypt(packet)
+            yield offset, packet
+            offset += len(packet)
+        stats.mark('encrypt')
+    yield 0, encrypt(zipfixheader(first, deflated))
+    stats.mark('encrypt')
+    stats.sizes['deflated'] = deflated
+
+
+def _wwwbodybound(size, version, zipped, packet_size=0x2000):
+    """
+    Upper bound of the size of a 3w body containing size bytes of G-code.
+    """
+    if version == 2 and zipped:
+        # zlib deflateBound, plus the zip headers
+        size += (size >> 12) + (size >> 14) + (size >> 25) + 13 + 0x200
+        return -(-size // packet_size) * (packet_size + 16)
+    return size + pad16(size)
+
 
+def _wwwprefix(version, zipped, header, crc):
+    """
+    The part of a 3w file before the body: file header and encrypted
+    G-code header.
+    """
     with io.BytesIO() as stream:
         stream.write(b'3DPFNKG13WTW')
         stream.write(bytes([1, version, 0, 0]))
@@ -583,7 +2005,7 @@ def gcode2www(gcode, version, zipped, machine_id):
         if version == 5:
             stream.write(bytes([0, 0, 0, 1]))
 
-        stream.write(zlib.crc32(body).to_bytes(4, byteorder='big'))
+        stream.write(crc.to_bytes(4, byteorder='big'))
 
         if version == 5:
             stream.write(bytes(header_start-8))
@@ -591,11 +2013,209 @@ def gcode2www(gcode, version, zipped, machine_id):
             stream.write(bytes(header_start-4))
 
         stream.write(header)
-        stream.write(bytes(BODY_OFFSET - stream.tell()))
-        stream.seek(BODY_OFFSET)
-        stream.write(body)
-        stream.seek(0)
-        return stream.read()
+        return stream.getvalue()
+
+
+def readwwwheader(data):
+    """
+    Decode the G-code header of a 3w file, data must contain at least its
+    first 0x2000 bytes. Returns a dict with the header keys.
+    """
+    if not data.startswith(b'3DPFNKG13WTW'):
+        raise ValueError("not a 3w file")
+    version = data[13]
+    zip_start = int.from_bytes(data[16:20], byteorder='big')
+    pos = 20 + zip_start + 8
+    if version == 5:
+        header_len = int.from_bytes(data[pos:pos+4], byteorder='big')
+        pos += 4
+    header_start = int.from_bytes(data[pos:pos+4], byteorder='big')
+    pos += 4 + header_start
+    if version == 5:
+        header = data[pos:pos+header_len]
+    else:
+        from Crypto.Cipher import AES
+
+        # the length is not stored, the header is followed by zeros up to
+        # the body and the garbage decrypted from them is ignored below
+        header = data[pos:floor16(min(len(data), 0x2000))]
+        header = AES.new(
+            b'@xyzprinting.com',
+            AES.MODE_CBC,
+            b'\x00'*16
+        ).decrypt(header[:floor16(len(header))])
+    values = {}
+    for line in header.split(b'\n'):
+        match = re.match(rb'; ?([\w ]+?) ?= ?([ -~]*)', line)
+        if match:
+            values[match[1].decode()] = match[2].decode().strip()
+    return values
+
+
+def estimatestats(data):
+    """
+    Estimate print_time, total_layers and total_filament from the moves of
+    the G-code data (bytes), returns an empty dict if numpy is not
+    available.
+    """
+    try:
+        from monnalisa import toolpath
+    except ImportError:
+        logging.debug("numpy is not installed, cannot estimate the print "
+                      "time, the layers and the filament used")
+        return {}
+    return toolpath.gcodestats(data)
+
+
+def _trimnumber(val):
+    if '.' not in val:
+        return val
+    try:
+        float(val)
+    except ValueError:
+        return val
+    val = val.rstrip('0').rstrip('.')
+    return val if val not in ('', '-', '-0') else '0'
+
+
+def minifygcode(gcode):
+    """
+    Remove from gcode everything the printer does not need: comments, blank
+    lines, redundant whitespaces, trailing zeros in the numbers of G
+    commands and modal words of G0/G1 moves that repeat the previous value
+    (the feedrate and, in absolute positioning, the X, Y and Z coordinates).
+    """
+    out = []
+    last = {}
+    relative = False
+    for line in gcode.split('\n'):
+        comment = line.find(';')
+        if comment >= 0:
+            line = line[:comment]
+        words = line.split()
+        if not words:
+            continue
+        cmd = words[0].upper()
+        if cmd in ('G0', 'G1'):
+            kept = [words[0]]
+            for word in words[1:]:
+                letter = word[0].upper()
+                val = _trimnumber(word[1:])
+                if letter == 'F' or (letter in 'XYZ' and not relative):
+                    if last.get(letter) == val:
+                        continue
+                    last[letter] = val
+                kept.append(word[0] + val)
+            if len(kept) == 1:
+                continue
+            words = kept
+        elif cmd[0] == 'G':
+            if cmd in ('G90', 'G91'):
+                relative = cmd == 'G91'
+                last.pop('X', None)
+                last.pop('Y', None)
+                last.pop('Z', None)
+            else:
+                # homing, arcs, G92 and so on: the position and the
+                # feedrate are not known anymore
+                last.clear()
+            words = [words[0]] + [w[0] + _trimnumber(w[1:]) for w in words[1:]]
+        elif cmd[0] == 'T':
+            last.clear()
+        out.append(' '.join(words))
+    return '\n'.join(out) + '\n'
+
+
+def _dostime(date_time):
+    dostime = date_time[3] << 11 | date_time[4] << 5 | date_time[5] // 2
+    dosdate = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+    return dostime, dosdate
+
+
+def zipdeflate(data, name, level=-1, packet_size=0x2000, date_time=None):
+    """
+    Stream a single file zip archive containing data, in chunks of exactly
+    packet_size bytes (except the last one).
+
+    The archive is byte for byte the one written by zipfile.writestr, but
+    the compressed size in the local file header is left to 0 since it is
+    known only at the end: the first chunk must be fixed with zipfixheader.
+    """
+    if date_time is None:
+        date_time = time.localtime(time.time())[:6]
+    name = name.encode()
+    dostime, dosdate = _dostime(date_time)
+    crc = zlib.crc32(data)
+    buff = bytearray(struct.pack(
+        '<4s2B4HL2L2H', b'PK\003\004', 20, 0, 0, 8, dostime, dosdate,
+        crc, 0, len(data), len(name), 0
+    ))
+    buff += name
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = 0
+    view = memoryview(data)
+    # feed the compressor in slices to bound the temporary buffers
+    for off in range(0, len(data), 16 * packet_size):
+        out = compressor.compress(view[off:off + 16 * packet_size])
+        compressed += len(out)
+        buff += out
+        while len(buff) >= packet_size:
+            yield bytes(buff[:packet_size])
+            del buff[:packet_size]
+    out = compressor.flush()
+    compressed += len(out)
+    buff += out
+
+    cdir_offset = len(name) + 30 + compressed
+    cdir = struct.pack(
+        '<4s4B4HL2L5H2L', b'PK\001\002', 20, 3, 20, 0, 0, 8,
+        dostime, dosdate, crc, compressed, len(data), len(name),
+        0, 0, 0, 0, 0o600 << 16, 0
+    ) + name
+    buff += cdir
+    buff += struct.pack(
+        '<4s4H2LH', b'PK\005\006', 0, 0, 1, 1, len(cdir), cdir_offset, 0
+    )
+    for off in range(0, len(buff), packet_size):
+        yield bytes(buff[off:off + packet_size])
+
+
+def zipfixheader(packet, archive_size):
+    """
+    Write the compressed size in the first chunk produced by zipdeflate,
+    archive_size is the total length of the archive.
+    """
+    name_len, = struct.unpack('<H', packet[26:28])
+    # local header, central directory and end of central directory
+    compressed = archive_size - (30 + name_len) - (46 + name_len) - 22
+    return packet[:18] + struct.pack('<L', compressed) + packet[22:]
+
+
+def autolevel(data, link_speed, sample_size=0x40000):
+    """
+    Choose the deflate level that minimizes the time needed to compress
+    data and to send it over a link of link_speed bytes per second. The
+    speed and the ratio of each level are measured on a sample of data.
+    """
+    if not link_speed or not data:
+        return -1
+    start = max(0, len(data) // 2 - sample_size // 2)
+    sample = data[start:start + sample_size]
+    scale = len(data) / len(sample)
+    best_level = -1
+    best_time = None
+    for level in (1, 3, 6, 9):
+        stme = time.perf_counter()
+        size = len(zlib.compress(sample, level))
+        cost = (time.perf_counter() - stme) * scale
+        cost += size * scale / link_speed
+        if best_time is None or cost < best_time:
+            best_level = level
+            best_time = cost
+    logging.debug("Using deflate level %d for a link of %.1f kB/s",
+                  best_level, link_speed / 1024)
+    return best_level
 
 
 def pad16(val):
@@ -30,10 +30,15 @@ setuptools.setup(
     ],
     extras_require={
         'Webcam interface for server': 'cv2',
-    }, 
+        'Print statistics for G-code without slicer metadata': 'numpy',
+    },
     entry_points={
         'console_scripts': [
-            'monnalisa-server=monnalisa.server:main'
+            'monnalisa-server=monnalisa.server:main',
+            'monnalisa-convert=monnalisa.convert:main',
+            'monnalisa-replay=monnalisa.replay:main',
+            'monnalisa-loadtest=monnalisa.loadtest:main',
+            'monnalisa-fanout=monnalisa.fanout:main'
         ],
         'gui_scripts': [
             'monnalisa=monnalisa.xyzgui:main'
@@ -0,0 +1,78 @@
+"""
+${LICENSE_HEADER}
+"""
+
+import socket
+import threading
+import time
+
+import pytest
+
+from monnalisa import xyz
+
+
+class FakeServer(threading.Thread):
+    """
+    The server side of a socketpair, answering like a monnalisa-server
+    connected to a printer that accepts everything. The files uploaded with
+    SaveToSD are remembered in sdcard, and every message received is kept in
+    messages. Each reply waits delay seconds, like a slow link.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.client, self.sock = socket.socketpair()
+        self.codec = xyz.MessageCodec()
+        self.sdcard = set()
+        self.messages = []
+        self.delay = 0
+        self._do_stop = threading.Event()
+
+    def stop(self):
+        self._do_stop.set()
+        self.join()
+        self.sock.close()
+
+    def run(self):
+        rawbuff = b''
+        self.sock.settimeout(0.1)
+        while not self._do_stop.is_set():
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            if not data:
+                return
+            messages, rawbuff = self.codec.decode(rawbuff + data)
+            for message in messages:
+                self.reply(message)
+
+    def reply(self, message):
+        self.messages.append(message)
+        time.sleep(self.delay)
+        send = self.codec.send
+        if message.startswith(b'hello:'):
+            send(self.sock, b'hello:{"compress":"deflate"}')
+            self.codec.compress = True
+        elif message.startswith(b'XYZv3/query='):
+            send(self.sock, b'd:0,0,0\np:daVinciF10\n')
+        elif message.startswith(b'XYZv3/upload='):
+            name, size, *flags = message[13:].split(b',')
+            if b'SaveToSD' in flags:
+                self.sdcard.add(name)
+            send(self.sock, b'ok\n')
+        elif message.startswith(b'telemetry:'):
+            send(self.sock, b'telemetry:{"channels": {}}')
+        else:
+            # the other commands and the upload blocks
+            send(self.sock, b'ok\n')
+
+
+@pytest.fixture
+def server():
+    srv = FakeServer()
+    srv.start()
+    yield srv
+    srv.stop()
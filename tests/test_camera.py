@@ -0,0 +1,39 @@
+"""
+${LICENSE_HEADER}
+"""
+
+import pytest
+
+from monnalisa import camera
+
+
+@pytest.fixture
+def ring():
+    ring = camera.FrameRing(slots=3, slot_size=64)
+    yield ring
+    ring.close()
+    ring.unlink()
+
+
+def test_pinned_frame_is_kept(ring):
+    assert ring.latest() is None
+    ring.write(b'first', (5,))
+    seq, shape, data = ring.latest()
+    assert shape == (5,)
+    for i in range(5):
+        assert ring.write(bytes([65 + i]) * 4, (4,)) == seq + i + 1
+    # the writer skipped the pinned slot and did not unpin it
+    assert ring.valid(seq)
+    assert bytes(data) == b'first'
+    data.release()
+    ring.release()
+    assert not ring.valid(seq)
+    seq, shape, data = ring.latest()
+    assert (seq, bytes(data)) == (6, b'EEEE')
+    data.release()
+    ring.release()
+
+
+def test_frame_too_big(ring):
+    assert ring.write(bytes(65), (65,)) is None
+    assert ring.latest() is None
@@ -0,0 +1,42 @@
+"""
+${LICENSE_HEADER}
+"""
+
+import json
+
+from monnalisa import xyz
+from monnalisa.server import hellocommand
+
+
+MESSAGES = [b'ok', b'd:0,0,0\np:daVinciF10\n' * 3, b'E4',
+            b'j:9511,0\nt:1,20,0\n' * 10]
+
+
+def test_roundtrip():
+    for compress in (False, True):
+        sender = xyz.MessageCodec()
+        sender.compress = compress
+        wire = b''.join(sender.encode(msg) for msg in MESSAGES)
+        assert wire.count(sender.ZPACKET_START) == (2 if compress else 0)
+        # the packets are split anywhere by the socket
+        for step in (1, 7, len(wire)):
+            receiver = xyz.MessageCodec()
+            received = []
+            buff = b''
+            for off in range(0, len(wire), step):
+                messages, buff = receiver.decode(buff + wire[off:off+step])
+                received += messages
+            assert received == MESSAGES
+
+
+def test_hello():
+    reply, compress = hellocommand(b'{"compress": "deflate"}', min_size=8)
+    assert compress
+    assert json.loads(reply[6:]) == {'compress': 'deflate', 'min_size': 8}
+    reply, compress = hellocommand(b'{"compress": "deflate"}', False)
+    assert not compress
+    assert json.loads(reply[6:])['compress'] is None
+    for data in (b'[1, 2]', b'"deflate"', b'{', b'\xff'):
+        reply, compress = hellocommand(data)
+        assert reply.startswith(b'hello:')
+        assert not compress
@@ -0,0 +1,89 @@
+"""
+${LICENSE_HEADER}
+"""
+
+import time
+
+from monnalisa import xyz
+
+
+def connect(server):
+    printer = xyz.XYZPrinter()
+    printer.message_callback = lambda msg: None
+    printer.ack_timeout = 0.5
+    printer.attach(xyz.SocketPort('localhost:2222', sock=server.client))
+    while not printer.formatknown():
+        time.sleep(0.05)
+    return printer
+
+
+def test_priority():
+    printer = xyz.XYZPrinter()
+    try:
+        assert printer.commandpriority(xyz.XYZPrinter.PRINT_CANCEL) == \
+            printer.EMERGENCY
+        assert printer.commandpriority(
+            b'XYZv3/action=load:cancel'
+        ) == printer.INTERACTIVE
+    finally:
+        printer.stop()
+
+
+def test_commands_wait_for_the_upload(tmp_path, server):
+    path = tmp_path / 'sample.3w'
+    path.write_bytes(b'3DPFNKG13WTW' + bytes(8192 * 20))
+    printer = connect(server)
+    server.delay = 0.01
+    try:
+        printer.sendFile(str(path))
+        while not any(msg.startswith(b'XYZv3/upload=')
+                      for msg in server.messages):
+            time.sleep(0.01)
+        printer.jog('x', 10)
+        while printer._upload:
+            time.sleep(0.05)
+        time.sleep(0.2)
+        messages = [msg for msg in server.messages
+                    if not msg.startswith(b'XYZv3/query=')]
+        jog = next(i for i, msg in enumerate(messages)
+                   if msg.startswith(b'XYZv3/action=jog'))
+        # the 20 blocks and the final handshake come first
+        assert jog > 20
+        assert not messages[jog - 1].startswith(b'\x00\x00\x00')
+    finally:
+        printer.stop()
+
+
+def test_cancel_aborts_the_upload(tmp_path, server):
+    path = tmp_path / 'sample.3w'
+    path.write_bytes(b'3DPFNKG13WTW' + bytes(8192 * 200))
+    printer = connect(server)
+    server.delay = 0.01
+    try:
+        printer.sendFile(str(path))
+        while len(server.messages) < 10:
+            time.sleep(0.01)
+        printer.print('cancel')
+        while printer._upload:
+            time.sleep(0.05)
+        assert xyz.XYZPrinter.PRINT_CANCEL in server.messages
+        blocks = [msg for msg in server.messages
+                  if msg.startswith(b'\x00\x00')]
+        assert len(blocks) < 200
+    finally:
+        printer.stop()
+
+
+def test_stale_commands_are_dropped():
+    printer = xyz.XYZPrinter()
+    sent = []
+    printer.write = sent.append
+    printer.command_timeout = 0.1
+    try:
+        printer.sendcommand(b'XYZv3/action=home')
+        time.sleep(0.2)
+        printer.sendcommand(b'XYZv3/action=jog')
+        printer._flushcommands()
+        assert sent == [b'XYZv3/action=jog']
+    finally:
+        printer.stop()
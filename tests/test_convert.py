@@ -0,0 +1,18 @@
+"""
+${LICENSE_HEADER}
+"""
+
+from monnalisa import convert
+
+
+def test_uptodate_for_the_machine(tmp_path):
+    src = tmp_path / 'part.gcode'
+    src.write_text('; é\nG28\nG1 X10 Y10 E1\n')
+    dst = str(tmp_path / 'part.3w')
+    assert not convert.isuptodate(str(src), dst, 'daVinciF10')
+    convert.convertfile(str(src), dst, 'daVinciF10')
+    assert convert.isuptodate(str(src), dst, 'daVinciF10')
+    assert convert.wwwformat(dst) == (2, True, 'daVinciF10')
+    # same format, another machine id in the header
+    assert not convert.isuptodate(str(src), dst, 'daVinciF11')
+    assert not convert.isuptodate(str(src), dst, 'daVinciJR10S')
@@ -0,0 +1,67 @@
+"""
+${LICENSE_HEADER}
+"""
+
+import base64
+import hashlib
+import json
+import os
+
+import pytest
+
+from monnalisa.server import FileStore, offloadcommand
+
+
+DATA = bytes(range(256)) * 40
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+
+def test_chunks(tmp_path):
+    store = FileStore(str(tmp_path))
+    assert not store.has(DIGEST)
+    assert not store.write(DIGEST, len(DATA), 0, DATA[:4096])
+    # sent again after a lost reply
+    assert not store.write(DIGEST, len(DATA), 0, DATA[:4096])
+    assert store.write(DIGEST, len(DATA), 4096, DATA[4096:])
+    assert store.has(DIGEST)
+    with open(store.filepath(DIGEST), 'rb') as f:
+        assert f.read() == DATA
+    assert os.listdir(tmp_path) == [DIGEST]
+
+
+def test_invalid(tmp_path):
+    store = FileStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.filepath('../' + DIGEST[3:])
+    with pytest.raises(ValueError):
+        store.write(DIGEST, 0, 0, b'')
+    with pytest.raises(ValueError):
+        store.write(DIGEST, 10, 8, b'abc')
+    store.write(DIGEST, len(DATA), 0, DATA[:10])
+    with pytest.raises(ValueError, match='missing'):
+        store.write(DIGEST, len(DATA), 20, DATA[20:30])
+    # the partial file is dropped with the upload
+    assert os.listdir(tmp_path) == []
+    with pytest.raises(ValueError, match='corrupted'):
+        store.write(DIGEST, len(DATA), 0, bytes(len(DATA)))
+    assert not store.has(DIGEST)
+    assert os.listdir(tmp_path) == []
+
+
+def test_dedupe(tmp_path):
+    store = FileStore(str(tmp_path))
+
+    def command(**cmd):
+        reply = offloadcommand(store, None, json.dumps(cmd).encode())
+        return reply and json.loads(reply[8:])
+
+    assert command(cmd='query', hash=DIGEST)['stat'] == 'need'
+    chunk = base64.b64encode(DATA).decode()
+    assert command(cmd='data', hash=DIGEST, size=len(DATA), offset=0,
+                   data=chunk)['stat'] == 'stored'
+    assert command(cmd='query', hash=DIGEST)['stat'] == 'have'
+    # a new store finds it, and forgets the partial files
+    open(os.path.join(tmp_path, 'a' * 64 + '.part'), 'wb').close()
+    store = FileStore(str(tmp_path))
+    assert command(cmd='query', hash=DIGEST)['stat'] == 'have'
+    assert os.listdir(tmp_path) == [DIGEST]
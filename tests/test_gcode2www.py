@@ -0,0 +1,57 @@
+"""
+${LICENSE_HEADER}
+"""
+
+import hashlib
+import time
+
+import pytest
+
+from monnalisa import xyz
+
+
+# sha256 of the files written by the original gcode2www, which built the
+# whole body in memory and the zip archive with zipfile
+EXPECTED = {
+    (2, False): 'd44ea132084a8e12c5edb4461c4c4e9e'
+                'a292d153de3d510baccf2142d7c8b595',
+    (2, True): '52540fec44200163c7f58a1ba6ecf82b'
+               '3e5e24db74dafd109a6910a7ca90f5ff',
+    (5, False): '7c667f0da1547ded73db5c23da961e2f'
+                '96007790f27fb18143b8103574bf9844',
+    (5, True): '88e784d1c7d467f3425816acf1ca0e3a'
+               '3903b2a76a48130a2d2e95166697a264',
+}
+
+
+def sample():
+    # the header keys are all set, so that nothing is estimated
+    lines = [';FLAVOR:Marlin', ';TIME:1234', ';Filament used: 2.5m',
+             ';LAYER_COUNT:80', '; facets = 120', 'G28', 'G92 E0']
+    for i in range(20000):
+        lines.append(f'G{i % 2} X{i % 200}.{i % 7} Y{(i * 7) % 200}.25 '
+                     f'E{i * 0.0123:.4f} ; move {i}')
+    lines.append('G01 X0 Y0')
+    return '\n'.join(lines) + '\n'
+
+
+@pytest.fixture
+def frozen(monkeypatch):
+    # the zip archive stores the time of the conversion
+    monkeypatch.setattr(
+        time, 'localtime',
+        lambda *args: time.struct_time((2020, 1, 2, 3, 4, 6, 3, 2, 0))
+    )
+
+
+@pytest.mark.parametrize('fmt', sorted(EXPECTED))
+@pytest.mark.parametrize('mapped', [False, True])
+def test_output_unchanged(tmp_path, frozen, fmt, mapped):
+    if mapped:
+        path = tmp_path / 'sample.3w'
+        size = xyz.gcode2www(sample(), *fmt, 'daVinciF10', output=str(path))
+        data = path.read_bytes()
+        assert size == len(data)
+    else:
+        data = xyz.gcode2www(sample(), *fmt, 'daVinciF10')
+    assert hashlib.sha256(data).hexdigest() == EXPECTED[fmt]
@@ -0,0 +1,71 @@
+"""
+${LICENSE_HEADER}
+"""
+
+import json
+import os
+
+import pytest
+
+from monnalisa import xyz
+from monnalisa.jobs import JobQueue
+
+
+@pytest.fixture
+def printer():
+    # never connected, the queue only keeps the jobs
+    printer = xyz.XYZPrinter()
+    yield printer
+    printer.stop()
+
+
+def paths(queue):
+    return [os.path.basename(job['path']) for job in queue.list()]
+
+
+def test_ordering(tmp_path, printer):
+    queue = JobQueue(printer, str(tmp_path))
+    try:
+        ids = {name: queue.add(name, priority)
+               for name, priority in [('a', 0), ('b', 5), ('c', 0),
+                                      ('d', 5)]}
+        # higher priorities first, then in order of arrival
+        assert paths(queue) == ['b', 'd', 'a', 'c']
+        assert queue.setpriority(ids['c'], 5)
+        assert paths(queue) == ['b', 'd', 'c', 'a']
+        assert queue.move(ids['a'], 0)
+        assert queue.move(ids['b'], 10)
+        assert paths(queue) == ['a', 'd', 'c', 'b']
+        assert queue.cancel(ids['d'])
+        assert not queue.cancel(ids['d'])
+        assert not queue.move('missing', 0)
+        assert paths(queue) == ['a', 'c', 'b']
+    finally:
+        queue.stop()
+
+
+def test_persistence(tmp_path, printer):
+    queue = JobQueue(printer, str(tmp_path))
+    try:
+        for name, priority in [('a', 0), ('b', 1), ('c', 0)]:
+            queue.add(name, priority)
+        saved = queue.list()
+    finally:
+        queue.stop()
+
+    queue = JobQueue(printer, str(tmp_path))
+    try:
+        assert queue.list() == saved
+    finally:
+        queue.stop()
+
+    # the job that was printing is dropped, the others kept
+    state = tmp_path / JobQueue.STATE_FILE
+    jobs = json.loads(state.read_text())
+    jobs[0]['status'] = 'printing'
+    state.write_text(json.dumps(jobs))
+    queue = JobQueue(printer, str(tmp_path))
+    try:
+        assert paths(queue) == ['a', 'c']
+    finally:
+        queue.stop()
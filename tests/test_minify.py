@@ -0,0 +1,33 @@
+"""
+${LICENSE_HEADER}
+"""
+
+from monnalisa.xyz import minifygcode
+
+
+def test_comments_and_blanks():
+    gcode = '; generated\n\nG28   ; home\n  M104 S200\n'
+    assert minifygcode(gcode) == 'G28\nM104 S200\n'
+
+
+def test_numbers_trimmed():
+    gcode = 'G1 X1.500 Y-0.000 Z10 E2.0\nM104 S200.0\n'
+    assert minifygcode(gcode) == 'G1 X1.5 Y0 Z10 E2\nM104 S200.0\n'
+
+
+def test_modal_words_dropped():
+    gcode = ('G1 X1 Y2 F1200\n'
+             'G1 X1.0 Y3 F1200 E1\n'
+             'G0 X1 Y3\n')
+    assert minifygcode(gcode) == 'G1 X1 Y2 F1200\nG1 Y3 E1\n'
+
+
+def test_relative_positioning():
+    gcode = 'G91\nG1 X1 F600\nG1 X1 F600\nG90\nG1 X1\n'
+    assert minifygcode(gcode) == 'G91\nG1 X1 F600\nG1 X1\nG90\nG1 X1\n'
+
+
+def test_resets():
+    for reset in ('G28', 'G92 E0', 'T1'):
+        gcode = f'G1 X1 F100\n{reset}\nG1 X1 F100\n'
+        assert minifygcode(gcode) == gcode
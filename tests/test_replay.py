@@ -0,0 +1,42 @@
+"""
+${LICENSE_HEADER}
+"""
+
+import time
+
+from monnalisa import xyz, replay
+
+
+def record(path, server, compress, upload=None):
+    printer = xyz.XYZPrinter()
+    printer.message_callback = lambda msg: None
+    printer.poll_interval = 0.2
+    printer.record(str(path))
+    printer.attach(xyz.SocketPort('localhost:2222', compress=compress,
+                                  recorder=printer.recorder,
+                                  sock=server.client))
+    time.sleep(0.5)
+    if upload:
+        printer.sendFile(upload)
+        while printer._upload:
+            time.sleep(0.05)
+    printer.stop()
+
+
+def test_socket_roundtrip(tmp_path, server):
+    upload = tmp_path / 'sample.3w'
+    upload.write_bytes(b'3DPFNKG13WTW' + bytes(range(256)) * 100)
+    path = tmp_path / 'socket.wire'
+    record(path, server, False, str(upload))
+    stats = replay.replay(str(path), speed=0)
+    assert stats['uploads'] == 1
+    assert stats['sent'] == stats['expected'] > len(upload.read_bytes())
+    assert stats['identical']
+
+
+def test_compressed_socket_roundtrip(tmp_path, server):
+    path = tmp_path / 'zsocket.wire'
+    record(path, server, True)
+    stats = replay.replay(str(path), speed=0)
+    assert stats['expected'] > 0
+    assert stats['identical']
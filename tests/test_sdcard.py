@@ -0,0 +1,49 @@
+"""
+${LICENSE_HEADER}
+"""
+
+import time
+
+from monnalisa import xyz
+
+
+def upload(printer, path, timeout=10):
+    messages = []
+    printer.message_callback = messages.append
+    printer.sendFile(str(path))
+    deadline = time.time() + timeout
+    while printer._upload and time.time() < deadline:
+        time.sleep(0.05)
+    return messages
+
+
+def test_upload_3w_to_sdcard(tmp_path, server):
+    path = tmp_path / 'sample.3w'
+    path.write_bytes(b'3DPFNKG13WTW' + bytes(range(256)) * 100)
+    printer = xyz.XYZPrinter()
+    printer.ack_timeout = 0.5
+    printer.savetosd = True
+    printer.sdcard = xyz.SDCardIndex(str(tmp_path / 'sdcard.json'))
+    printer.attach(xyz.SocketPort('localhost:2222', sock=server.client))
+    try:
+        # the SD card is indexed by the model reported by the printer
+        while not printer.id:
+            time.sleep(0.05)
+        digest = xyz.filedigest(str(path))
+
+        messages = upload(printer, path)
+        assert b'upload:{"stat":"start"}' in messages
+        name = printer.sdcard.lookup(printer.id, digest)
+        assert name is not None
+        assert name.encode() in server.sdcard
+        assert printer.is_alive()
+
+        # uploaded again, under the same name
+        server.messages.clear()
+        messages = upload(printer, path)
+        assert b'upload:{"stat":"start"}' in messages
+        assert any(msg.startswith(b'XYZv3/upload=' + name.encode())
+                   for msg in server.messages)
+        assert printer.sdcard.lookup(printer.id, digest) == name
+    finally:
+        printer.stop()